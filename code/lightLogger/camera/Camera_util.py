@@ -5,9 +5,9 @@ import os
 import seaborn as sns
 import argparse 
 import sys 
-import matlab.engine
 from natsort import natsorted
 from collections.abc import Iterable
+import concurrent.futures
 import pickle
 import scipy.io
 from mpl_toolkits.mplot3d import Axes3D
@@ -17,6 +17,20 @@ import pandas as pd
 agc_lib_path = os.path.join(os.path.dirname(__file__))
 from recorder import CAM_FPS, parse_settings_file 
 
+"""Import the NumPy fourier regression and FPS search"""
+from fourier_util import fourier_regression, fourier_regression_with_t, fourier_regression_batch, find_observed_fps, ideal_discrete_sample_filter
+
+"""Import the Bayer pattern of the camera"""
+from frame_stats import BAYER_OFFSETS, BAYER_CHANNEL_IDS, bayer_plane_slices, read_frame_metadata, frame_times_from_metadata
+
+"""Import the frame store recordings are packed into"""
+from frame_store import is_frame_store, open_frame_store
+
+"""Import the gap detection and resampling of sensor streams"""
+resample_lib_path: str = os.path.join(os.path.dirname(__file__), '..', 'raspberry_pi_firmware', 'utility')
+sys.path.append(os.path.abspath(resample_lib_path))
+from resample import find_gaps, interpolate_samples
+
 """Parse command line arguments when script is called via command line"""
 def parse_args() -> tuple:
     parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Analyze Temporal Sensitivity of the camera")
@@ -109,56 +123,88 @@ def parse_frame_capture_file(path_to_file: str) -> pd.DataFrame:
 
     return frame_timing_df 
 
-"""Generate the flat fielding function for the camera and a matrix of color-classified pixels
-   when video input is a string, it's a path to the video file. When it's an np.array,
-   its the frames preloaded"""
-def generate_fielding_function(video: str | np.ndarray) -> tuple:
-    # Initialize frame variale
-    frames: np.ndarray = None
-    # Parse the video into its frames if given the path
-    if(type(video) is str):
-        frames: np.array = parse_video(video)
-    # Otherwise, the input parameter is already the frame array
-    else:
-        frames = video
+# Cache of the pixel matrices that have been built, by frame shape
+bayer_pixel_matrices: dict = {}
 
-    # Take the mean frame and extract its dimensions
-    mean_frame: np.array = np.mean(frames, axis=0)
+"""Return a (read only) matrix of the frame shape classifying each pixel's color 
+   as R=0, G=1, B=2. Built once per frame shape"""
+def bayer_pixel_matrix(frame_shape: tuple) -> np.ndarray:
+    frame_shape = tuple(frame_shape[:2])
+    if(frame_shape not in bayer_pixel_matrices):
+        pixel_matrix: np.ndarray = np.empty(frame_shape, dtype=np.uint8)
+        for color, channel_id in BAYER_CHANNEL_IDS.items():
+            for plane in bayer_plane_slices(color):
+                pixel_matrix[plane] = channel_id
 
-    # Construct the indices of the various colors 
-    r_pixels: np.array = np.array([(r,c)
-                                    for r in range(mean_frame.shape[0]) 
-                                    for c in range(mean_frame.shape[1]) 
-                                    if (r % 2 != 0 and c % 2 != 0)])
+        pixel_matrix.flags.writeable = False
+        bayer_pixel_matrices[frame_shape] = pixel_matrix
 
-    g_pixels: np.array = np.array([(r,c)
-                                    for r in range(mean_frame.shape[0])
-                                    for c in range(mean_frame.shape[1])
-                                    if ((r % 2 == 0 and c % 2 != 0) or (r % 2 != 0 and c % 2 == 0))])
-    b_pixels: np.array = np.array([(r,c)
-                                    for r in range(mean_frame.shape[0]) 
-                                    for c in range(mean_frame.shape[1])
-                                    if (r % 2 == 0 and c % 2 == 0)])
+    return bayer_pixel_matrices[frame_shape]
 
-    # Initialize a pixel matrix to show where in the image each pixel is
-    pixel_matrix: np.array = mean_frame.copy()
+"""Accumulates the mean frame over any number of frames or chunks of frames, 
+   holding only a running sum, so the mean frame of hours of recording takes 
+   constant memory"""
+class MeanFrameAccumulator:
+    def __init__(self):
+        self.frame_sum: np.ndarray = None
+        self.num_frames: int = 0
 
-    # Assign pixel identities
-    pixel_matrix[r_pixels[:,0], r_pixels[:,1]] = 0 # Assign R to 0
-    pixel_matrix[g_pixels[:,0], g_pixels[:,1]] = 1 # Assign G to 1
-    pixel_matrix[b_pixels[:,0], b_pixels[:,1]] = 2 # Assign B to 2
+    """Add a single frame (rows x cols) or a chunk of frames (frames x rows x cols)"""
+    def add(self, frames: np.ndarray) -> None:
+        frames = np.asarray(frames)
+        if(frames.ndim == 2): frames = frames[np.newaxis]
 
-    # Initialize the fielding function image
-    fielding_function: np.array = mean_frame.copy()
+        # Allocate the sum once we know the frame shape
+        if(self.frame_sum is None): self.frame_sum = np.zeros(frames.shape[1:], dtype=np.float64)
 
-    # Normalize the red pixels 
-    fielding_function[r_pixels[:,0], r_pixels[:,1]] /= np.max(fielding_function[r_pixels[:,0], r_pixels[:,1]])
+        self.frame_sum += np.sum(frames, axis=0, dtype=np.float64)
+        self.num_frames += frames.shape[0]
 
-    # Normalize the green pixels
-    fielding_function[g_pixels[:,0], g_pixels[:,1]] /= np.max(fielding_function[g_pixels[:,0], g_pixels[:,1]])
+    """Return the mean frame of all of the frames added so far"""
+    def mean_frame(self) -> np.ndarray:
+        assert(self.num_frames > 0)
 
-    # Normalize the blue pixels
-    fielding_function[b_pixels[:,0], b_pixels[:,1]] /= np.max(fielding_function[b_pixels[:,0], b_pixels[:,1]])
+        return self.frame_sum / self.num_frames
+
+"""Generate the flat fielding function for the camera and a matrix of color-classified pixels
+   when video input is a string, it's a path to the video file. When it's an np.array,
+   its the frames preloaded. It may also be any iterable of frames or chunks of frames 
+   (e.g. Pi_util.Recording.world.iter_chunks()), whose mean frame is accumulated 
+   incrementally in constant memory"""
+def generate_fielding_function(video: str | np.ndarray | Iterable, plot: bool=True) -> tuple:
+    # Take the mean frame. If given the path, stream the video's frames into the mean
+    if(type(video) is str):
+        accumulator: MeanFrameAccumulator = MeanFrameAccumulator()
+        for frame in stream_video(video):
+            accumulator.add(frame)
+        mean_frame: np.ndarray = accumulator.mean_frame()
+
+    # If the input parameter is already the frame array, simply take its mean 
+    elif(isinstance(video, np.ndarray)):
+        mean_frame = np.mean(video, axis=0)
+
+    # Otherwise, accumulate the mean over the chunks 
+    else:
+        accumulator = MeanFrameAccumulator()
+        for chunk in video:
+            accumulator.add(chunk)
+        mean_frame = accumulator.mean_frame()
+
+    # Retrieve the matrix showing which color each pixel in the image is
+    pixel_matrix: np.ndarray = bayer_pixel_matrix(mean_frame.shape).astype(mean_frame.dtype)
+
+    # Initialize the fielding function image, then normalize each 
+    # color's pixels by the brightest pixel of that color 
+    fielding_function: np.ndarray = mean_frame.copy()
+    for color in BAYER_OFFSETS:
+        planes: list = bayer_plane_slices(color)
+        color_max: float = max(np.max(fielding_function[plane]) for plane in planes)
+        for plane in planes:
+            fielding_function[plane] /= color_max
+
+    # If we do not want to plot, simply return
+    if(plot is False):
+        return fielding_function, pixel_matrix
 
     # Build the x, y meshgrid for the surface plot of the camera frame
     x: np.array = np.arange(0,mean_frame.shape[1])
@@ -185,13 +231,35 @@ def generate_fielding_function(video: str | np.ndarray) -> tuple:
 
     return fielding_function, pixel_matrix
 
+"""Open a frame buffer file as a memory map, and read its pages into the page cache 
+   so reducing it later does not have to wait on the disk. Reading releases the GIL, 
+   so this can run on a background thread while the previous buffer is reduced"""
+def prefetch_frame_buffer(buffer_file: str) -> np.ndarray:
+    frame_buffer: np.ndarray = np.load(buffer_file, mmap_mode='r')
+
+    # Stream the file through a small scratch buffer 
+    scratch: bytearray = bytearray(1 << 22)
+    with open(buffer_file, 'rb', buffering=0) as f:
+        while(f.readinto(scratch) > 0): pass
+
+    return frame_buffer
+
+"""Find the mean of the ROI of every frame in a stack of frames at once, as float64"""
+def mean_of_frames(frames: np.ndarray, roi_index: tuple | np.ndarray) -> np.ndarray:
+    # A rectangle (or the whole frame) is a view, so reduce over its rows and cols
+    if(isinstance(roi_index, tuple)):
+        return np.mean(frames[(slice(None), *roi_index)], axis=(1,2), dtype=np.float64)
+    
+    # A mask selects its pixels from every frame into one (frames, pixels) array
+    return np.mean(frames[:, roi_index], axis=1, dtype=np.float64)
+
 """Parse the mean of a given set of pixels from a series of frame buffers. This is 
    used as opposed to parse_mean_video when the frame array is too long to
    create a video for, and when the frames are stored in buffer format. 
-   This approach only ever stores the mean of each frame rather than 
-   loading them all in and then taking the mean, so saves more memory
-   in that regard too"""
-def parse_mean_frame_array_buffer(path_to_frame_buffers: str | list, start_buffer: int=0, pixel_indices: np.ndarray=None) -> np.array:
+   Each buffer is memory mapped and reduced in one call, while the next 
+   is prefetched on a background thread, so only the means are ever stored"""
+def parse_mean_frame_array_buffer(path_to_frame_buffers: str | list, start_buffer: int=0, pixel_indices: np.ndarray=None, 
+                                  roi: np.ndarray | tuple=None, prefetch: bool=True) -> np.array:
     # Initialize container for the frame buffer file paths 
     frame_buffer_files: list = []
     
@@ -203,147 +271,180 @@ def parse_mean_frame_array_buffer(path_to_frame_buffers: str | list, start_buffe
     else:
         frame_buffer_files = path_to_frame_buffers
 
-    # Allocate a container to hold the frame means
-    mean_array: list = []
-
-    # Iterate over the files
-    for buffer_file in frame_buffer_files:
-        # Load in the frame 
-        frame_buffer: np.ndarray = np.load(buffer_file)
-
-        # Iterate over the frames in the frame buffer 
-        for frame_idx in range(frame_buffer.shape[0]):
-            # Retrieve the frame
-            frame: np.ndarray = frame_buffer[frame_idx]
-
-            # Find the mean of the desird pixels, or entire image if no pixels 
-            # specified
-            if(pixel_indices is None or len(pixel_indices) == 0): 
-                pixel_indices = np.arange(0, frame.shape[0]*frame.shape[1])
+    # Allocate a container to hold the means of each buffer
+    buffer_means: list = []
+    roi_index: tuple | np.ndarray = None
+
+    # Load the buffers on a single background thread, so the next 
+    # is always being read while the current one is reduced
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        load_buffer = prefetch_frame_buffer if prefetch else lambda buffer_file: np.load(buffer_file, mmap_mode='r')
+        load = lambda buffer_file: executor.submit(load_buffer, buffer_file)
+        next_buffer: concurrent.futures.Future = load(frame_buffer_files[0]) if len(frame_buffer_files) > 0 else None
+
+        # Iterate over the files
+        for buffer_num in range(len(frame_buffer_files)):
+            # Retrieve this buffer and begin loading the next
+            frame_buffer: np.ndarray = next_buffer.result()
+            if(buffer_num + 1 < len(frame_buffer_files)): next_buffer = load(frame_buffer_files[buffer_num + 1])
+
+            # Build the ROI once we know the frame shape
+            if(roi_index is None): roi_index = build_roi_index(frame_buffer.shape[1:], pixel_indices, roi)
             
-            mean_frame: np.ndarray = np.mean(frame.flatten()[pixel_indices])
+            # Find the mean of the desired pixels (or the entire image if none are specified) of every frame at once
+            buffer_means.append(mean_of_frames(frame_buffer, roi_index))
 
-            # Append the mean of the frame to the mean_array 
-            mean_array.append(mean_frame)
-    
-    # Convert the mean array to a numpy array
-    mean_array: np.ndarray = np.array(mean_array, dtype=np.uint8)
+            # Unmap the buffer before moving on
+            del frame_buffer
 
-    # Retunr the mean array
-    return mean_array
+    # Concatenate the means of the buffers. Keep them as float64, 
+    # as the flicker signal is often smaller than one gray level
+    return np.concatenate(buffer_means) if len(buffer_means) > 0 else np.empty(0, dtype=np.float64)
 
 """Parse the mean of a given set of pixels from a series of frames. This is 
    used as opposed to parse_mean_video when the frame array is too long to
-   create a video for. This approach only ever stores the mean of each frame 
-   rather than loading them all in and then taking the mean, so saves more memory
-   in that regard too"""
-def parse_mean_frame_array(path_to_frames: str, start_frame: int=0, pixel_indices: np.ndarray=None) -> np.array:
+   create a video for. The frames may be single frame files or a frame store. 
+   This approach only ever stores the mean of each frame rather than loading 
+   them all in and then taking the mean, so saves more memory in that regard too"""
+def parse_mean_frame_array(path_to_frames: str, start_frame: int=0, pixel_indices: np.ndarray=None, roi: np.ndarray | tuple=None) -> np.array:
+    # If the frames have been packed into a frame store, reduce them straight from its memory map
+    if(is_frame_store(path_to_frames)):
+        frames: np.ndarray = open_frame_store(path_to_frames)[start_frame:]
+        
+        return mean_of_frames(frames, build_roi_index(frames.shape[1:], pixel_indices, roi))
+
     # Create a list of the frame files and splice from where to start
     frame_files: str = [os.path.join(path_to_frames, frame) 
                         for frame in natsorted(os.listdir(path_to_frames))][start_frame:]
 
     # Allocate a container to hold the frame means
-    mean_array: list = []
+    mean_array: np.ndarray = np.empty(len(frame_files), dtype=np.float64)
+    roi_index: tuple | np.ndarray = None
 
     # Iterate over the files
-    for frame_file in frame_files:
+    for frame_num, frame_file in enumerate(frame_files):
         # Load in the frame 
         frame: np.ndarray = np.load(frame_file)
 
-        # Find the mean of the desird pixels, or entire image if no pixels 
-        # specified
-        if(pixel_indices is None or len(pixel_indices) == 0): 
-            pixel_indices = np.arange(0, frame.shape[0]*frame.shape[1])
-        
-        mean_frame: np.ndarray = np.mean(frame.flatten()[pixel_indices])
+        # Build the ROI once we know the frame shape
+        if(roi_index is None): roi_index = build_roi_index(frame.shape, pixel_indices, roi)
 
-        # Append the mean of the frame to the mean_array 
-        mean_array.append(mean_frame)
-    
-    # Convert the mean array to a numpy array
-    mean_array: np.ndarray = np.array(mean_array, dtype=np.uint8)
+        # Find the mean of the desired pixels, or entire image if no pixels specified
+        mean_array[frame_num] = np.mean(frame[roi_index])
 
-    # Retunr the mean array
+    # Return the mean array, as float64 so the flicker signal is not quantized away
     return mean_array
     
-"""Parse video file starting as start_frame as mean of certain pixels of np.array"""
-def parse_mean_video(path_to_video: str, start_frame: int=0, pixel_indices: np.array=None) -> np.array:
+"""Build the index used to select a region of interest from every frame of a given shape, 
+   so it is only computed once per video. The ROI may be given as flat pixel_indices 
+   (as returned by pixel_to_index), a boolean mask of the frame shape, or a rectangle 
+   (row_start, row_end, col_start, col_end). Rectangles (and no ROI) index with slices, 
+   so frames are never copied just to select them"""
+def build_roi_index(frame_shape: tuple, pixel_indices: np.ndarray=None, roi: np.ndarray | tuple=None) -> tuple | np.ndarray:
+    # Convert flat pixel indices to a boolean mask once
+    if(pixel_indices is not None and len(pixel_indices) != 0):
+        mask: np.ndarray = np.zeros(frame_shape[0] * frame_shape[1], dtype=bool)
+        mask[pixel_indices] = True
+
+        return mask.reshape(frame_shape[:2])
+
+    # Use no ROI as the whole frame
+    if(roi is None): 
+        return (slice(None), slice(None))
+
+    # Otherwise, we were given a boolean mask or a rectangle 
+    if(isinstance(roi, np.ndarray)):
+        assert(roi.dtype == bool and roi.shape == tuple(frame_shape[:2]))
+        return roi
+
+    row_start, row_end, col_start, col_end = roi
+
+    return (slice(row_start, row_end), slice(col_start, col_end))
+
+"""Decode the frames of a video one at a time, yielding each as a grayscale 
+   view of a single reused buffer (so callers must copy or reduce it before 
+   the next frame). Frames before start_frame are skipped without decoding them"""
+def stream_video(path_to_video: str, start_frame: int=0):
     # Initialize a video capture object
-    video_capture: cv2.videoCapture = cv2.VideoCapture(path_to_video)
-
-    # Create a container to store the frames as they are read in
-    frames: list = []
-
-    while(True):
-        # Attempt to read a frame from the video file
-        ret, frame = video_capture.read()
-
-        # If read in valid, we are 
-        # at the end of the video, break
-        if(not ret): break 
+    video_capture: cv2.VideoCapture = cv2.VideoCapture(path_to_video)
 
-        # Images read in as color by default => All channels 
-        # equal since images were captured raw, so 
-        # just take the first value to for every pixel
-        frame: np.array = frame[:,:,0]
+    try:
+        # Skip to the start frame
+        for _ in range(start_frame):
+            if(not video_capture.grab()): return
 
-        # Find the mean of the given pixels per frame 
-        if(pixel_indices is None or len(pixel_indices) == 0): 
-            pixel_indices = np.arange(0, frame.shape[0]*frame.shape[1])
-        mean_frame: np.ndarray = np.mean(frame.flatten()[pixel_indices])
+        # Decode every frame into the same buffer. Images read in as color by 
+        # default => All channels equal since images were captured raw, so 
+        # just take the first value for every pixel
+        frame: np.ndarray = None
+        while(True):
+            ret, frame = video_capture.read(frame)
 
-        # Append the mean frame to the frames list
-        frames.append(mean_frame)
+            # If read in valid, we are 
+            # at the end of the video, break
+            if(not ret): break 
 
-    # Close the video capture object 
-    video_capture.release()
+            yield frame[:, :, 0]
     
-    # Convert frames to standardized np.array
-    frames = np.array(frames, dtype=np.uint8)
-
-    return frames[start_frame:]
+    # Close the video capture object 
+    finally:
+        video_capture.release()
 
-"""Parse video file starting as start_frame of certain pixels of np.array"""
-def parse_video(path_to_video: str, start_frame: int=0, pixel_indices: np.array=None) -> np.array:
-    # Initialize a video capture object
+"""Parse video file starting as start_frame as mean of certain pixels of np.array. 
+   Frames are reduced as they are decoded, so the video is never held in memory"""
+def parse_mean_video(path_to_video: str, start_frame: int=0, pixel_indices: np.array=None, roi: np.ndarray | tuple=None) -> np.array:
+    # Find how many frames the video says it has, to preallocate the means 
     video_capture: cv2.VideoCapture = cv2.VideoCapture(path_to_video)
+    num_frames: int = max(0, int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT)) - start_frame)
+    video_capture.release()
+    frames: np.ndarray = np.empty(num_frames, dtype=np.float64)
 
-    # Create a container to store the frames as they are read in
-    frames = []
-
-    while(True):
-        # Attempt to read a frame from the video file
-        ret, frame = video_capture.read()
+    # Find the mean of the given pixels per frame 
+    roi_index: tuple | np.ndarray = None
+    frame_num: int = 0
+    for frame in stream_video(path_to_video, start_frame):
+        # Build the ROI once we know the frame shape
+        if(roi_index is None): roi_index = build_roi_index(frame.shape, pixel_indices, roi)
 
-        # If read in valid, we are 
-        # at the end of the video, break
-        if(not ret): break 
+        # The frame count of some containers is only an estimate, so grow if needed
+        if(frame_num == frames.shape[0]): frames = np.resize(frames, max(2 * frames.shape[0], 1))
+        
+        frames[frame_num] = np.mean(frame[roi_index])
+        frame_num += 1
 
-        # Otherwise, append the frame 
-        # to the frames containers
-        frames.append(frame)
+    return frames[:frame_num]
 
-    # Close the video capture object 
+"""Parse video file starting as start_frame of certain pixels of np.array. Frames 
+   are decoded straight into a preallocated grayscale array. With a rectangular ROI 
+   the frames are cropped, with pixel indices or a mask each frame is flattened to the 
+   selected pixels"""
+def parse_video(path_to_video: str, start_frame: int=0, pixel_indices: np.array=None, roi: np.ndarray | tuple=None) -> np.array:
+    # Find how many frames the video says it has, to preallocate the frames
+    video_capture: cv2.VideoCapture = cv2.VideoCapture(path_to_video)
+    num_frames: int = max(0, int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT)) - start_frame)
     video_capture.release()
-    
-    # Convert frames to standardized np.array
-    frames = np.array(frames, dtype=np.uint8)
 
-    # Select only one channel as pixel intensity value, since 
-    # the grayscale images are read in as RGB, all channels are equal, 
-    # just choose the first one
-    frames = frames[start_frame:,:,:,0]
+    # Copy the selected pixels of each frame into the frames container 
+    frames: np.ndarray = None
+    roi_index: tuple | np.ndarray = None
+    frame_num: int = 0
+    for frame in stream_video(path_to_video, start_frame):
+        # Build the ROI and allocate the frames once we know the frame shape
+        if(roi_index is None): 
+            roi_index = build_roi_index(frame.shape, pixel_indices, roi)
+            frames = np.empty((num_frames, *frame[roi_index].shape), dtype=np.uint8)
 
-    # If we simply want the entire images, return them now 
-    if(pixel_indices is None): return frames
-    
-    # Otherwise, splice specific pixel indices
-    pixel_rows = pixel_indices // frames.shape[1]
-    pixel_cols = pixel_indices % frames.shape[1]
+        # The frame count of some containers is only an estimate, so grow if needed
+        if(frame_num == frames.shape[0]): 
+            frames = np.resize(frames, (max(2 * frames.shape[0], 1), *frames.shape[1:]))
 
-    frames = frames[:, pixel_rows, pixel_cols]
+        frames[frame_num] = frame[roi_index]
+        frame_num += 1
 
-    return frames
+    # Return an empty video if there were no frames
+    if(frames is None): return np.empty((0,), dtype=np.uint8)
+
+    return frames[:frame_num]
 
 """Convert a given str NDF representation to its float value"""
 def str2ndf(ndf_string: str) -> float:
@@ -443,6 +544,13 @@ def read_light_level_videos(recordings_dir: str, experiment_filename: str,
                               for key, val 
                               in video_settings_dict_of_lists.items()}
 
+        # Read in the sensor metadata of each frame if it was recorded (recordings 
+        # from before the world camera captured it will not have it)
+        video_metadata_filepath: str = os.path.join(metadata_dir, os.path.splitext(file)[0] + '_frameMetadata.bin')
+        if(os.path.exists(video_metadata_filepath)):
+            print(f'Video frame metadata from: {os.path.basename(video_metadata_filepath)}')
+            video_settings['frame_metadata'] = read_frame_metadata(video_metadata_filepath)
+
         # Associate the frequency to this tuple of (video, warmup_settings, settings)
         frequencies_and_videos[experiment_info["frequency"]] = (parser(filepath), warmup_settings, video_settings)
 
@@ -491,64 +599,38 @@ def plot_fit(fit_info: tuple, FPS: float, start_second: int=0, end_second: int=N
     # Show the plot
     plt.show()
 
-"""Interpolate the camera signal via MATLAB in order to 
-   help dropped frames issue"""
-def interpolate_signal(signal: np.ndarray, signal_t: np.ndarray, 
-                       fit: np.ndarray, fit_t: np.ndarray,
-                       threshold: float, fps: float,
+"""Interpolate the camera signal, captured at the times signal_t (seconds), onto a uniform 
+   timeline at fps in order to fill the frames that were dropped. Gaps longer than max_gap 
+   seconds are left as NaN rather than interpolated across if desired"""
+def interpolate_signal(signal: np.ndarray, signal_t: np.ndarray, fps: float,
+                       method: str='linear', max_gap: float=None,
                        convert_to_contrast: bool=False) -> tuple:
-    # Start the MATLAB engine
-    eng = matlab.engine.start_matlab()
-    eng.addpath('~/Documents/MATLAB/projects/combiExperiments/code/lightLogger/camera')
-    eng.addpath('~/Documents/MATLAB/projects/combiExperiments/code/lightLogger/libraries_matlab')
-
     # Convert signal to contrast (if needed)
     if(convert_to_contrast is True):
         signal_mean = np.mean(signal)
         signal = (signal - signal_mean) / signal_mean
 
-    # Call the MATLAB function to generate the interpolated signal and signal T
-    interpolated_signal, interpolated_signal_T = eng.interpolateSignal(matlab.double(signal),
-                                                                       matlab.double(signal_t),
-                                                                       matlab.double(fit),
-                                                                       matlab.double(fit_t),
-                                                                       matlab.double(threshold),
-                                                                       matlab.double(fps),
-                                                                       nargout=2)
+    # Find where frames were dropped
+    signal_t_ns: np.ndarray = np.round(np.asarray(signal_t, dtype=np.float64) * 1e9).astype(np.int64)
+    gap_indices, missing_frames = find_gaps(signal_t_ns, fps)
+    print(f'Filling {np.sum(missing_frames)} dropped frames in {len(gap_indices)} gaps')
 
-    # Convert returned data back to Python datatype 
-    interpolated_signal: np.array = np.array(interpolated_signal).flatten()
-    interpolated_signal_T: np.array = np.array(interpolated_signal_T).flatten()
+    # Resample the signal onto a uniform timeline over the same span
+    interpolated_signal_T: np.ndarray = signal_t_ns[0] + np.round(np.arange(int((signal_t_ns[-1] - signal_t_ns[0]) * fps / 1e9) + 1) * 1e9 / fps).astype(np.int64)
+    interpolated_signal: np.ndarray = interpolate_samples(interpolated_signal_T, signal_t_ns, signal, method, None if max_gap is None else max_gap * 1e9)
 
-    return interpolated_signal, interpolated_signal_T 
+    return interpolated_signal, interpolated_signal_T / 1e9
 
 """Similar to fit source modulation, but this time taking into account changes to the MATLAB fourier regression
    function to allow us to compare phases from any point in time. Needs a signal_t generated with an FPS guess."""
 def fit_source_modulation_with_t(signal: np.ndarray, signal_t: np.ndarray, frequency: float, fit_sampling_rate: float= CAM_FPS, convert_to_contrast: bool=False) -> tuple:
-    # Start the MATLAB engine
-    eng = matlab.engine.start_matlab()
-    eng.addpath('~/Documents/MATLAB/projects/combiExperiments/code/lightLogger/camera')
-
-    # Ensure MATLAB started properly
-    assert eng is not None
-
     # Convert to contrast units, if desired 
     if(convert_to_contrast is True):
         signal_mean = np.mean(signal)
         signal = (signal - signal_mean) / signal_mean
     
-    # Call the MATLAB fourier regression function
-    observed_r2, observed_amplitude, observed_phase, observed_fit, observed_model_T, observed_signal_T = eng.fourierRegressionWithT(matlab.double(signal.astype(float)), 
-                                                                                                                                    matlab.double(signal_t.astype(float)),
-                                                                                                                                    matlab.double(frequency), 
-                                                                                                                                    matlab.double(fit_sampling_rate), 
-                                                                                                                                    nargout=6)
-
-    # Convert returned data back to Python datatype 
-    observed_signal_T: np.array = np.array(observed_signal_T).flatten()
-    observed_model_T: np.array = np.array(observed_model_T).flatten()
-    observed_fit: np.array = np.array(observed_fit).flatten()
-
+    # Call the fourier regression function
+    observed_r2, observed_amplitude, observed_phase, observed_fit, observed_model_T, observed_signal_T = fourier_regression_with_t(signal, signal_t, frequency, fit_sampling_rate)
 
     print(f"R2: {observed_r2}")
     print(f"Amplitude: {observed_amplitude}")
@@ -556,45 +638,33 @@ def fit_source_modulation_with_t(signal: np.ndarray, signal_t: np.ndarray, frequ
 
     return observed_amplitude, observed_phase, (observed_signal_T, signal, observed_model_T, observed_fit, observed_r2)
 
-"""Fit the source modulation to the observed and plot the fit"""
+"""Fit the source modulation to the observed and plot the fit. If the time (seconds) 
+   each sample was captured at is known (signal_t, e.g. from the sensor timestamps 
+   of the frames), the fit uses it directly instead of searching for the FPS"""
 def fit_source_modulation(signal: np.array, light_level: str, frequency: float, ax: plt.Axes=None, 
                           fps_guess: float=CAM_FPS, fps_guess_increment: tuple=(0,0.25),
-                          convert_to_contrast: bool =False) -> tuple:     
-    # Start the MATLAB engine
-    eng = matlab.engine.start_matlab()
-    eng.addpath('~/Documents/MATLAB/projects/combiExperiments/code/lightLogger/camera')
-
-    # Ensure MATLAB started properly
-    assert eng is not None
-    
+                          convert_to_contrast: bool =False, signal_t: np.ndarray=None) -> tuple:     
     # Convert signal to contrast (if needed)
     if(convert_to_contrast is True):
         signal_mean = np.mean(signal)
         signal = (signal - signal_mean) / signal_mean
 
-    # Find the actual FPS of the observed data (might be slightly different than our guess)
-    observed_fps: matlab.double = eng.findObservedFPS(matlab.double(signal), 
-                                                      matlab.double(frequency), 
-                                                      matlab.double([fps_guess+fps_guess_increment[0], fps_guess+fps_guess_increment[1]]), 
-                                                      nargout=1)
+    # If we have the capture time of every sample, the FPS is known 
+    # and the fit accounts for any dropped frames
+    if(signal_t is not None):
+        observed_fps: float = float((len(signal_t) - 1) / (signal_t[-1] - signal_t[0]))
+        observed_r2, observed_amplitude, observed_phase, observed_fit, observed_model_T, observed_signal_T = fourier_regression_with_t(signal, signal_t, frequency)
     
-    # Fit the data
-    observed_r2, observed_amplitude, observed_phase, observed_fit, observed_model_T, observed_signal_T = eng.fourierRegression(matlab.double(signal), 
-                                                                                                                               matlab.double(frequency), 
-                                                                                                                               observed_fps, 
-                                                                                                                               nargout=6)
+    # Otherwise, find the actual FPS of the observed data (might be slightly different than our guess) 
+    # and fit the data assuming every frame was captured at it
+    else:
+        observed_fps: float = find_observed_fps(signal, frequency, 
+                                                (fps_guess+fps_guess_increment[0], fps_guess+fps_guess_increment[1]))
+        observed_r2, observed_amplitude, observed_phase, observed_fit, observed_model_T, observed_signal_T = fourier_regression(signal, frequency, observed_fps)
     print(f"Observed FPS: {observed_fps}")
     print(f"R2: {observed_r2}")
     print(f"Amplitude: {observed_amplitude}")
 
-    # Close the MATLAB engine 
-    eng.quit()
-    
-    # Convert returned data back to Python datatype 
-    observed_signal_T: np.array = np.array(observed_signal_T).flatten()
-    observed_model_T: np.array = np.array(observed_model_T).flatten()
-    observed_fit: np.array = np.array(observed_fit).flatten()
-
     # If we do not want to plot, simply return
     if(ax is None):
         return observed_amplitude, observed_phase, observed_fps
@@ -637,9 +707,14 @@ def analyze_temporal_sensitivity(recordings_dir: str, experiment_filename: str,
         print(f"Fitting Source vs Observed Modulation: {light_level}NDF {frequency}hz")
         moduation_axis, gain_axis = modulation_axes[ind], settings_axes[ind]
 
+        # Use the sensor timestamps of the frames as the temporal support of the video if they were recorded
+        signal_t: np.ndarray = None
+        if('frame_metadata' in video_settings_history and len(video_settings_history['frame_metadata']) >= mean_video.shape[0]):
+            signal_t = frame_times_from_metadata(video_settings_history['frame_metadata'][:mean_video.shape[0]])
+
         # Fit the source modulation to the observed for this frequency, 
         # and find the amplitude
-        observed_amplitude, observed_phase, observed_fps, fit = fit_source_modulation(mean_video, light_level, frequency, moduation_axis)
+        observed_amplitude, observed_phase, observed_fps, fit = fit_source_modulation(mean_video, light_level, frequency, moduation_axis, signal_t=signal_t)
 
         # Build the temporal support of the settings values by converting frame num to second
         settings_t: np.array = np.arange(0, mean_video.shape[0]/observed_fps, 1/observed_fps)
@@ -735,7 +810,8 @@ def generate_klein_ttf(recordings_dir: str, experiment_filename: str):
     # Show the figure of source vs observed modulation fits
     fig.show()
 
-    # Initialize the MATLAB engine
+    # Initialize the MATLAB engine (only imported here, as no other analysis needs it)
+    import matlab.engine
     eng = matlab.engine.start_matlab() 
     eng.addpath('/Users/zacharykelly/Documents/MATLAB/toolboxes/combiLEDToolbox/code/calibration/measureFlickerRolloff/')
 
@@ -775,11 +851,6 @@ def generate_klein_ttf(recordings_dir: str, experiment_filename: str):
 
 """Generate a TTF plot for several light levels, return values used to generate the plot"""
 def generate_TTF(recordings_dir: str, experiment_filename: str, light_levels: tuple, save_path: str=None, hold_figures_on: bool=False) -> dict: 
-    # Start the MATLAB engine
-    eng = matlab.engine.start_matlab()
-    eng.addpath('~/Documents/MATLAB/toolboxes/combiLEDToolbox/code/calibration/measureFlickerRolloff/')
-    eng.addpath('~/Documents/MATLAB/projects/combiExperiments/code/lightLogger/camera')
-
     # Create a mapping between light levels and their (frequencies, amplitudes)
     light_level_ts_map: dict = {str2ndf(light_level) : analyze_temporal_sensitivity(recordings_dir, experiment_filename, light_level)
                                                        for light_level in light_levels}
@@ -846,10 +917,10 @@ def generate_TTF(recordings_dir: str, experiment_filename: str, light_levels: tu
                                                             'fits': {'F'+str(freq).replace('.', 'x'): fit 
                                                             for freq, fit in zip(frequencies, fits)}}
 
-    # Retrieve the ideal device curve from MATLAB
-    sourceFreqsHz = matlab.double(np.logspace(0,2))
+    # Retrieve the ideal device curve
+    sourceFreqsHz = np.logspace(0,2)
     dTsignal = 1/CAM_FPS
-    ideal_device_curve = (np.array(eng.idealDiscreteSampleFilter(sourceFreqsHz, dTsignal)).flatten() * 0.5).astype(np.float64)
+    ideal_device_curve = (ideal_discrete_sample_filter(sourceFreqsHz, dTsignal) * 0.5).astype(np.float64)
     
     # Record the ideal_device_curve in the results dictionary
     results['ideal_device'] = [np.array(sourceFreqsHz, dtype=np.float64), ideal_device_curve]
@@ -862,9 +933,6 @@ def generate_TTF(recordings_dir: str, experiment_filename: str, light_levels: tu
     ttf_ax0.set_ylim([0, 0.65])
     ttf_ax1.set_ylim([0, 0.65])
 
-    # Close the MATLAB engine 
-    eng.quit()
-
     # Label TTF and FPS plot
     ttf_ax0.set_xlabel("Frequency [log]")
     ttf_ax0.set_ylabel("Amplitude")
@@ -965,26 +1033,14 @@ def generate_ms_by_exposure_plot(recordings_dir: str, experiment_filename: str,
 
 """Generate a plot of phase by row"""
 def generate_row_phase_plot(video: np.array, frequency: float) -> float:
-    # Start the MATLAB engine
-    eng = matlab.engine.start_matlab()
-
-    # Calculate the phase for each row of the video 
-    phases: list = []
-    for r in range(video.shape[1]):
-        # Get the mean video of just this row
-        row_video: np.array = np.mean(np.ascontiguousarray(video[:,r,:].astype(np.float64)), axis=1).flatten()
-
-        # Find the phase
-        observed_r2, observed_amplitude, observed_phase, observed_fit, observed_model_T, observed_signal_T = eng.fourierRegression(matlab.double(row_video),
-                                                                                                                                   matlab.double(frequency), 
-                                                                                                                                   matlab.double(CAM_FPS), 
-                                                                                                                                   nargout=6)
-        
-        # Append the phase to the storage container
-        phases.append(observed_phase)
+    # Get the mean video of every row at once (frames x rows), without copying the video
+    row_videos: np.ndarray = np.mean(video, axis=2, dtype=np.float64)
+
+    # Find the phase of every row with a single regression 
+    observed_r2, observed_amplitude, phases = fourier_regression_batch(row_videos.T, frequency, CAM_FPS)
 
-    # Convert the list of phases to standardized np.array
-    phases = np.unwrap(np.array(phases), period=np.pi/4)
+    # Unwrap the phases across rows 
+    phases = np.unwrap(phases, period=np.pi/4)
 
     # Build the x and y of the figure to plot
     x, y = range(video.shape[1]), phases
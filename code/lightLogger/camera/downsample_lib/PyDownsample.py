@@ -5,6 +5,8 @@ import numpy as np
 import os 
 import ctypes
 import cv2
+import argparse
+import time
 
 """A generalized bayer downsample algorithm written in pure Python
    Note: factor is a power of two. So factor=1 downscales by 2 along
@@ -49,6 +51,55 @@ def downsample_pure_python(img: np.array, factor: int) -> np.array:
     # Return the downsampled image
     return downsampled_img
 
+"""A generalized bayer-aware downsample algorithm written in vectorized NumPy.
+   Downsamples an entire (N, rows, cols) buffer of images (or a single image)
+   in one pass via reshaped views instead of one call per frame. Matches the CPP
+   library bit for bit, that is, the first 2x2 pixels of each color in
+   each chunk are averaged with a floored integer division.
+   Note: factor is a power of two. So factor=1 downscales by 2 along
+   dimension. Populates output_memory_buffer with the downsampled images if provided
+   (should be C-contiguous and of the same dtype as the input) and returns it."""
+def downsample_numpy(img_buffer: np.ndarray, factor: int, output_memory_buffer: np.ndarray=None) -> np.ndarray:
+    # Treat a single image as a buffer of one image
+    img_buffer_as_3d: np.ndarray = img_buffer if len(img_buffer.shape) == 3 else img_buffer[np.newaxis]
+
+    # Retrieve the shape of the images and the size of the chunks
+    # each pair of downsampled pixels per dimension is generated from
+    num_frames, height, width = img_buffer_as_3d.shape
+    chunk_size: int = 2 << factor
+    chunk_rows, chunk_cols = height // chunk_size, width // chunk_size
+
+    # The CPP algorithm samples a 4x4 region at the start of every chunk, so
+    # the chunks must be at least that large and evenly tile the image
+    assert(factor >= 1 and height % chunk_size == 0 and width % chunk_size == 0)
+
+    # Allocate the output buffer if we need to
+    if(output_memory_buffer is None):
+        output_memory_buffer = np.empty((*img_buffer.shape[:-2], height >> factor, width >> factor), dtype=img_buffer.dtype)
+
+    # Otherwise, assert the output buffer can be written to through a reshaped view
+    assert(output_memory_buffer.flags['C_CONTIGUOUS'] and output_memory_buffer.size == num_frames * (height >> factor) * (width >> factor))
+
+    # View the images as (frame, chunk row, row in chunk, chunk col, col in chunk)
+    chunks: np.ndarray = img_buffer_as_3d.reshape(num_frames, chunk_rows, chunk_size, chunk_cols, chunk_size)
+
+    # Each [r:r+2, c:c+2] slice of a chunk holds one pixel of each color in the
+    # [B, GB; GR, R] layout, so summing the four slices at offsets 0 and 2 sums each color's
+    # pixels in place. Sum in a wider type so the sum of 4 pixels does not overflow
+    accumulate_type: type = np.uint16 if img_buffer.dtype == np.uint8 else np.uint32
+    color_sums: np.ndarray = chunks[:, :, 0:2, :, 0:2].astype(accumulate_type)
+    color_sums += chunks[:, :, 0:2, :, 2:4]
+    color_sums += chunks[:, :, 2:4, :, 0:2]
+    color_sums += chunks[:, :, 2:4, :, 2:4]
+
+    # Divide by 4 and write the averages directly into the output buffer, viewed
+    # with the same (frame, chunk row, color row, chunk col, color col) layout
+    np.right_shift(color_sums, 2,
+                   out=output_memory_buffer.reshape(num_frames, chunk_rows, 2, chunk_cols, 2),
+                   casting='unsafe')
+
+    return output_memory_buffer
+
 """Import the necessary libraries to use the CPP downsampling library.
     This is time consuming, so don't do if we don't have to."""
 def import_downsample_lib() -> ctypes.CDLL:
@@ -64,7 +115,14 @@ def import_downsample_lib() -> ctypes.CDLL:
                                             ctypes.c_uint16,
                                             ctypes.c_uint8,
                                             ctypes.POINTER(ctypes.c_uint8)]
-
+    
+    downsample_lib.downsample_buffer_parallel.argtypes = [ ctypes.POINTER(ctypes.c_uint8), 
+                                                           ctypes.c_uint16,
+                                                           ctypes.c_uint16, 
+                                                           ctypes.c_uint16,
+                                                           ctypes.c_uint8,
+                                                           ctypes.POINTER(ctypes.c_uint8),
+                                                           ctypes.c_uint8]
 
     return downsample_lib
 
@@ -91,45 +149,98 @@ def downsample(img: np.ndarray, factor: int, output_memory_buffer: np.ndarray, l
    Note: factor is a power of two. So factor=1 downscales by 2 along
    dimension. Populates output_memory_buffer with a buffer of downsampled images. 
    Should be the the number of frames, then the size of the image downsampled by 
-   the factor and an np.empty of dtype np.uint8"""
-def downsample_buffer(img_buffer: np.ndarray, buffer_size: int, factor: int, output_memory_buffer: np.ndarray, lib: ctypes.CDLL=None) -> None:    
+   the factor and an np.empty of dtype np.uint8. The frames are split across n_threads 
+   CPP threads, and as the library is loaded via ctypes.CDLL, the GIL is released 
+   for the duration of the call"""
+def downsample_buffer(img_buffer: np.ndarray, buffer_size: int, factor: int, output_memory_buffer: np.ndarray, lib: ctypes.CDLL=None, n_threads: int=1) -> None:    
     # Import the downsample library if we need to. Note, this is very time consuming
     if(lib is None): lib = import_downsample_lib()
     
     # Retrieve the shape of the image
     height, width = img_buffer.shape[1], img_buffer.shape[2]
     new_height, new_width = height >> factor, width >> factor 
+
+    # The CPP library walks the buffers by raw offsets, so they must be contiguous 
+    # and large enough to hold buffer_size images
+    assert(img_buffer.flags['C_CONTIGUOUS'] and output_memory_buffer.flags['C_CONTIGUOUS'])
+    assert(img_buffer.shape[0] >= buffer_size and output_memory_buffer.size >= buffer_size * new_height * new_width)
     
     # Downsample the image and populate the buffer
-    lib.downsample_buffer(img_buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)), 
-                          buffer_size, 
-                          height, width,
-                          factor,
-                          output_memory_buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8))); 
+    lib.downsample_buffer_parallel(img_buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)), 
+                                   buffer_size, 
+                                   height, width,
+                                   factor,
+                                   output_memory_buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)),
+                                   n_threads)
 
-"""Main used for testing purposes"""
-def main():
-    # Define a path to a video 
-    path_to_vid: str = '/Volumes/EXTERNAL1/120fps_5hz_0NDF/120fps_5hz_0NDF_world'
-    
-    # Read in the first frame buffer
-    first_frame_buffer: np.ndarray = np.load(os.path.join(path_to_vid, '120.npy'))
+"""Parse arguments from the command line"""
+def parse_args() -> tuple:
+    parser = argparse.ArgumentParser(description="Test the equivalence and throughput of the downsampling implementations")
 
-    # Retrieve a sample frame 
-    sample_frame: np.ndarray = first_frame_buffer[0]
+    parser.add_argument("--n_frames", type=int, default=200, help="The number of random frames to downsample")
+    parser.add_argument("--factor", type=int, default=4, help="The power of 2 to downsample by")
+    parser.add_argument("--n_trials", type=int, default=5, help="The number of trials to average throughput over")
 
-    print(f'Dimensions before: {sample_frame.shape}')
+    args = parser.parse_args()
 
-    # Import the CPP downsamplig lib 
-    lib = import_downsample_lib()
+    return args.n_frames, args.factor, args.n_trials
 
-    downsampled = downsample(sample_frame, 1, lib)
+"""Main used for testing purposes. Checks the batched downsamplers against the
+   per-frame CPP and NumPy implementations on random buffers at every factor up to
+   the given one, then reports the throughput of each at the given factor in frames per second"""
+def main():
+    n_frames, factor, n_trials = parse_args()
 
-    print(f"Dimensions after downsampling: {downsampled.shape}")
+    # Generate a random buffer of frames the size of the world camera's frames
+    img_buffer: np.ndarray = np.random.randint(0, 256, size=(n_frames, 480, 640), dtype=np.uint8)
 
-    #plt.imshow(downsampled, cmap='gray')
+    # Import the CPP downsamplig lib 
+    lib = import_downsample_lib()
 
-    #plt.show()
+    # Check every factor, not only the one timed, as each one changes how the frames are chunked
+    for test_factor in range(1, factor + 1):
+        new_shape: tuple = (n_frames, 480 >> test_factor, 640 >> test_factor)
+
+        # Generate the reference output with the per-frame CPP implementation
+        reference: np.ndarray = np.empty(new_shape, dtype=np.uint8)
+        for i in range(n_frames):
+            downsample(img_buffer[i], test_factor, reference[i], lib)
+
+        # The NumPy implementation shares no code with the CPP one, 
+        # so check the reference against it first
+        numpy_reference: np.ndarray = downsample_numpy(img_buffer, test_factor)
+        assert(np.array_equal(numpy_reference, reference)), f'downsample_numpy does not match the per-frame CPP downsample at factor {test_factor}'
+
+        # The pure Python implementation averages every pixel of a color in a chunk, so 
+        # it only agrees with the CPP (first 2x2 pixels of a color) when a chunk is 4x4
+        if(test_factor == 1):
+            for i in range(min(n_frames, 5)):
+                assert(np.array_equal(downsample_pure_python(img_buffer[i], test_factor), reference[i]))
+
+        # Check the parallel path against both references, including 
+        # a thread count that does not evenly divide the frames
+        for n_threads in (1, 2, 3, 4):
+            output: np.ndarray = np.zeros(new_shape, dtype=np.uint8)
+            downsample_buffer(img_buffer, n_frames, test_factor, output, lib, n_threads)
+            assert(np.array_equal(output, reference) and np.array_equal(output, numpy_reference)), f'downsample_buffer ({n_threads} threads) does not match at factor {test_factor}'
+
+        print(f'Factor {test_factor}: downsample_numpy and downsample_buffer equivalent')
+
+    # Define the batched implementations to time
+    new_shape: tuple = (n_frames, 480 >> factor, 640 >> factor)
+    implementations: dict = {'downsample_numpy': lambda output: downsample_numpy(img_buffer, factor, output)}
+    for n_threads in (1, 2, 4):
+        implementations[f'downsample_buffer ({n_threads} threads)'] = lambda output, n_threads=n_threads: downsample_buffer(img_buffer, n_frames, factor, output, lib, n_threads)
+
+    # Time each implementation
+    for name, implementation in implementations.items():
+        output: np.ndarray = np.zeros(new_shape, dtype=np.uint8)
+        start_time: float = time.perf_counter()
+        for trial in range(n_trials):
+            implementation(output)
+        elapsed_time: float = time.perf_counter() - start_time
+
+        print(f'{name}: {(n_frames * n_trials) / elapsed_time:.1f} FPS')
 
 if(__name__ == '__main__'):
-    main()  
\ No newline at end of file
+    main()  
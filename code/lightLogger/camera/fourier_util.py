@@ -0,0 +1,262 @@
+import numpy as np
+import scipy.optimize
+import scipy.io
+import argparse
+
+"""NumPy ports of the MATLAB fourierRegression, findObservedFPS and
+   idealDiscreteSampleFilter functions in this directory, so fitting
+   does not need a MATLAB engine (or license) at all"""
+
+"""Return the number of points MATLAB's colon operator 0:step:stop generates"""
+def colon_length(stop: float, step: float) -> int:
+    # MATLAB allows for a little floating point error at the end of the range
+    n_steps: float = stop / step
+
+    return max(0, int(np.floor(n_steps + 1e-10 * max(1, abs(n_steps)))) + 1)
+
+"""Sample a signal with uniform temporal support (starting at 0) at the times t
+   using the nearest neighbor, extrapolating with the first/last sample,
+   as MATLAB's interp1(signalT, signal, t, 'nearest', 'extrap')"""
+def nearest_uniform(signal: np.ndarray, delta_t: float, t: np.ndarray) -> np.ndarray:
+    # Ties are rounded up, as MATLAB does
+    indices: np.ndarray = np.floor(t / delta_t + 0.5).astype(np.int64)
+    np.clip(indices, 0, signal.shape[0] - 1, out=indices)
+
+    return signal[indices]
+
+"""Sample a signal with arbitrary (increasing) temporal support signal_t at the times t
+   using the nearest neighbor, extrapolating with the first/last sample"""
+def nearest_nonuniform(signal: np.ndarray, signal_t: np.ndarray, t: np.ndarray) -> np.ndarray:
+    # Find the sample at or after each time, then step back if the one before is closer
+    indices: np.ndarray = np.clip(np.searchsorted(signal_t, t), 1, signal_t.shape[0] - 1)
+    indices -= (t - signal_t[indices - 1]) < (signal_t[indices] - t)
+
+    return signal[indices]
+
+"""Fit a sinusoid of frequency f0 to the samples y taken at times model_t
+   by least squares. Returns r2, amplitude, phase and the fit"""
+def fit_sinusoid(y: np.ndarray, f0: float, model_t: np.ndarray) -> tuple:
+    # Set up the regression matrix
+    X: np.ndarray = np.column_stack((np.sin(model_t / (1/f0) * 2 * np.pi),
+                                     np.cos(model_t / (1/f0) * 2 * np.pi)))
+
+    # Perform the fit
+    b, *_ = np.linalg.lstsq(X, y, rcond=None)
+
+    # Derive some results
+    fit: np.ndarray = X @ b
+    amplitude: float = float(np.linalg.norm(b))
+    phase: float = float(-np.arctan(b[1] / b[0]))
+    r2: float = float(np.corrcoef(fit, y)[0, 1] ** 2)
+
+    return r2, amplitude, phase, fit
+
+"""Fit a sinusoid of frequency f0 to a signal sampled at fps, after
+   upsampling it to fps_model with the nearest neighbor. Mirrors fourierRegression.m,
+   returning r2, amplitude, phase, fit, model_t, signal_t"""
+def fourier_regression(signal: np.ndarray, f0: float, fps: float, fps_model: float=10000) -> tuple:
+    signal = np.asarray(signal, dtype=np.float64).flatten()
+
+    # Define some aspects of temporal support
+    delta_t: float = 1 / fps
+    model_delta_t: float = 1 / fps_model
+    elapsed_seconds: float = signal.shape[0] * delta_t
+    signal_t: np.ndarray = np.arange(colon_length(elapsed_seconds - delta_t, delta_t)) * delta_t
+    model_t: np.ndarray = np.arange(colon_length(elapsed_seconds - model_delta_t, model_delta_t)) * model_delta_t
+
+    # Upsample the signal and fit it
+    y: np.ndarray = nearest_uniform(signal, delta_t, model_t)
+    r2, amplitude, phase, fit = fit_sinusoid(y, f0, model_t)
+
+    return r2, amplitude, phase, fit, model_t, signal_t
+
+"""Fit a sinusoid of frequency f0 to a signal with its own temporal support signal_t
+   (e.g. the timestamps of its frames), after upsampling it to fps_model with the nearest
+   neighbor. The model spans signal_t, so the phases of fits to different windows
+   of the same recording are comparable. Returns r2, amplitude, phase, fit, model_t, signal_t"""
+def fourier_regression_with_t(signal: np.ndarray, signal_t: np.ndarray, f0: float, fps_model: float=10000) -> tuple:
+    signal = np.asarray(signal, dtype=np.float64).flatten()
+    signal_t = np.asarray(signal_t, dtype=np.float64).flatten()
+
+    # Define the model's temporal support over the span of the signal
+    model_delta_t: float = 1 / fps_model
+    model_t: np.ndarray = signal_t[0] + np.arange(colon_length(signal_t[-1] - signal_t[0], model_delta_t)) * model_delta_t
+
+    # Upsample the signal and fit it
+    y: np.ndarray = nearest_nonuniform(signal, signal_t, model_t)
+    r2, amplitude, phase, fit = fit_sinusoid(y, f0, model_t)
+
+    return r2, amplitude, phase, fit, model_t, signal_t
+
+"""Fit a sinusoid of frequency f0 to many signals of the same length sampled at fps 
+   (one per row of signals) at once, as fourier_regression would to each. The nearest 
+   neighbor upsampling only repeats samples, so it is folded into the regression matrix 
+   and the upsampled signals are never built. Returns arrays of r2, amplitude and phase"""
+def fourier_regression_batch(signals: np.ndarray, f0: float, fps: float, fps_model: float=10000) -> tuple:
+    signals = np.asarray(signals, dtype=np.float64)
+
+    # Define some aspects of temporal support
+    delta_t: float = 1 / fps
+    model_delta_t: float = 1 / fps_model
+    n_samples: int = signals.shape[1]
+    elapsed_seconds: float = n_samples * delta_t
+    model_t: np.ndarray = np.arange(colon_length(elapsed_seconds - model_delta_t, model_delta_t)) * model_delta_t
+
+    # Set up the regression matrix shared by every signal
+    X: np.ndarray = np.column_stack((np.sin(model_t / (1/f0) * 2 * np.pi),
+                                     np.cos(model_t / (1/f0) * 2 * np.pi)))
+
+    # Find which sample each model time is upsampled from, then sum the rows of the regression 
+    # matrix that each sample is repeated into, as well as how many times it is repeated
+    indices: np.ndarray = nearest_uniform(np.arange(n_samples), delta_t, model_t)
+    counts: np.ndarray = np.bincount(indices, minlength=n_samples).astype(np.float64)
+    W: np.ndarray = np.column_stack([np.bincount(indices, weights=X[:, col], minlength=n_samples) for col in range(2)])
+
+    # Solve the normal equations for all of the signals at once (one right hand side per signal)
+    XtX: np.ndarray = X.T @ X
+    Xty: np.ndarray = W.T @ signals.T
+    b: np.ndarray = np.linalg.solve(XtX, Xty)
+
+    # Derive some results
+    amplitude: np.ndarray = np.linalg.norm(b, axis=0)
+    phase: np.ndarray = -np.arctan(b[1] / b[0])
+
+    # Find the correlation of each fit with its upsampled signal from their sums
+    n_model: int = model_t.shape[0]
+    sum_y: np.ndarray = signals @ counts
+    sum_yy: np.ndarray = (signals ** 2) @ counts
+    sum_fit: np.ndarray = X.sum(axis=0) @ b
+    sum_fitfit: np.ndarray = np.einsum('in,ij,jn->n', b, XtX, b)
+    sum_fity: np.ndarray = np.einsum('in,in->n', b, Xty)
+    covariance: np.ndarray = sum_fity - sum_fit * sum_y / n_model
+    r2: np.ndarray = covariance ** 2 / ((sum_fitfit - sum_fit ** 2 / n_model) * (sum_yy - sum_y ** 2 / n_model))
+
+    return r2, amplitude, phase
+
+"""Find the FPS (within fps_range) a signal of a source modulating at f0 was
+   actually observed at, as the one the sinusoid fits best. Mirrors findObservedFPS.m"""
+def find_observed_fps(signal: np.ndarray, f0: float, fps_range: tuple=(206, 207)) -> float:
+    signal = np.asarray(signal, dtype=np.float64).flatten()
+
+    # Define an objective
+    objective = lambda fps: -fourier_regression(signal, f0, fps)[0]
+
+    # Search with the same bounded golden section/parabolic search (and
+    # tolerance) as MATLAB's fminbnd
+    result = scipy.optimize.minimize_scalar(objective, bounds=tuple(fps_range), method='bounded', options={'xatol': 1e-4})
+
+    return float(result.x)
+
+"""Find the amplitude an ideal device sampling every dt_signal seconds would
+   observe for sources at each frequency. Mirrors idealDiscreteSampleFilter.m"""
+def ideal_discrete_sample_filter(source_freqs_hz: np.ndarray, dt_signal: float) -> np.ndarray:
+    n_cycles: int = 100
+    dt_source: float = 0.001 # seconds
+
+    filter_profile: np.ndarray = np.empty(len(source_freqs_hz), dtype=np.float64)
+    for ii, source_freq_hz in enumerate(np.asarray(source_freqs_hz, dtype=np.float64).flatten()):
+        # Generate the source and sample it as the device would
+        source_dur_secs: float = n_cycles / source_freq_hz
+        source_t: np.ndarray = np.arange(colon_length(source_dur_secs - dt_source, dt_source)) * dt_source
+        source: np.ndarray = np.sin(source_t / (1/source_freq_hz) * 2 * np.pi)
+        signal_t: np.ndarray = np.arange(colon_length(source_dur_secs - dt_signal, dt_signal)) * dt_signal
+        signal: np.ndarray = np.interp(signal_t, source_t, source)
+
+        # Fit the source frequency to the sampled signal
+        y: np.ndarray = nearest_uniform(signal, dt_signal, source_t)
+        _, filter_profile[ii], _, _ = fit_sinusoid(y, source_freq_hz, source_t)
+
+    return filter_profile
+
+"""Parse arguments from the command line"""
+def parse_args() -> str:
+    parser = argparse.ArgumentParser(description='Check the NumPy fourier regression against known answers, and optionally against stored MATLAB results')
+
+    parser.add_argument('results_path', type=str, nargs='?', default=None, help='Path to a .mat file with the variables signal, f0, fps, r2, amplitude, phase and fit from fourierRegression, and optionally fpsRange and observedFPS from findObservedFPS')
+
+    args = parser.parse_args()
+
+    return args.results_path
+
+"""Check the fits recover the amplitude, phase and FPS of generated sinusoids,
+   whose answers are known without MATLAB"""
+def check_known_answers() -> None:
+    rng: np.random.Generator = np.random.default_rng(0)
+
+    # Generate a few seconds of a source modulating at f0 as seen by a 200 FPS camera. The fit 
+    # is sin/cos without an offset, so the phase it returns is the negative of the source's.
+    # The nearest neighbor upsampling turns the samples into a staircase, which costs a
+    # little r2 and biases the phase by about 1e-3 radians
+    f0, fps, amplitude, phase = 4.0, 200.0, 0.3, 0.6
+    signal_t: np.ndarray = np.arange(int(4 * fps)) / fps
+    signal: np.ndarray = amplitude * np.sin(2 * np.pi * f0 * signal_t + phase)
+
+    r2, fit_amplitude, fit_phase, fit, model_t, fit_signal_t = fourier_regression(signal, f0, fps)
+    print(f'fourier_regression | r2: {r2} | amplitude: {fit_amplitude} (expected {amplitude}) | phase: {fit_phase} (expected {-phase})')
+    assert(r2 > 0.99 and abs(fit_amplitude - amplitude) < 1e-3 and abs(fit_phase + phase) < 5e-3)
+    assert(np.allclose(fit_signal_t, signal_t))
+
+    # The same source on jittered frame times, fit on those times
+    jittered_t: np.ndarray = np.sort(signal_t + rng.uniform(-1e-3, 1e-3, signal_t.shape[0]))
+    jittered_signal: np.ndarray = amplitude * np.sin(2 * np.pi * f0 * jittered_t + phase)
+    r2, fit_amplitude, fit_phase, *_ = fourier_regression_with_t(jittered_signal, jittered_t, f0)
+    print(f'fourier_regression_with_t | r2: {r2} | amplitude: {fit_amplitude} | phase: {fit_phase}')
+    assert(r2 > 0.99 and abs(fit_amplitude - amplitude) < 1e-3 and abs(fit_phase + phase) < 5e-3)
+
+    # Rows of different amplitudes and phases (plus noise), fit at once and one by one
+    amplitudes: np.ndarray = rng.uniform(0.1, 1, 8)
+    phases: np.ndarray = rng.uniform(-1.2, 1.2, 8)
+    signals: np.ndarray = amplitudes[:, np.newaxis] * np.sin(2 * np.pi * f0 * signal_t + phases[:, np.newaxis]) + rng.normal(0, 0.01, (8, signal_t.shape[0]))
+    r2s, fit_amplitudes, fit_phases = fourier_regression_batch(signals, f0, fps)
+    print(f'fourier_regression_batch | amplitude max error: {np.max(np.abs(fit_amplitudes - amplitudes))} | phase max error: {np.max(np.abs(fit_phases + phases))}')
+    assert(np.all(np.abs(fit_amplitudes - amplitudes) < 5e-3) and np.all(np.abs(fit_phases + phases) < 2e-2))
+    assert(np.allclose(np.array([fourier_regression(row, f0, fps)[:3] for row in signals]).T, (r2s, fit_amplitudes, fit_phases)))
+
+    # A camera nominally at 200 FPS that actually ran at 206.5 FPS
+    observed_fps: float = 206.5
+    signal = amplitude * np.sin(2 * np.pi * f0 * np.arange(int(10 * observed_fps)) / observed_fps + phase)
+    fit_fps: float = find_observed_fps(signal, f0)
+    print(f'find_observed_fps: {fit_fps} (expected {observed_fps})')
+    assert(abs(fit_fps - observed_fps) < 1e-2)
+
+    # An ideal device passes a source far below its sampling rate untouched, 
+    # and one at its Nyquist frequency is attenuated
+    filter_profile: np.ndarray = ideal_discrete_sample_filter(np.array([1.0, 100.0]), 1 / fps)
+    print(f'ideal_discrete_sample_filter: {filter_profile}')
+    assert(abs(filter_profile[0] - 1) < 1e-3 and filter_profile[1] < 0.9)
+
+"""Compare the NumPy fits to ones stored from MATLAB"""
+def check_matlab_results(results_path: str) -> None:
+    # Load the MATLAB inputs and outputs
+    results: dict = scipy.io.loadmat(results_path, squeeze_me=True)
+    signal, f0, fps = results['signal'], float(results['f0']), float(results['fps'])
+
+    # Compare the fourier regression
+    r2, amplitude, phase, fit, model_t, signal_t = fourier_regression(signal, f0, fps)
+    print(f"r2: {r2} | MATLAB: {results['r2']}")
+    print(f"amplitude: {amplitude} | MATLAB: {results['amplitude']}")
+    print(f"phase: {phase} | MATLAB: {results['phase']}")
+    print(f"fit max abs difference: {np.max(np.abs(fit - results['fit']))}")
+    assert(np.allclose((r2, amplitude, phase), (results['r2'], results['amplitude'], results['phase']), rtol=1e-6, atol=1e-9))
+    assert(np.allclose(fit, results['fit'], rtol=1e-6, atol=1e-9))
+
+    # Compare the FPS search if it was stored
+    if('observedFPS' in results):
+        observed_fps: float = find_observed_fps(signal, f0, results['fpsRange'])
+        print(f"observed FPS: {observed_fps} | MATLAB: {results['observedFPS']}")
+        assert(abs(observed_fps - results['observedFPS']) < 1e-3)
+
+    print('NumPy fits match MATLAB')
+
+"""Main used for testing purposes. Checks the NumPy fits against known answers,
+   then against results stored from MATLAB if they are given"""
+def main():
+    results_path = parse_args()
+
+    check_known_answers()
+    print('NumPy fits recover the known answers')
+
+    if(results_path is not None): check_matlab_results(results_path)
+
+if(__name__ == '__main__'):
+    main()
@@ -0,0 +1,179 @@
+import numpy as np
+import json
+import os
+import argparse
+import time
+
+"""Layout of a frame store. A frame store is a directory holding every frame
+   of a recording back to back in one raw file, along with a small JSON index.
+   As every frame has the same shape and dtype, frame i begins at byte
+   i * frame_bytes, so any frame can be read in O(1) through a memory map.
+   The index also records the range of frames each appended buffer became"""
+FRAME_STORE_DATA: str = 'frames.store'
+FRAME_STORE_INDEX: str = 'frames_index.json'
+
+# The number of frames preallocated when the expected number is not given
+DEFAULT_CAPACITY: int = 200 * 60
+
+"""Return whether a directory holds a frame store"""
+def is_frame_store(path: str) -> bool:
+    return os.path.exists(os.path.join(path, FRAME_STORE_INDEX))
+
+"""Appends buffers of frames to a frame store. The data file is preallocated
+   for capacity frames (and doubled whenever it fills), so appending never
+   has to grow the file a little at a time. The index is only written on close,
+   so a store is not visible to readers until it is complete"""
+class FrameStoreWriter:
+    def __init__(self, path: str, frame_shape: tuple, dtype: np.dtype=np.uint8, capacity: int=DEFAULT_CAPACITY):
+        if(not os.path.exists(path)): os.mkdir(path)
+
+        # Describe the frames this store holds
+        self.path: str = path
+        self.frame_shape: tuple = tuple(int(dim) for dim in frame_shape)
+        self.dtype: np.dtype = np.dtype(dtype)
+        self.frame_bytes: int = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+
+        # The number of frames written, and the (source, first frame, number of frames) of each buffer
+        self.num_frames: int = 0
+        self.buffers: list = []
+
+        # Open and preallocate the data file
+        self.fd: int = os.open(os.path.join(path, FRAME_STORE_DATA), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.capacity: int = 0
+        self.reserve(max(1, capacity))
+
+    """Make sure the data file has room for at least capacity frames"""
+    def reserve(self, capacity: int) -> None:
+        if(capacity <= self.capacity): return
+
+        # Ask the filesystem for the blocks up front where we can,
+        # so the file is not fragmented as it is filled
+        if(hasattr(os, 'posix_fallocate')):
+            os.posix_fallocate(self.fd, 0, capacity * self.frame_bytes)
+        else:
+            os.ftruncate(self.fd, capacity * self.frame_bytes)
+        self.capacity = capacity
+
+    """Append a buffer of frames (frames, *frame_shape) to the store. Returns
+       the number of the first frame the buffer became"""
+    def append(self, frames: np.ndarray, source: str=None) -> int:
+        frames = np.ascontiguousarray(frames, dtype=self.dtype)
+        assert(tuple(frames.shape[1:]) == self.frame_shape)
+
+        # Double the capacity until the buffer fits
+        while(self.num_frames + frames.shape[0] > self.capacity):
+            self.reserve(2 * self.capacity)
+
+        # Write the frames at their offset. os.pwrite may write only
+        # some of the bytes, so keep writing from wherever it stopped
+        data: memoryview = memoryview(frames.reshape(-1)).cast('B')
+        offset: int = self.num_frames * self.frame_bytes
+        while(len(data) > 0):
+            bytes_written: int = os.pwrite(self.fd, data, offset)
+            data = data[bytes_written:]
+            offset += bytes_written
+
+        # Record where this buffer went
+        first_frame: int = self.num_frames
+        self.buffers.append((source, first_frame, frames.shape[0]))
+        self.num_frames += frames.shape[0]
+
+        return first_frame
+
+    """Trim the unused preallocated space, then write the index"""
+    def close(self) -> None:
+        os.ftruncate(self.fd, self.num_frames * self.frame_bytes)
+        os.close(self.fd)
+
+        index: dict = {'frame_shape': list(self.frame_shape), 'dtype': self.dtype.str,
+                       'num_frames': self.num_frames, 'buffers': self.buffers}
+        with open(os.path.join(self.path, FRAME_STORE_INDEX), 'w') as f:
+            json.dump(index, f)
+
+"""Read the index of a frame store"""
+def read_frame_store_index(path: str) -> dict:
+    with open(os.path.join(path, FRAME_STORE_INDEX), 'r') as f:
+        return json.load(f)
+
+"""Open the frames of a frame store as a read-only memory map of shape (frames, *frame_shape).
+   Frames are only read from disk when they are accessed"""
+def open_frame_store(path: str) -> np.ndarray:
+    index: dict = read_frame_store_index(path)
+
+    # A memory map cannot be empty, so return an empty array for an empty store
+    if(index['num_frames'] == 0):
+        return np.empty((0, *index['frame_shape']), dtype=np.dtype(index['dtype']))
+
+    return np.memmap(os.path.join(path, FRAME_STORE_DATA), dtype=np.dtype(index['dtype']), mode='r',
+                     shape=(index['num_frames'], *index['frame_shape']))
+
+"""Pack buffer .npy files (each of shape (frames, *frame_shape)) into a frame store at path,
+   in the given order. The buffer files are removed once they are packed if desired"""
+def pack_buffer_files(path: str, buffer_files: list, remove_buffers: bool=True) -> int:
+    writer: FrameStoreWriter = None
+    for i, buffer_file in enumerate(buffer_files):
+        print(f'Packing buffer: {i+1}/{len(buffer_files)}')
+
+        # Memory map the buffer, so it is only read once as it is copied into the store
+        frame_buffer: np.ndarray = np.load(buffer_file, mmap_mode='r')
+
+        # Open the store once we know the frame shape, preallocating as
+        # if every buffer has as many frames as the first
+        if(writer is None):
+            writer = FrameStoreWriter(path, frame_buffer.shape[1:], frame_buffer.dtype, len(buffer_files) * frame_buffer.shape[0])
+
+        writer.append(frame_buffer, os.path.basename(buffer_file))
+        del frame_buffer
+
+    if(writer is None): return 0
+    writer.close()
+
+    # Remove the buffers only after the store is complete
+    if(remove_buffers is True):
+        for buffer_file in buffer_files: os.remove(buffer_file)
+
+    return writer.num_frames
+
+"""Parse arguments from the command line"""
+def parse_args() -> tuple:
+    parser = argparse.ArgumentParser(description='Pack synthetic frame buffers into a frame store and time random access to it')
+
+    parser.add_argument('path', type=str, help='The directory to build the frame store in')
+    parser.add_argument('--n_buffers', type=int, default=10, help='The number of buffers to pack')
+    parser.add_argument('--buffer_length', type=int, default=200, help='The number of frames in each buffer')
+
+    args = parser.parse_args()
+
+    return args.path, args.n_buffers, args.buffer_length
+
+"""Main used for testing purposes. Packs synthetic buffers, then checks
+   the frames read back at random match the ones written"""
+def main():
+    path, n_buffers, buffer_length = parse_args()
+    if(not os.path.exists(path)): os.mkdir(path)
+
+    # Generate and save the buffers
+    rng: np.random.Generator = np.random.default_rng(0)
+    frames: np.ndarray = rng.integers(0, 255, (n_buffers * buffer_length, 60, 80), dtype=np.uint8)
+    buffer_files: list = []
+    for buffer_num in range(n_buffers):
+        buffer_file: str = os.path.join(path, f'{(buffer_num + 1) * buffer_length}.npy')
+        np.save(buffer_file, frames[buffer_num * buffer_length:(buffer_num + 1) * buffer_length])
+        buffer_files.append(buffer_file)
+
+    # Pack them into a store
+    start_time: float = time.time()
+    pack_buffer_files(path, buffer_files)
+    print(f'Packed {frames.shape[0]} frames in {time.time() - start_time:.3f} seconds')
+
+    # Read frames back at random
+    store: np.ndarray = open_frame_store(path)
+    frame_nums: np.ndarray = rng.integers(0, frames.shape[0], 1000)
+    start_time = time.time()
+    for frame_num in frame_nums:
+        assert(np.array_equal(store[frame_num], frames[frame_num]))
+    print(f'Read {len(frame_nums)} random frames in {time.time() - start_time:.3f} seconds')
+    assert(np.array_equal(store, frames))
+
+if(__name__ == '__main__'):
+    main()
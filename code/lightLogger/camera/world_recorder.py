@@ -10,6 +10,7 @@ import threading
 import pandas as pd
 import matplotlib.pyplot as plt
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import psutil
 import signal
 import traceback
@@ -26,11 +27,27 @@ AGC_lib = import_AGC_lib()
 """Import the custom Downsampling library"""
 downsample_lib_path = os.path.join(os.path.dirname(__file__), 'downsample_lib')
 sys.path.append(os.path.abspath(downsample_lib_path))
-from PyDownsample import import_downsample_lib, downsample, downsample_buffer, downsample_pure_python
+from PyDownsample import import_downsample_lib, downsample_buffer, downsample_numpy, downsample_pure_python
 
 # Import the CPP downsample lib (with types, etc)
 downsample_lib = import_downsample_lib()
 
+"""Import the control channel used to communicate with the master process"""
+firmware_lib_path = os.path.join(os.path.dirname(__file__), '..', 'raspberry_pi_firmware')
+sys.path.append(os.path.abspath(firmware_lib_path))
+from control_channel import ControlClient, control_socket_path, GO, sleep_until
+from cpu_plan import applied_plan_report
+
+"""Import the ring the capture thread hands items to its writer thread through"""
+from spsc_ring import SPSCRing
+
+"""Import the per-frame means computed at capture time, and the 
+   format the sensor metadata of each frame is stored in"""
+from frame_stats import FrameMeans, write_frame_means, FRAME_METADATA_DTYPE, frame_metadata_record
+
+"""Import the frame store the captured buffers are packed into"""
+from frame_store import pack_buffer_files, is_frame_store, open_frame_store
+
 # The FPS we have locked the camera to (as opposed to 206.65 in the settings)
 CAM_FPS: float = 200
 
@@ -40,9 +57,50 @@ CAM_IMG_DIMS: np.ndarray = np.array((480, 640), dtype=np.uint16)
 # The power of 2 to downsample the recorded image by 
 downsample_factor: int = 4 # 4 worked well
 
+# The number of 1 second frame buffer slots the capture and write threads cycle through
+capture_ring_slots: int = 3
+
+"""A preallocated ring of 1 second frame, settings and frame metadata buffer slots shared 
+   between the capture and write threads. Ownership of a slot is handed off 
+   explicitly: the capture thread acquires a free slot, fills it and sends its 
+   index to the writer, which releases it once it has been written. Capture never 
+   blocks or overwrites a slot still being written; if no slot is free, that 
+   second of frames is dropped and counted instead."""
+class CaptureRing:
+    def __init__(self, n_slots: int, frame_shape: tuple, settings_dtype: type):
+        # Allocate the slots and touch every page now, so that 
+        # capture never waits on the allocation of memory
+        self.frame_buffers: np.ndarray = np.empty((n_slots, CAM_FPS, *frame_shape), dtype=np.uint8)
+        self.settings_buffers: np.ndarray = np.empty((n_slots, CAM_FPS, 2), dtype=settings_dtype)
+        self.metadata_buffers: np.ndarray = np.empty((n_slots, CAM_FPS), dtype=FRAME_METADATA_DTYPE)
+        self.frame_buffers.fill(0)
+        self.settings_buffers.fill(0)
+        self.metadata_buffers.fill(0)
+
+        # Initially, all of the slots are free for the capture thread to fill
+        self.free_slots: queue.SimpleQueue = queue.SimpleQueue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+
+        # Count the seconds of frames dropped because no slot was free 
+        self.dropped_slots: int = 0
+
+    """Retrieve the index of a free slot for the capture thread to fill, 
+       or None (and count the drop) if the writer still owns all of them"""
+    def acquire(self) -> int | None:
+        try:
+            return self.free_slots.get_nowait()
+        except queue.Empty:
+            self.dropped_slots += 1
+            return None
+
+    """Return a slot that has finished being written to the capture thread"""
+    def release(self, slot: int) -> None:
+        self.free_slots.put(slot)
+
 """Write a frame and its info in the write queue to disk 
 in the output_path directory and to the settings file"""
-def write_frame(write_queue: queue.Queue, filename: str, generate_settingsfile: bool=True):
+def write_frame(write_queue: SPSCRing, filename: str, generate_settingsfile: bool=True):
     # Ensure the output directory exists (if we are not running via signalcommunication)
     if(not os.path.exists(filename) and generate_settingsfile):
         os.makedirs(filename)
@@ -84,8 +142,9 @@ def write_frame(write_queue: queue.Queue, filename: str, generate_settingsfile:
             # Skip the rest of the loop work
             continue
 
-        # Extract frame and its metadata
-        frame_buffer, frame_num, settings_buffer = ret[0:3]
+        # Extract the ring slot holding the frames and their metadata
+        ring, slot, frame_num = ret[0:3]
+        frame_buffer, settings_buffer = ring.frame_buffers[slot], ring.settings_buffers[slot]
 
         # If the length is greater than two, we've passed it 
         # the filename (directory) to save under and the settings file
@@ -112,14 +171,8 @@ def write_frame(write_queue: queue.Queue, filename: str, generate_settingsfile:
         # must have been timing related
         if(not os.path.exists(filename)): os.mkdir(filename)
 
-        # Print out the state of the write queue
-        print(f'Camera queue size: {write_queue.qsize()}')
-
-        # Downsample every frame in the frame buffer and populate the downsampled buffer 
-        #downsample_buffer(frame_buffer, CAM_FPS, downsample_factor, downsampled_buffer, downsample_lib)
-        
-        for i in range(frame_buffer.shape[0]):
-            downsample(frame_buffer[i], downsample_factor, downsampled_buffer[i], downsample_lib) 
+        # Downsample every frame in the frame buffer at once and populate the downsampled buffer 
+        downsample_numpy(frame_buffer, downsample_factor, downsampled_buffer)
 
         # Write the frame
         save_path: str = os.path.join(filename, f'{frame_num}.npy')
@@ -128,41 +181,36 @@ def write_frame(write_queue: queue.Queue, filename: str, generate_settingsfile:
         # Write the frame info to the existing csv file
         np.savetxt(current_settingsfile, settings_buffer, delimiter=',', fmt='%d')
 
+        # Append the sensor metadata of the frames to the binary file next to the settings file
+        with open(current_settingsfile.name.replace('settingsHistory.csv', 'frameMetadata.bin'), 'ab') as f:
+            ring.metadata_buffers[slot].tofile(f)
+
+        # Hand the slot back to the capture thread now that it has been written
+        ring.release(slot)
+
     # Close the settings and frame timings files (if needed)
     if(current_settingsfile is not None and not current_settingsfile.closed): current_settingsfile.close()
 
 """Unpack chunks of n captured frames. This is used 
    to reformat the memory-limitation required capture 
-   buffer format into the single frame files the codebase 
-   is built on at the end of a capture."""
+   buffer format into a single indexed frame store (see frame_store) 
+   at the end of a capture, so any frame can be read without 
+   loading its buffer, and the buffer files are removed"""
 def unpack_capture_chunks(path_to_frames: str):
-    # Declare an accumulator variable to hold the real frame number 
-    # of each frame when we resave it 
-    frame_num: int = 0
-
-    # First retrieve the frame buffer files
-    frame_buffer_files: list = natsorted(os.listdir(path_to_frames))
-
-    # Iterate over the frame buffer files
-    for i, frame_buffer_file in enumerate(frame_buffer_files):
-        print(f'Camera unpacking buffer: {i+1}/{len(frame_buffer_files)}')
-
-        # Load in this buffer 
-        frame_buffer: np.ndarray = np.load(os.path.join(path_to_frames, frame_buffer_file))
-
-        # Assert we are unpacking a buffer and not a frame
+    # First retrieve the frame buffer files in the order they were captured
+    frame_buffer_files: list = [os.path.join(path_to_frames, frame_buffer_file) 
+                                for frame_buffer_file in natsorted(os.listdir(path_to_frames))
+                                if frame_buffer_file.endswith('.npy')]
+
+    # Assert we are unpacking buffers and not frames (only reads their headers)
+    for frame_buffer_file in frame_buffer_files:
+        frame_buffer: np.ndarray = np.load(frame_buffer_file, mmap_mode='r')
         assert(len(frame_buffer.shape) == 3 and frame_buffer.shape[0] == CAM_FPS) 
+        del frame_buffer
 
-        # Iterate over the frames in the buffer 
-        for frame_idx in range(frame_buffer.shape[0]):
-            # Construct the new path to save this file (all buffer files will be overwritten by these)
-            save_path: str = os.path.join(path_to_frames, f'{frame_num}.npy')
-
-            # Save the frame
-            np.save(save_path, frame_buffer[frame_idx])
-
-            # Increment the frame number
-            frame_num += 1 
+    # Append the buffers to the frame store, one after another
+    print(f'Camera packing {len(frame_buffer_files)} buffers into a frame store')
+    pack_buffer_files(path_to_frames, frame_buffer_files)
 
 
 """Parse the setting file for a video as a data frame"""
@@ -171,6 +219,9 @@ def parse_settings_file(path: str) -> pd.DataFrame:
 
 """Read in a video from a folder full of images saved as .np files as 8-bit unsigned np.array"""
 def vid_array_from_npy_folder(path: str) -> np.array:
+    # Memory map the frames if they have been packed into a frame store
+    if(is_frame_store(path)): return open_frame_store(path)
+
     frames = [np.load(os.path.join(path, frame))
               for frame in natsorted(os.listdir(path))
               if('.pkl' not in frame and '.txt' not in frame)]
@@ -202,21 +253,39 @@ def reconstruct_video(video_frames: np.array, output_path: str):
     # Release the VideoWriter object
     out.release()
 
+"""Capture a frame along with the metadata the sensor reported for it 
+   (as a frame metadata record). Capturing the request, rather than just 
+   its array, means the timestamp and exposure belong to this exact frame. 
+   Only the odd cols of the frame are kept (even cols have junk content)"""
+def capture_frame(cam: object) -> tuple:
+    request: object = cam.capture_request()
+    try:
+        frame: np.ndarray = request.make_array('raw')[:, 1::2]
+        metadata: tuple = frame_metadata_record(request.get_metadata())
+    finally:
+        # Return the request's buffers to the camera
+        request.release()
+
+    return frame, metadata
+
 """A helper function that contains the meat of capturing 
    a video of a set length, for use when communicating 
    via signals"""
-def capture_helper(cam: object, duration: float, write_queue: queue.Queue,
+def capture_helper(cam: object, duration: float, write_queue: SPSCRing,
                   current_gain: float, current_exposure: float,
                   gain_change_interval: float,
-                  frame_buffer: np.ndarray, settings_buffer: np.ndarray,
+                  ring: CaptureRing,
                   filename: str, settings_file: object, 
-                  burst_num: int) -> None:
+                  burst_num: int, frame_means: FrameMeans=None) -> None:
     print('World Cam: Beginning capture')
 
     # Begin timing capture
     start_capture_time: float = time.time()
     last_gain_change: float = start_capture_time 
 
+    # Note how many slots had been dropped before this burst
+    start_dropped_slots: int = ring.dropped_slots
+
     # Capture duration (seconds) of frames
     frame_num: int = 0
     while(True):
@@ -227,12 +296,22 @@ def capture_helper(cam: object, duration: float, write_queue: queue.Queue,
         if((current_time - start_capture_time) >= duration):
             break  
 
-        # Capture the frame and splice only the odd cols (even cols have junk content)
-        frame: np.array = cam.capture_array('raw')[:, 1::2]
+        # At the start of every second, acquire a free slot to fill 
+        if(frame_num % CAM_FPS == 0): slot = ring.acquire()
+
+        # Capture the frame (and its sensor metadata) and splice only the odd cols (even cols have junk content)
+        frame, metadata = capture_frame(cam)
+
+        # Store the frame + settings into the slot (if we were able to acquire one)
+        if(slot is not None):
+            ring.frame_buffers[slot, frame_num % CAM_FPS] = frame
+            ring.settings_buffers[slot, frame_num % CAM_FPS] = (current_gain, current_exposure) 
+            ring.metadata_buffers[slot, frame_num % CAM_FPS] = metadata
 
-        # Store the frame + settings into the allocated memory buffers
-        frame_buffer[frame_num % CAM_FPS] = frame
-        settings_buffer[frame_num % CAM_FPS] = (current_gain, current_exposure) 
+        # Compute the means of the frame while it is still in cache, from the contiguous 
+        # copy in the slot if there is one, as that is much faster to reduce than the strided frame
+        if(frame_means is not None and frame_num < frame_means.frame_means.shape[0]): 
+            frame_means.add(frame_num, ring.frame_buffers[slot, frame_num % CAM_FPS] if slot is not None else frame)
 
         # Change gain every N ms
         if((current_time - last_gain_change) > gain_change_interval):
@@ -256,12 +335,14 @@ def capture_helper(cam: object, duration: float, write_queue: queue.Queue,
         # Record the next frame number
         frame_num += 1 
 
-        # If we have now captured one second worth of frames, send the frame buffer 
-        # to be written 
-        if(frame_num % CAM_FPS == 0):
-            #write_queue.put((frame_buffer, frame_num, settings_buffer, frame_timings_buffer))
-            write_queue.put((frame_buffer, frame_num, settings_buffer, filename, settings_file))
+        # If we have now captured one second worth of frames, hand the filled 
+        # slot off to be written 
+        if(frame_num % CAM_FPS == 0 and slot is not None):
+            write_queue.put((ring, slot, frame_num, filename, settings_file))
     
+    # Return a partially filled slot to the ring, as only full seconds are written
+    if(frame_num % CAM_FPS != 0 and slot is not None): ring.release(slot)
+
     # Record timing of end of capture 
     end_capture_time: float = time.time()
     
@@ -269,15 +350,22 @@ def capture_helper(cam: object, duration: float, write_queue: queue.Queue,
     # (approximate due to time taken for other computation)
     observed_fps: float = (frame_num)/(end_capture_time-start_capture_time)
 
+    # Calculate how many seconds of frames were dropped this burst because the writer fell behind
+    dropped_slots: int = ring.dropped_slots - start_dropped_slots
+
     # Add this observed FPS to the write queue, to denote the FPS of the video 
-    write_queue.put({"num_frames_captured": frame_num, "observed_fps": observed_fps})
+    write_queue.put({"num_frames_captured": frame_num, "observed_fps": observed_fps, "dropped_slots": dropped_slots})
 
-    print(f'World cam: captured {frame_num} at ~{observed_fps} fps')
+    print(f'World cam: captured {frame_num} at ~{observed_fps} fps | Dropped slots: {dropped_slots}')
+
+    # Write the means of this burst's frames as a side-car next to it 
+    if(frame_means is not None): 
+        write_frame_means(f'{filename}_frameMeans.npz', frame_means, min(frame_num, frame_means.frame_means.shape[0]))
 
 
 """Record from with the camera with a specified duration, but 
    communicating with signals"""
-def record_video_signalcom(duration: float, write_queue: queue.Queue, 
+def record_video_signalcom(duration: float, write_queue: SPSCRing, 
                            filename: str, initial_gain: float, initial_exposure: int,
                            stop_flag: threading.Event, is_subprocess: bool,
                            parent_pid: int, go_flag: threading.Event,
@@ -286,14 +374,6 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
     # Retrieve the name of the controller this recorder is operating out of
     controller_name: str = setproctitle.getproctitle()
     
-    # Define the path to the controller READY files
-    READY_file_dir: str = "/home/rpiControl/combiExperiments/code/lightLogger/raspberry_pi_firmware/READY_files"
-    GO_file_dir: str = "/home/rpiControl/combiExperiments/code/lightLogger/raspberry_pi_firmware/GO_files"
-    STOP_file_dir: str = "/home/rpiControl/combiExperiments/code/lightLogger/raspberry_pi_firmware/STOP_files"
-
-    # Define the name of this controller's READY file 
-    READY_file_name: str = os.path.join(READY_file_dir, f"{controller_name}|READY")
-
     # Connect to and set up camera
     print(f"Initializing World camera")
     cam: Picamera2 = initialize_camera(initial_gain, initial_exposure)
@@ -308,44 +388,35 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
     # (had to put this here at some point) for it to work 
     cam.set_controls({'AeEnable':0, 'AwbEnable':0})
 
-    # Initialize a contiguous memory buffer to store 1 second of frames 
-    # + settings in this is so when we send them to be written, numpy does not have 
-    # to reallocate for contiguous memory, thus slowing down capture
-    frame_buffer: np.array = np.zeros((CAM_FPS, 480,640), dtype=np.uint8)
-    settings_buffer: np.array = np.zeros((CAM_FPS, 2), dtype=np.float16)
+    # Initialize a ring of contiguous memory buffers to each store 1 second of frames 
+    # + settings in. This is so when we send them to be written, numpy does not have 
+    # to reallocate for contiguous memory, thus slowing down capture, and so we never 
+    # overwrite a buffer that is still being written
+    ring: CaptureRing = CaptureRing(capture_ring_slots, (480, 640), np.float16)
 
-    # If we were run as a subprocess, send a message to the parent 
-    # process that we are ready to go via creating a file with the name of 
-    # this controller
-    try:
-        if(is_subprocess is True):
-            print(f'World Cam: Initialized. Generating READY flag file for parent: {parent_pid}')
+    # Initialize the per-frame (and per-Bayer-color) means of a burst, with an extra 
+    # second worth of frames in case we capture above the desired FPS
+    frame_means: FrameMeans = FrameMeans(int(np.ceil(duration) + 1) * CAM_FPS, bayer=True)
 
-            # Add a READY file for this controller
-            with open(READY_file_name, 'w') as f: pass
-
-            # While we have not receieved the GO signal wait 
-            start_wait: float = time.time()
-            last_read: float = time.time()
-            while(not go_flag.is_set()):
-                # Set the GO flag if we have received a GO signal
-                if(len(os.listdir(GO_file_dir)) > 0): go_flag.set()
+    # Define the starting burst number
+    # and the thus the initial filename
+    # settings file, and generate them before we report READY
+    filename : str = filename.replace('burstX', f"burst{burst_num}") 
+    if(not os.path.exists(filename)): os.mkdir(filename)
+    settings_file: object = open(f'{filename}_settingsHistory.csv', 'a')
 
-                # Capture the current time
-                current_wait: float = time.time()
+    # Connect to the parent process' control channel and report that we are 
+    # ready to go, then block (without spinning) until it tells us to GO 
+    try:
+        print(f'World Cam: Initialized. Sending READY signal to parent: {parent_pid}')
+        control: ControlClient = ControlClient(control_socket_path(parent_pid), controller_name)
+        control.send_ready(burst_num, pid=os.getpid(), cpu_plan=applied_plan_report())
 
-                # If the parent process is no longer existent, something has gone wrong
-                # and we should quit 
-                if(not psutil.pid_exists(parent_pid)):
-                    raise Exception('ERROR: Parent process was killed')
-                
-                # Every 2 seconds, output a message
-                if((current_wait - last_read) >= 2):
-                    print('World Cam: Waiting for GO signal...')
-                    last_read = current_wait
+        # Wait for the first command. This raises an error if the parent process has died 
+        command: dict = control.wait_for_command()
     
     # Catch if there was an error in some part of the pipeline and we did not receive 
-    # a go signal in the appropriate amount of time
+    # a go signal 
     except Exception as e:
         # Close the camera 
         cam.close()
@@ -355,69 +426,53 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
         print(e)
         sys.exit(1)
 
-    # Now, the camera was initialized and the first ready was sent and the first go was received
-    # Therefore, let's record the amount of time we desire
-    
-    # Define the starting burst number
-    # and the thus the initial filename
-    # settings file
-    filename : str = filename.replace('burstX', f"burst{burst_num}") 
-    settings_file: object = open(f'{filename}_settingsHistory.csv', 'a')
-
-    # Once the GO signal has been received, begin capturing chunks until we 
-    # receive a stop signal
-    while(not stop_flag.is_set()):     
-        # Use the milliseconds of time gaps between GO signals to generate files and hopefully not add 
-        # any delay in the start of a burst capture
+    # Now, the camera was initialized and the first ready was sent and the first command was received
+    # Therefore, capture bursts for as long as the parent tells us to GO
+    while(command['type'] == GO and not stop_flag.is_set()):     
+        # Arm and sleep until the start time the parent scheduled for every controller, 
+        # noting how late we actually started 
+        start_offset_ns: int = control.wait_for_start(command)
+
+        # Record a burst
+        go_flag.set()
+        capture_helper(cam, duration, write_queue, current_gain, current_exposure,
+                       gain_change_interval,
+                       ring,
+                       filename, settings_file,
+                       burst_num, frame_means)
+        go_flag.clear()
+
+        # Increment the burst number += 1 
+        burst_num += 1
+
+        # Update the filename for the new burst number
+        filename = filename.replace(f'burst{burst_num-1}', f"burst{burst_num}")
+
+        # Use the time between bursts to generate the files for the next burst and hopefully 
+        # not add any delay in the start of a burst capture
         # Akin to racing the beam on ATARI 2600, pretty cool! 
-
-        # STOP if we have received a stop signal
-        if(len(os.listdir(STOP_file_dir)) > 0): break 
-
-        # Set the GO flag if we have received a GO signal
-        if(len(os.listdir(GO_file_dir)) > 0): go_flag.set()
-
-        # Generate the directory for this burst if it does not already exist
         if(not os.path.exists(filename)): os.mkdir(filename)
-        
-        # Generate/Open the settings file for this burst if it does not already exist
         if(settings_file.name != f'{filename}_settingsHistory.csv'): 
             settings_file = open(f'{filename}_settingsHistory.csv', 'a')
 
-        # While we have the GO signal, record a burst
-        while(go_flag.is_set()):
-            # Capture duration worth of frames
-            capture_helper(cam, duration, write_queue, current_gain, current_exposure,
-                           gain_change_interval,
-                           frame_buffer, settings_buffer,
-                           filename, settings_file,
-                           burst_num)
-
-            # Stop recording until we receive the GO signal again 
-            go_flag.clear()
-            # Try except here because multiple controllers could be trying to remove this file at once 
-            # so it could be deleted by the time another goes to delete it
-            try:
-                for file in os.listdir(GO_file_dir): os.remove(os.path.join(GO_file_dir, file))
-            except:
-                pass
-
-            # Report to the parent process we are ready to go for the next burst 
-            assert(not os.path.exists(READY_file_name))
-            with open(READY_file_name, 'w') as f: pass
-            print(f'World cam: Finished burst: {burst_num+1} | Generating READY signal for parent: {parent_pid}!')
-        
-            # Increment the burst number += 1 
-            burst_num += 1
+        # Report to the parent process we are ready to go for the next burst, 
+        # along with when we started the last one 
+        control.send_ready(burst_num, start_time_ns=command['start_time_ns'], start_offset_ns=start_offset_ns)
+        print(f'World cam: Finished burst: {burst_num} | Sending READY signal for parent: {parent_pid}!')
 
-            # Update the filename for the new burst number
-            filename = filename.replace(f'burst{burst_num-1}', f"burst{burst_num}")
+        # Block until the next GO or STOP. If the parent has died, stop
+        try:
+            command = control.wait_for_command()
+        except ConnectionError:
+            print('World cam: Parent closed the control channel')
+            break
 
     # Append None to the write queue to signal it is time to stop 
-    write_queue.put(None)
+    write_queue.close()
 
-    # Stop recording and close the picam object 
+    # Stop recording and close the picam object and the control channel
     cam.close() 
+    control.close()
 
     ## If the last dir we made never got used, remove it
     if(os.path.exists(filename) and len(os.listdir(filename)) == 0): os.rmdir(filename)
@@ -429,14 +484,11 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
     # Remove it as well if it is empty
     if(os.path.exists(settings_file.name) and os.path.getsize(settings_file.name) == 0): os.remove(settings_file.name)
 
-    # Remove any left over READY file if it is empty 
-    if(os.path.exists(READY_file_name)): os.remove(READY_file_name)
-
     print(f'World cam: Finishing recording')
     
 
 """Record live from the camera with no specified duration"""
-def record_live(duration: float, write_queue: queue.Queue, filename: str, 
+def record_live(duration: float, write_queue: SPSCRing, filename: str, 
                 initial_gain: float, initial_exposure: int,
                 stop_flag: threading.Event,
                 is_subprocess: bool,
@@ -461,14 +513,11 @@ def record_live(duration: float, write_queue: queue.Queue, filename: str,
     # (had to put this here at some point) for it to work 
     cam.set_controls({'AeEnable':0, 'AwbEnable':0})   
 
-     # Initialize a contiguous memory buffer to store 1 second of frames 
-    # + settings in this is so when we send them to be written, numpy does not have 
-    # to reallocate for contiguous memory, thus slowing down capture
-    #frame_buffer: np.array = np.zeros((CAM_FPS, 480, 640), dtype=np.uint8)
-    frame_buffer: np.array = np.zeros((CAM_FPS, 480, 640), dtype=np.uint8)
-    settings_buffer: np.array = np.zeros((CAM_FPS, 2), dtype=np.float32)
-    #frame_timings_buffer: np.array = np.zeros((CAM_FPS,2), dtype=float) 
-    #cpu_info_buffer: np.array = np.zeros((CAM_FPS,2), dtype=float) 
+    # Initialize a ring of contiguous memory buffers to each store 1 second of frames 
+    # + settings in. This is so when we send them to be written, numpy does not have 
+    # to reallocate for contiguous memory, thus slowing down capture, and so we never 
+    # overwrite a buffer that is still being written
+    ring: CaptureRing = CaptureRing(capture_ring_slots, (480, 640), np.float32)
 
 
     # Initialize the last time we changed the gain as the current time
@@ -480,12 +529,17 @@ def record_live(duration: float, write_queue: queue.Queue, filename: str,
         # Capture the current time
         current_time: float = time.time()
         
-        # Capture the frame and splice only the odd cols (even cols have junk content)
-        frame: np.array = cam.capture_array('raw')[:, 1::2]
+        # At the start of every second, acquire a free slot to fill 
+        if(frame_num % CAM_FPS == 0): slot = ring.acquire()
+
+        # Capture the frame (and its sensor metadata) and splice only the odd cols (even cols have junk content)
+        frame, metadata = capture_frame(cam)
 
-        # Store the frame + settings into the allocated memory buffers
-        frame_buffer[frame_num % CAM_FPS] = frame
-        settings_buffer[frame_num % CAM_FPS] = (current_gain, current_exposure)
+        # Store the frame + settings into the slot (if we were able to acquire one)
+        if(slot is not None):
+            ring.frame_buffers[slot, frame_num % CAM_FPS] = frame
+            ring.settings_buffers[slot, frame_num % CAM_FPS] = (current_gain, current_exposure)
+            ring.metadata_buffers[slot, frame_num % CAM_FPS] = metadata
    
         # Change gain every N ms
         if((current_time - last_gain_change) > gain_change_interval):
@@ -511,21 +565,20 @@ def record_live(duration: float, write_queue: queue.Queue, filename: str,
         # Record the next frame number
         frame_num += 1 
 
-        # If we have now captured one second worth of frames, send the frame buffer 
-        # to be written 
-        if(frame_num % CAM_FPS == 0):
-            #write_queue.put((frame_buffer, frame_num, settings_buffer, frame_timings_buffer, cpu_info_buffer))
-            write_queue.put((frame_buffer, frame_num, settings_buffer))
+        # If we have now captured one second worth of frames, hand the filled 
+        # slot off to be written 
+        if(frame_num % CAM_FPS == 0 and slot is not None):
+            write_queue.put((ring, slot, frame_num))
 
 
     # Signal the end of the write queue
-    write_queue.put(None) 
+    write_queue.close() 
 
     # Close the camera
     cam.close()
 
 """Record a viceo from the Raspberry Pi camera"""
-def record_video(duration: float, write_queue: queue.Queue, filename: str, 
+def record_video(duration: float, write_queue: SPSCRing, filename: str, 
                  initial_gain: float, initial_exposure: int,
                  stop_flag: threading.Event,
                  is_subprocess: bool,
@@ -554,11 +607,11 @@ def record_video(duration: float, write_queue: queue.Queue, filename: str,
     # (had to put this here at some point) for it to work 
     cam.set_controls({'AeEnable':0, 'AwbEnable':0})   
 
-    # Initialize a contiguous memory buffer to store 1 second of frames 
-    # + settings in this is so when we send them to be written, numpy does not have 
-    # to reallocate for contiguous memory, thus slowing down capture
-    frame_buffer: np.array = np.zeros((CAM_FPS, 480,640), dtype=np.uint8)
-    settings_buffer: np.array = np.zeros((CAM_FPS, 2), dtype=np.float16)
+    # Initialize a ring of contiguous memory buffers to each store 1 second of frames 
+    # + settings in. This is so when we send them to be written, numpy does not have 
+    # to reallocate for contiguous memory, thus slowing down capture, and so we never 
+    # overwrite a buffer that is still being written
+    ring: CaptureRing = CaptureRing(capture_ring_slots, (480, 640), np.float16)
 
     # If we were run as a subprocess, send a message to the parent 
     # process that we are ready to go
@@ -613,12 +666,17 @@ def record_video(duration: float, write_queue: queue.Queue, filename: str,
         if((current_time - start_capture_time) >= duration):
             break  
 
-        # Capture the frame and splice only the odd cols (even cols have junk content)
-        frame: np.array = cam.capture_array('raw')[:, 1::2]
+        # At the start of every second, acquire a free slot to fill 
+        if(frame_num % CAM_FPS == 0): slot = ring.acquire()
 
-        # Store the frame + settings into the allocated memory buffers
-        frame_buffer[frame_num % CAM_FPS] = frame
-        settings_buffer[frame_num % CAM_FPS] = (current_gain, current_exposure) 
+        # Capture the frame (and its sensor metadata) and splice only the odd cols (even cols have junk content)
+        frame, metadata = capture_frame(cam)
+
+        # Store the frame + settings into the slot (if we were able to acquire one)
+        if(slot is not None):
+            ring.frame_buffers[slot, frame_num % CAM_FPS] = frame
+            ring.settings_buffers[slot, frame_num % CAM_FPS] = (current_gain, current_exposure) 
+            ring.metadata_buffers[slot, frame_num % CAM_FPS] = metadata
 
         # Change gain every N ms
         if((current_time - last_gain_change) > gain_change_interval):
@@ -642,31 +700,41 @@ def record_video(duration: float, write_queue: queue.Queue, filename: str,
         # Record the next frame number
         frame_num += 1 
 
-        # If we have now captured one second worth of frames, send the frame buffer 
-        # to be written 
-        if(frame_num % CAM_FPS == 0):
-            #write_queue.put((frame_buffer, frame_num, settings_buffer, frame_timings_buffer))
-            write_queue.put((frame_buffer, frame_num, settings_buffer))
+        # If we have now captured one second worth of frames, hand the filled 
+        # slot off to be written 
+        if(frame_num % CAM_FPS == 0 and slot is not None):
+            write_queue.put((ring, slot, frame_num))
+
+    # Return a partially filled slot to the ring, as only full seconds are written
+    if(frame_num % CAM_FPS != 0 and slot is not None): ring.release(slot)
 
     # Record timing of end of capture 
     end_capture_time: float = time.time()
     
     # Signal the end of the write queue
-    write_queue.put(None) 
+    write_queue.close() 
     
     # Calculate the approximate FPS the frames were taken at 
     # (approximate due to time taken for other computation)
     observed_fps: float = (frame_num)/(end_capture_time-start_capture_time)
-    print(f'World Camera captured {frame_num} at ~{observed_fps} fps')
+    print(f'World Camera captured {frame_num} at ~{observed_fps} fps | Dropped slots: {ring.dropped_slots}')
     
     # Stop recording and close the picam object 
     cam.close() 
 
+"""Return the shape and type of the shared buffer a LEAN capture 
+   of duration seconds fills with downsampled frames"""
+def lean_buffer_spec(duration: int) -> tuple:
+    downsampled_image_shape: tuple = tuple(int(dim) for dim in CAM_IMG_DIMS >> downsample_factor)
+
+    return ((duration + 1) * CAM_FPS, *downsampled_image_shape), np.uint8
+
 """Perform the bulk of the work of a capture burst using the LEAN capture method"""
 def lean_capture_helper(cam: object, duration: int, current_gain: float, current_exposure: int,
                         gain_change_interval: float, frame_buffer: np.ndarray, 
                         downsampled_buffer: np.ndarray, settings_buffer: np.ndarray,
-                        write_queue: mp.Queue):
+                        write_queue: mp.Queue, slot: int, start_fields: dict,
+                        frame_means: FrameMeans, frame_times: np.ndarray, frame_metadata: np.ndarray):
     # Define indices to place frames/settings into the 
     # provided buffers
     frame_num: int = 0 
@@ -689,12 +757,18 @@ def lean_capture_helper(cam: object, duration: int, current_gain: float, current
         if(elapsed_time >= duration):
             break  
 
-        # Capture the frame and splice only the odd cols (even cols have junk content)
-        frame: np.array = cam.capture_array('raw')[:, 1::2]
+        # Capture the frame (and its sensor metadata) and splice only the odd cols (even cols have junk content)
+        frame, metadata = capture_frame(cam)
+        frame_times[frame_num] = time.monotonic_ns()
 
         # Save the frame into the buffer
         frame_buffer[frame_num] = frame
         settings_buffer[frame_num] = (current_gain, current_exposure)
+        frame_metadata[frame_num] = metadata
+
+        # Compute the means of the frame while it is still in cache, from its 
+        # contiguous copy, as that is much faster to reduce than the strided frame
+        frame_means.add(frame_num, frame_buffer[frame_num])
 
         # Change gain every N ms
         if((current_time - last_gain_change) > gain_change_interval):
@@ -726,12 +800,13 @@ def lean_capture_helper(cam: object, duration: int, current_gain: float, current
     observed_fps: float = (frame_num)/(end_time-start_time)
     print(f'World Camera captured {frame_num} at ~{observed_fps} fps')
 
-    # Downsample and append info to the write queue
-    for i in range(frame_num): # Iterate over each frame captured
-            # Downsample the frame and populate the downsampled buffer with this value
-            downsample(frame_buffer[i], downsample_factor, downsampled_buffer[i], downsample_lib) 
+    # Downsample all of the captured frames at once into the shared memory slot
+    downsample_numpy(frame_buffer[:frame_num], downsample_factor, downsampled_buffer[:frame_num])
 
-    write_queue.put(('W', downsampled_buffer[:frame_num], frame_num))
+    # Append only the description of the chunk (and its frames' means) to the write 
+    # queue, the main process reads the frames directly from shared memory
+    write_queue.put(('W', slot, frame_num, observed_fps, start_time, start_fields, frame_means.fields(frame_num),
+                     {'frame_times_ns': frame_times[:frame_num].copy(), 'frame_metadata': frame_metadata[:frame_num].copy()}))
 
     # Signal the end of the write queue for this chunk
     write_queue.put(('W', None)) 
@@ -739,7 +814,7 @@ def lean_capture_helper(cam: object, duration: int, current_gain: float, current
 
 """"""
 def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, duration: int, world_queue,
-                 initial_gain: float = 1, initial_exposure=100):
+                 shared_buffer_name: str, initial_gain: float = 1, initial_exposure=100):
 
     # Connect to and initialize the camera
     current_gain, current_exposure = initial_gain, initial_exposure
@@ -756,10 +831,17 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, duration: int,
     # capture above the desired FPS (say, 200.5 FPS)
     frame_buffer: np.array = np.empty(((duration + 1) * CAM_FPS , *CAM_IMG_DIMS), dtype=np.uint8)
     settings_buffer: np.array = np.empty(((duration + 1) * CAM_FPS, 2), dtype=np.float16)
+    frame_means: FrameMeans = FrameMeans((duration + 1) * CAM_FPS, bayer=True)
+    frame_times: np.array = np.empty((duration + 1) * CAM_FPS, dtype=np.int64)
+    frame_metadata: np.array = np.zeros((duration + 1) * CAM_FPS, dtype=FRAME_METADATA_DTYPE)
     
-    # Create a contiguous memory buffer for to store downsampled images
-    downsampled_image_shape: tuple = CAM_IMG_DIMS >> downsample_factor
-    downsampled_buffer = np.empty(((duration + 1) * CAM_FPS, *downsampled_image_shape), dtype=np.uint8)
+    # Attach to the shared memory double buffer the downsampled images are stored in. 
+    # We alternate between its two slots so the main process can still be reading 
+    # the last chunk while we capture the next
+    shared_buffer: shared_memory.SharedMemory = shared_memory.SharedMemory(name=shared_buffer_name)
+    downsampled_buffer_shape, downsampled_buffer_type = lean_buffer_spec(duration)
+    downsampled_buffers: np.ndarray = np.ndarray((2, *downsampled_buffer_shape), dtype=downsampled_buffer_type, buffer=shared_buffer.buf)
+    slot: int = 0
  
     # Define the time between AGC measurements
     gain_change_interval: float = 0.250 
@@ -771,8 +853,9 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, duration: int,
     while(STOP is False):
         print('World Cam | Awaiting GO')
         # Retrieve whether we should go or not from 
-        # the main process 
-        GO: bool = world_queue.get()
+        # the main process (forwarded by the Pupil cam). 
+        # A GO is the CLOCK_MONOTONIC time to start the chunk at
+        GO: bool | int = world_queue.get()
 
         # If GO received special flag, we end completely
         if(GO is False):
@@ -781,12 +864,20 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, duration: int,
             break    
 
         # Otherwise, we capture a burst of duration long 
-        while(GO is True):
+        while(GO is not False):
+            # Sleep until the start time shared by all of the sensors, 
+            # noting how late we actually started
+            start_offset_ns: int = sleep_until(GO)
+
             print(f'World Cam | Capturing chunk')
             # Capture a burst of frames
             lean_capture_helper(cam, duration, current_gain, current_exposure, gain_change_interval,
-                                frame_buffer, downsampled_buffer, settings_buffer, 
-                                write_queue)
+                                frame_buffer, downsampled_buffers[slot], settings_buffer, 
+                                write_queue, slot, {'start_time_ns': GO, 'start_offset_ns': start_offset_ns},
+                                frame_means, frame_times, frame_metadata)
+
+            # Swap to the other slot for the next chunk
+            slot ^= 1
 
             # Set GO back to False 
             GO = False
@@ -794,9 +885,11 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, duration: int,
     # Append to the main process queue and let it know we are really done 
     write_queue.put(('W', False))
 
-    # Close the camera
+    # Close the camera and detach from the shared buffer 
     print(f'World Cam | Closing')
     cam.close()
+    del downsampled_buffers
+    shared_buffer.close()
     
 """View a preview view of what the camera currently sees from the main stream"""
 def preview_capture():
@@ -1,5 +1,4 @@
 import numpy as np
-import queue
 import threading
 import time
 import serial
@@ -9,6 +8,7 @@ import sys
 import signal
 import traceback
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import setproctitle
 
 """Define the COM port to communicate with the device over, based on OS"""
@@ -23,57 +23,129 @@ MSG_LENGTH: int = 150
 """Define how long the data portion of the message is in bytes"""
 DATA_LENGTH: int = MSG_LENGTH - 2
 
-"""Write MS readings taken from the serial connection"""
-def write_SERIAL(write_queue: queue.Queue, reading_names: list, output_directory: str, generate_readingfiles: bool=True):
-    pass
-    """
-    # Open the reading file handles (if we are not using signals to communicate)
-    reading_file_handles: list = [open(os.path.join(output_directory, reading_name + '.csv'), 'a')
-                                  for reading_name in reading_names] if generate_readingfiles else []
+"""Import the control channel used to communicate with the master process"""
+firmware_lib_path = os.path.join(os.path.dirname(__file__), '..', 'raspberry_pi_firmware')
+sys.path.append(os.path.abspath(firmware_lib_path))
+from control_channel import ControlClient, control_socket_path, GO, sleep_until
+from cpu_plan import applied_plan_report
+
+"""Import the ring the capture thread hands items to its writer thread through"""
+from spsc_ring import SPSCRing
+
+"""An incremental parser of the MS' serial stream. Bytes are fed in in whatever 
+   blocks they were read, and the bodies of all of the whole <...> messages in 
+   them are returned. If a message is not closed by the ending delimeter, the 
+   stream is corrupt, so the message is counted as bad and we resynchronize on 
+   the next starting delimeter instead of giving up on the recording"""
+class MSFrameParser:
+    def __init__(self):
+        # The bytes received that have not yet been parsed into messages
+        self.stream: bytearray = bytearray()
+
+        # The number of corrupt messages we have skipped over
+        self.bad_frames: int = 0
+
+    """Parse a block of bytes that arrived at arrival_ns, returning a list of 
+       (message body, arrival_ns) for every whole message now received"""
+    def feed(self, data: bytes, arrival_ns: int) -> list:
+        # Append the new bytes to the unparsed stream
+        self.stream += data
+
+        # Find all of the whole messages in the stream 
+        frames: list = []
+        position: int = 0
+        while(True):
+            # Find the next starting delimeter. If there is none, the rest of the stream is noise
+            start: int = self.stream.find(b'<', position)
+            if(start == -1):
+                position = len(self.stream)
+                break
 
-    # Write while we are receiving information
-    while(True):
-        print(f'MS Queue size {write_queue.qsize()}')
+            # If the message has not fully arrived yet, wait for the next block 
+            if(len(self.stream) - start < MSG_LENGTH):
+                position = start
+                break
 
-        # Retrieve an item from the write queue
-        ret: tuple = write_queue.get()
-        # Break from writing if we have finished a recording
-        if(ret is None):
-            break
+            # If the message is not closed by the ending delimeter, it is corrupt 
+            # (or this was not really a starting delimeter), so search again after it
+            if(self.stream[start + MSG_LENGTH - 1] != ord('>')):
+                self.bad_frames += 1
+                position = start + 1
+                continue
+
+            # Otherwise, splice out the body of the message 
+            frames.append((bytes(self.stream[start + 1:start + MSG_LENGTH - 1]), arrival_ns))
+            position = start + MSG_LENGTH
 
-        # Otherwise, extract the information from the item
-        read_time, bluetooth_bytes = ret[:2]
+        # Discard the bytes we have parsed 
+        del self.stream[:position]
 
-        # If the length is greater than 2, we have passed the file handles to the write 
-        # queue (for signal communication)
-        if(len(ret) > 2):
-            # Extract the (potentially) new reading filehandles
-            new_reading_filehandles = ret[-1]
+        return frames
 
-            # See if we need to swap the current reading filehandles
-            if(len(reading_file_handles) == 0 or reading_file_handles[0].name != new_reading_filehandles[0].name):
-                # If we need to swap, first close all of the old filehandles 
-                for handle in reading_file_handles:
-                    handle.close()
-                
-                # Now swap 
-                reading_file_handles = new_reading_filehandles
+"""Read whatever bytes are waiting from the MS in a single block (blocking for 
+   at least one byte), timestamp their arrival and parse them into messages"""
+def read_frames(ms: serial.Serial, parser: MSFrameParser) -> list:
+    data: bytes = ms.read(max(ms.in_waiting, 1))
 
-        # Parse the the readings into np.arrays 
-        readings: tuple = parse_SERIAL(bluetooth_bytes)
+    return parser.feed(data, time.monotonic_ns())
 
-        # Iterate over the reading files and append this info to them
+"""Write MS readings taken from the serial connection. Every reading waiting in the write 
+   ring is taken at once, and the readings bound for the same files are parsed together and 
+   written with a single write per file"""
+def write_SERIAL(write_queue: SPSCRing, reading_names: list, output_directory: str, generate_readingfiles: bool=True):
+    # Import the parser of the readings here, as the MS utility library imports this one
+    from MS_util import parse_SERIAL
+
+    # Open the reading file handles (if we are not using signals to communicate)
+    reading_file_handles: list = [open(os.path.join(output_directory, reading_name + '.csv'), 'a')
+                                  for reading_name in reading_names] if generate_readingfiles else []
+
+    # Write the readings bound for the current file handles
+    def write_readings(read_times: list, reading_bytes: list) -> None:
+        if(len(read_times) == 0): return
+
+        # Parse all of the readings into np.arrays at once, then append them to their files
+        readings: tuple = parse_SERIAL(b''.join(reading_bytes))
         for reading_file, reading in zip(reading_file_handles, readings):
-            reading_file.write(reading_to_string(read_time, reading))
-    
+            reading_file.write(''.join(','.join([str(read_time)] + [str(x) for x in channels]) + '\n'
+                                       for read_time, channels in zip(read_times, reading.reshape(len(read_times), -1).tolist())))
+
+    # Write while we are receiving information. An empty batch means the recording has finished
+    for batch in iter(write_queue.get_batch, []):
+        read_times: list = []
+        reading_bytes: list = []
+        for ret in batch:
+            # Extract the information from the item
+            read_time, bluetooth_bytes = ret[:2]
+
+            # If the length is greater than 2, we have passed the file handles to the write 
+            # queue (for signal communication)
+            if(len(ret) > 2):
+                # Extract the (potentially) new reading filehandles
+                new_reading_filehandles = ret[-1]
+
+                # See if we need to swap the current reading filehandles
+                if(len(reading_file_handles) == 0 or reading_file_handles[0].name != new_reading_filehandles[0].name):
+                    # If we need to swap, first write the readings bound for the old ones and close them
+                    write_readings(read_times, reading_bytes)
+                    read_times, reading_bytes = [], []
+                    for handle in reading_file_handles:
+                        handle.close()
+                    
+                    # Now swap 
+                    reading_file_handles = new_reading_filehandles
+
+            read_times.append(read_time)
+            reading_bytes.append(bluetooth_bytes)
+
+        write_readings(read_times, reading_bytes)
     
     # Close all of the file handles (if not closed already)
     for file_handle in reading_file_handles:
         if(not file_handle.closed): file_handle.close()
-    """
 
 """Record from all of the MS sensors for an unspecified amount of time"""
-def record_live(duration: float, write_queue: queue.Queue,
+def record_live(duration: float, write_queue: SPSCRing,
                 stop_flag: threading.Event) -> None: 
 
     raise NotYetImplementedError
@@ -85,7 +157,7 @@ def record_live(duration: float, write_queue: queue.Queue,
    a video of a set length, for use when communicating 
    via signals"""
 def capture_helper(ms: serial.Serial, duration: float, 
-                  write_queue: queue.Queue,
+                  write_queue: SPSCRing,
                   msg_length: int,
                   reading_filehandles: list) -> None:
     # Once the go signal has been received, begin capturing
@@ -94,6 +166,9 @@ def capture_helper(ms: serial.Serial, duration: float,
     # Initialize the start time of recording
     start_time: float = time.time() 
 
+    # Initialize the parser of the serial stream
+    parser: MSFrameParser = MSFrameParser()
+
     # Record the measurements for the given duration
     while(True):    
         # Determine the current time 
@@ -103,29 +178,17 @@ def capture_helper(ms: serial.Serial, duration: float,
         if((current_time - start_time) >= duration):
             break
         
-        # Read a token from the MS 
-        token: bytes = ms.read(1)
-
-        #Check if the token is equal to the starting delimeter
-        if(token == b'<'):                 
-            # Read the buffer over the serial port (- 2 for the begin/end delimeters)
-            reading_buffer: bytes = ms.read(DATA_LENGTH)
-
-            # Assert we didn't overread the buffer by reading the next byte and ensuring
-            # it's the ending delimeter 
-            assert(ms.read(1) == b'>')
-            #AS, TS, LI, temp = parse_SERIAL(reading_buffer)
-
-            # Append it to the write queue
-            write_queue.put(['NA',  reading_buffer, reading_filehandles])
+        # Read a block of bytes from the MS and append every whole 
+        # reading in it to the write ring at once with its arrival time
+        write_queue.put_batch([(arrival_ns, reading_buffer, reading_filehandles) 
+                               for reading_buffer, arrival_ns in read_frames(ms, parser)])
 
-            # Flush the reading buffer 
-            reading_buffer = None
+    print(f'MS: Skipped {parser.bad_frames} corrupt readings')
 
 
 """Record from all of the MS sensors for a set length of time
    communicating with a parent process via signals"""
-def record_video_signalcom(duration: float, write_queue: queue.Queue,
+def record_video_signalcom(duration: float, write_queue: SPSCRing,
                            filename: str, reading_names: list,
                            stop_flag: threading.Event,
                            is_subprocess: bool, 
@@ -136,14 +199,6 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
     # Retrieve the name of the controller this recorder is operating out of
     controller_name: str = setproctitle.getproctitle()
     
-    # Define the path to the controller READY files
-    READY_file_dir: str = "/home/rpiControl/combiExperiments/code/lightLogger/raspberry_pi_firmware/READY_files"
-    GO_file_dir: str = "/home/rpiControl/combiExperiments/code/lightLogger/raspberry_pi_firmware/GO_files"
-    STOP_file_dir: str = "/home/rpiControl/combiExperiments/code/lightLogger/raspberry_pi_firmware/STOP_files"
-
-    # Define the name of this controller's READY file 
-    READY_file_name: str = os.path.join(READY_file_dir, f"{controller_name}|READY")
-
     # Initialize a serial connection to the Minispect 
     # and how many bytes it will be transfering
     try:
@@ -157,39 +212,26 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
         sys.exit(1)
 
 
-    # If we were run as a subprocess, send a message to the parent 
-    # process that we are ready to go
+    # Define the starting burst number
+    # and the thus the initial filename
+    # settings file, and generate them before we report READY
+    filename : str = filename.replace('burstX', f"burst{burst_num}") 
+    if(not os.path.exists(filename)): os.mkdir(filename)
+    reading_filehandles: list = [open(os.path.join(filename, reading_name + '.csv'), 'a')
+                                  for reading_name in reading_names]
+
+    # Connect to the parent process' control channel and report that we are 
+    # ready to go, then block (without spinning) until it tells us to GO 
     try:
-        if(is_subprocess): 
-            print('MS: Initialized. Sending ready signal...')
-            
-            # Add a READY file for this controller
-            with open(READY_file_name, 'w') as f: pass
-
-            #os.kill(parent_pid, signal.SIGUSR1)
-
-            # While we have not receieved the GO signal wait 
-            start_wait: float = time.time()
-            last_read: float = time.time()
-            while(not go_flag.is_set()):
-                # Set the GO flag if we have received a GO signal
-                if(len(os.listdir(GO_file_dir)) > 0): go_flag.set()
-                
-                # Capture the current time
-                current_wait: float = time.time()
-
-                # If the parent process is no longer existent, something has gone wrong
-                # and we should quit 
-                if(not psutil.pid_exists(parent_pid)):
-                    raise Exception('ERROR: Parent process was killed')
-
-                # Every 2 seconds, output a message
-                if((current_wait - last_read) >= 2):
-                    print('MS: Waiting for GO signal...')
-                    last_read = current_wait
+        print('MS: Initialized. Sending ready signal...')
+        control: ControlClient = ControlClient(control_socket_path(parent_pid), controller_name)
+        control.send_ready(burst_num, pid=os.getpid(), cpu_plan=applied_plan_report())
+
+        # Wait for the first command. This raises an error if the parent process has died 
+        command: dict = control.wait_for_command()
     
     # Catch if there was an error in some part of the pipeline and we did not receive 
-    # a go signal in the appropriate amount of time
+    # a go signal 
     except Exception as e:
         # Close the serial connection to the MS
         ms.close()
@@ -199,69 +241,51 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
         print(e)
         sys.exit(1)
 
+    # Now, the MS was initialized and the first ready was sent and the first command was received
+    # Therefore, capture bursts for as long as the parent tells us to GO
+    while(command['type'] == GO and not stop_flag.is_set()):     
+        # Arm and sleep until the start time the parent scheduled for every controller, 
+        # noting how late we actually started 
+        start_offset_ns: int = control.wait_for_start(command)
 
-    # Now, the MS was initialized and the first ready was sent and the first go was received
-    # Therefore, let's record the amount of time we desire
-    
-    # Define the starting burst number
-    # and the thus the initial filename
-    # settings file
-    filename : str = filename.replace('burstX', f"burst{burst_num}") 
-    if(not os.path.exists(filename)): os.mkdir(filename)
-    reading_filehandles: list = [open(os.path.join(filename, reading_name + '.csv'), 'a')
-                                  for reading_name in reading_names]
+        # Record a burst
+        go_flag.set()
+        capture_helper(ms, duration, write_queue, 
+                       MSG_LENGTH, reading_filehandles)
+        go_flag.clear()
 
-    # Once the GO signal has been received, begin capturing chunks until we 
-    # receive a stop signal
-    while(True):     
-        # Use the milliseconds of time gaps between GO signals to generate files and hopefully not add 
-        # any delay in the start of a burst capture
-        # Akin to racing the beam on ATARI 2600, pretty cool!
-
-        # STOP if we have received a STOP signal
-        if(len(os.listdir(STOP_file_dir)) > 0): break 
+        # Increment the burst number += 1 
+        burst_num += 1
 
-        # Set the GO flag if we have received a GO signal
-        if(len(os.listdir(GO_file_dir)) > 0): go_flag.set() 
+        # Update the filename for the new burst number
+        filename = filename.replace(f'burst{burst_num-1}', f"burst{burst_num}")
 
+        # Use the time between bursts to generate the files for the next burst and hopefully 
+        # not add any delay in the start of a burst capture
+        # Akin to racing the beam on ATARI 2600, pretty cool!
         if(not os.path.exists(filename)): os.mkdir(filename) 
-
-        if(reading_filehandles[0].name != os.path.join(filename, reading_names[0])): 
+        if(reading_filehandles[0].name != os.path.join(filename, reading_names[0] + '.csv')): 
             reading_filehandles = [open(os.path.join(filename, reading_name + '.csv'), 'a')
                                   for reading_name in reading_names]
 
-        # While we have the GO signal, record a burst
-        while(go_flag.is_set()):
-            # Capture duration worth of frames
-            capture_helper(ms, duration, write_queue, 
-                          MSG_LENGTH, reading_filehandles)
-
-            # Stop recording until we receive the GO signal again 
-            go_flag.clear()
-            # Try except here because multiple controllers could be trying to remove this file at once 
-            # so it could be deleted by the time another goes to delete it
-            try:
-                for file in os.listdir(GO_file_dir): os.remove(os.path.join(GO_file_dir, file))
-            except:
-                pass
-
-            # Report to the parent process we are ready to go for the next burst 
-            assert(not os.path.exists(READY_file_name))
-            with open(READY_file_name, 'w') as f: pass
-            print(f'MS: Finished burst: {burst_num+1} | Generating READY signal for parent: {parent_pid}!')
-        
-            # Increment the burst number += 1 
-            burst_num += 1
-
-            # Update the filename for the new burst number
-            filename = filename.replace(f'burst{burst_num-1}', f"burst{burst_num}")
+        # Report to the parent process we are ready to go for the next burst, 
+        # along with when we started the last one 
+        control.send_ready(burst_num, start_time_ns=command['start_time_ns'], start_offset_ns=start_offset_ns)
+        print(f'MS: Finished burst: {burst_num} | Sending READY signal for parent: {parent_pid}!')
 
+        # Block until the next GO or STOP. If the parent has died, stop
+        try:
+            command = control.wait_for_command()
+        except ConnectionError:
+            print('MS: Parent closed the control channel')
+            break
         
     # Signal the end of the write queue
-    write_queue.put(None)
+    write_queue.close()
     
-    # Close the serial connection
+    # Close the serial connection and the control channel
     ms.close()
+    control.close()
 
     # Iterate over the filehandles and remove unncessary files (files we created but didn't populate)
     for handle in reading_filehandles:
@@ -274,13 +298,10 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
     # Now check to see if the directory for the files is empty 
     if(os.path.exists(filename) and len(os.listdir(filename)) == 0): os.rmdir(filename)
 
-    # Remove any left over READY file if it is empty 
-    if(os.path.exists(READY_file_name)): os.remove(READY_file_name)
-
     return 
 
 """Record from all of the MS sensors for a set length of time"""
-def record_video(duration: float, write_queue: queue.Queue,
+def record_video(duration: float, write_queue: SPSCRing,
                  filename: str, reading_names: list,
                  stop_flag: threading.Event,
                  is_subprocess: bool, 
@@ -340,6 +361,9 @@ def record_video(duration: float, write_queue: queue.Queue,
         # Initialize the start time of recording
         start_time: float = time.time() 
 
+        # Initialize the parser of the serial stream
+        parser: MSFrameParser = MSFrameParser()
+
         # Record the measurements for the given duration
         while(True):    
             # Determine the current time 
@@ -349,51 +373,41 @@ def record_video(duration: float, write_queue: queue.Queue,
             if((current_time - start_time) >= duration):
                 break
             
-            # Read a token from the MS 
-            token: bytes = ms.read(1)
-
-            #Check if the token is equal to the starting delimeter
-            if(token == b'<'):     
-                #print(f'Received MS TRANSMISSION @{time.time()}')      
-                
-                # Read the buffer over the serial port (- 2 for the begin/end delimeters)
-                reading_buffer: bytes = ms.read(MSG_LENGTH - 2)
-
-                # Assert we didn't overread the buffer by reading the next byte and ensuring
-                # it's the ending delimeter 
-                assert(ms.read(1) == b'>')
-
-                #print(f"Size of reading buffer: {len(reading_buffer)}")
-                #AS, TS, LI, temp = parse_SERIAL(reading_buffer)
-
-                #print(f'AS CHANNELS: {AS}')
-                #print(f'TS CHANNELS: {TS}')
-                #print(f'LI CHANNELS: {LI}')
-                #print(f'TEMP: {temp}')
+            # Read a block of bytes from the MS and append every whole 
+            # reading in it to the write ring at once with its arrival time
+            write_queue.put_batch([(arrival_ns, reading_buffer) 
+                                   for reading_buffer, arrival_ns in read_frames(ms, parser)])
 
-                # Append it to the write queue
-                write_queue.put(['NA',  reading_buffer])
-
-                # Flush the reading buffer 
-                reading_buffer = None
+        print(f'MS: Skipped {parser.bad_frames} corrupt readings')
         
         # Signal the end of the write queue
-        write_queue.put(None)
+        write_queue.close()
         
         # Close the serial connection
         ms.close()
 
         return 
 
+"""Return the shape and type of the shared buffer a LEAN capture 
+   of duration seconds fills with raw reading bytes"""
+def lean_buffer_spec(duration: int) -> tuple:
+    return ((duration + 1) * DATA_LENGTH,), np.uint8
+
 """Perform the bulk of the work of a capture burst using the LEAN capture method"""
 def lean_capture_helper(ms: serial.Serial, duration: int, reading_buffer: np.ndarray, 
-                        write_queue: mp.Queue):
+                        write_queue: mp.Queue, slot: int, start_fields: dict):
 
     # Capture the start time of recording 
     start_time: float = time.time()
 
+    # Initialize the parser of the serial stream and a container 
+    # for the arrival time of each reading
+    parser: MSFrameParser = MSFrameParser()
+    arrival_times: list = []
+
     # Capture duration worth of frames 
     frame_num: int = 0 
+    max_frames: int = reading_buffer.shape[0] // DATA_LENGTH
     while(True):
         # Retrieve the current time
         current_time: float = time.time()
@@ -405,20 +419,14 @@ def lean_capture_helper(ms: serial.Serial, duration: int, reading_buffer: np.nda
         if(elapsed_time >= duration):
             break  
 
-        # Read a token from the MS 
-        token: bytes = ms.read(1)
-
-        #Check if the token is equal to the starting delimeter
-        if(token == b'<'):    
-            # Read the buffer over the serial port (- 2 for the begin/end delimeters)
-            reading_bytes: bytes = ms.read(DATA_LENGTH)
+        # Read a block of bytes from the MS and parse the whole readings in it 
+        for reading_bytes, arrival_ns in read_frames(ms, parser):
+            # Drop readings that would overflow the buffer
+            if(frame_num >= max_frames): break
 
-            # Assert we didn't overread the buffer by reading the next byte and ensuring
-            # it's the ending delimeter 
-            assert(ms.read(1) == b'>')
-
-            # Append these bytes to the bytearray for this recording
-            reading_buffer[frame_num*DATA_LENGTH:frame_num*DATA_LENGTH + DATA_LENGTH] = reading_bytes
+            # Append these bytes to the buffer for this recording
+            reading_buffer[frame_num*DATA_LENGTH:frame_num*DATA_LENGTH + DATA_LENGTH] = np.frombuffer(reading_bytes, dtype=np.uint8)
+            arrival_times.append(arrival_ns)
             
             # Append the frame number
             frame_num += 1 
@@ -429,28 +437,38 @@ def lean_capture_helper(ms: serial.Serial, duration: int, reading_buffer: np.nda
     # Calculate the approximate FPS the frames were taken at 
     # (approximate due to time taken for other computation)
     observed_fps: float = (frame_num)/(end_time-start_time)
-    print(f'MS captured {frame_num} at ~{observed_fps} fps')
+    print(f'MS captured {frame_num} at ~{observed_fps} fps | Skipped {parser.bad_frames} corrupt readings')
     
-    # Send this info to the write queue 
-    write_queue.put(('M', reading_buffer, frame_num, observed_fps))
+    # Send only the description of the chunk to the write queue, the 
+    # main process reads the bytes directly from shared memory. The 
+    # arrival times are small enough to send along with it
+    write_queue.put(('M', slot, frame_num, observed_fps, start_time, 
+                     {'arrival_ns': np.array(arrival_times, dtype=np.int64), 'bad_frames': parser.bad_frames},
+                     start_fields))
 
     # Signal the end of the write queue
     write_queue.put(('M', None)) 
 
-def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, duration: int, world_queue):
+def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, duration: int, world_queue, 
+                 shared_buffer_name: str):
     # Connect to and initialize the MS
     ms = initialize_ms()
 
-    # Pre-allocate a bytearray in memory for this reading with a little extra in case 
-    # we start going over (like, say, we capture at 1.05 FPS)
-    reading_buffer: bytearray = bytearray((duration + 1) * DATA_LENGTH)
+    # Attach to the shared memory double buffer for the readings, which has a little extra 
+    # in case we start going over (like, say, we capture at 1.05 FPS). We alternate between 
+    # its two slots so the main process can still be reading the last chunk while we capture the next
+    shared_buffer: shared_memory.SharedMemory = shared_memory.SharedMemory(name=shared_buffer_name)
+    reading_buffer_shape, reading_buffer_type = lean_buffer_spec(duration)
+    reading_buffers: np.ndarray = np.ndarray((2, *reading_buffer_shape), dtype=reading_buffer_type, buffer=shared_buffer.buf)
+    slot: int = 0
 
     print('MS | Initialized')
     STOP: bool = False
     while(STOP is False):
         print('MS | Awaiting GO')
         # Retrieve whether we should go or not from 
-        # the main process 
+        # the main process. A GO is the CLOCK_MONOTONIC 
+        # time to start the chunk at
         GO: bool | int = receive_queue.get()
 
         # If GO received special flag, we end completely
@@ -460,11 +478,19 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, duration: int,
             break    
 
         # Otherwise, we capture a burst of duration long 
-        while(GO is True):
+        while(GO is not False):
+            # Sleep until the start time shared by all of the sensors, 
+            # noting how late we actually started
+            start_offset_ns: int = sleep_until(GO)
+
             print('MS | Capturing chunk')
 
             # Capture a burst of frames
-            lean_capture_helper(ms, duration, reading_buffer, write_queue)
+            lean_capture_helper(ms, duration, reading_buffers[slot], write_queue, slot,
+                                {'start_time_ns': GO, 'start_offset_ns': start_offset_ns})
+
+            # Swap to the other slot for the next chunk
+            slot ^= 1
 
             # Set GO back to False 
             GO = False
@@ -472,9 +498,11 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, duration: int,
     # Append to the main process queue and let it know we are really done 
     write_queue.put(('M', False))
 
-    # Close the camera
+    # Close the camera and detach from the shared buffer
     print(f'MS | Closing')
     ms.close()
+    del reading_buffers
+    shared_buffer.close()
 
 """Initialize a connection with the minispect over the serial port
    and return the MS serial object"""
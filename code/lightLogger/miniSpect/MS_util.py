@@ -19,7 +19,7 @@ import collections
 
 # Import the recorder library to find out things like the COM port, baudrate, and MSG length 
 sys.path.append(os.path.dirname(__file__))
-from MS_recorder import COM_PORT, BAUDRATE, MSG_LENGTH, DATA_LENGTH
+from MS_recorder import COM_PORT, BAUDRATE, DATA_LENGTH, MSFrameParser, read_frames
 
 """Parse the MS readings and return them as a tuple of pd.DataFrames"""
 def parse_readings(readings: bytes | bytearray | np.ndarray) -> tuple:
@@ -261,63 +261,36 @@ def write_SERIAL(write_queue: queue.Queue, reading_names: list, output_directory
         # Parse the the readings into np.arrays 
         readings: tuple = parse_SERIAL(bluetooth_bytes)
 
-        # Iterate over the reading files and append this info to them
+        # Iterate over the reading files and append this info to them. Each item 
+        # is a single reading, so write the one row of each sensor's channels
         for reading_file, reading in zip(reading_file_handles, readings):
-            reading_file.write(reading_to_string(read_time, reading))
+            reading_file.write(reading_to_string(read_time, reading.reshape(-1)))
     
     # Close all of the file handles 
     for file_handle in reading_file_handles:
         file_handle.close()
 
+"""Define the layout of a single MS reading as a structured type, so that a buffer of 
+   many readings can be interpreted all at once. Each field holds one sensor's channels"""
+MS_READING_DTYPE: np.dtype = np.dtype([('AS', '<u2', (10,)),      # bytes 0:20
+                                       ('TS', '<u2', (2,)),       # bytes 20:24
+                                       ('LS', '<i2', (60,)),      # bytes 24:144
+                                       ('LS_temp', '<f4', (1,))]) # bytes 144:148
+assert(MS_READING_DTYPE.itemsize == DATA_LENGTH)
+
 """Parse a MS reading from the serial connection (or broadly), e.g., no async operations necessary"""
-def parse_SERIAL(serial_bytes: np.ndarray) -> tuple:
-    # Define containers for all of the channels across the many readings
-    # They are lists now but will be converted to numpy array later, because I don't
-    # know exactly how many channels by a given sensor, and this may change in the future
-    AS_channels: list = []
-    TS_channels: list = [] 
-    LS_channels: list = [] 
-    LS_temp: list = []
-
-    # Define the start and end of each sensors' bytes
-    # for the first reading 
-    AS_start, AS_end = 0, 20
-    TS_start, TS_end = 20, 24
-    LS_start, LS_end = 24, 144
-    LS_temp_start, LS_temp_end = 144, 148 
-
-    # Define these start/ends as vectors for easy vector math
-    AS_bytes_info: np.ndarray = np.array([AS_start, AS_end]) # np.uint16 
-    TS_bytes_info: np.ndarray = np.array((TS_start, TS_end))  # np.uint16
-    LS_bytes_info: np.ndarray = np.array([LS_start, LS_end]) # np.int16
-    LS_temp_bytes_info: np.ndarray = np.array([LS_temp_start, LS_temp_end]) # np.float32
-
-    # Iterate over how many readings we have 
-    for reading_num, _ in enumerate(range(0, len(serial_bytes), DATA_LENGTH)):
-        #print(f'Reading num: {reading_num}/{len(serial_bytes)/DATA_LENGTH}')
-
-        AS_start, AS_end = AS_bytes_info + (reading_num * DATA_LENGTH)
-        TS_start, TS_end = TS_bytes_info + (reading_num * DATA_LENGTH)
-        LS_start, LS_end = LS_bytes_info + (reading_num * DATA_LENGTH)
-        LS_temp_start, LS_temp_end = LS_temp_bytes_info + (reading_num * DATA_LENGTH)
-            
-        # Read in the bytes as np.ndarrays and interpret them
-        this_reading_AS_channels: np.ndarray = np.frombuffer(serial_bytes[AS_start:AS_end], dtype=np.uint16)
-        this_reading_TS_channels: np.ndarray = np.frombuffer(serial_bytes[TS_start:TS_end], dtype=np.uint16)
-        this_reading_LS_channels: np.ndarray = np.frombuffer(serial_bytes[LS_start:LS_end], dtype=np.int16)
-        this_reading_LS_temp: np.ndarray = np.frombuffer(serial_bytes[LS_temp_start:LS_temp_end], dtype=np.float32)
-
-        # Append them to the growing list
-        AS_channels.append(this_reading_AS_channels)
-        TS_channels.append(this_reading_TS_channels)
-        LS_channels.append(this_reading_LS_channels)
-        LS_temp.append(this_reading_LS_temp)
-
-    # Convert all of the reading containers to a numpy array
-    AS_channels: np.ndarray = np.array(AS_channels, dtype=np.uint16)
-    TS_channels: np.ndarray = np.array(TS_channels, dtype=np.uint16)
-    LS_channels: np.ndarray = np.array(LS_channels, dtype=np.int16)
-    LS_temp: np.ndarray = np.array(LS_temp, dtype=np.float32)
+def parse_SERIAL(serial_bytes: bytes | bytearray | np.ndarray) -> tuple:
+    # Interpret the whole buffer as an array of readings at once. 
+    # Only whole readings are parsed
+    num_readings: int = len(serial_bytes) // DATA_LENGTH
+    readings: np.ndarray = np.frombuffer(serial_bytes, dtype=MS_READING_DTYPE, count=num_readings)
+
+    # Each sensor's channels are simply a view of its field across the readings, 
+    # with no copies made
+    AS_channels: np.ndarray = readings['AS']
+    TS_channels: np.ndarray = readings['TS']
+    LS_channels: np.ndarray = readings['LS']
+    LS_temp: np.ndarray = readings['LS_temp']
 
     return AS_channels, TS_channels, LS_channels, LS_temp 
 
@@ -327,34 +300,16 @@ def read_SERIAL(write_queue: queue.Queue, stop_flag: threading.Event):
     print('Connecting to ms...')
     ms: serial.Serial = serial.Serial(COM_PORT, BAUDRATE, timeout=1)
 
-    # Read until we hit the start delimeter of the MS message 
-    while(not stop_flag.is_set()):
-        token: bytes = ms.read(1)
-
-        #Check if the token is equal to the starting delimeter
-        if(token == b'<'):     
-            #print(f'Received MS TRANSMISSION @{time.time()}')      
-            
-            # Read the buffer over the serial port (- 2 for the begin/end delimeters)
-            reading_buffer: bytes = ms.read(MSG_LENGTH - 2)
-
-            # Assert we didn't overread the buffer by reading the next byte and ensuring
-            # it's the ending delimeter 
-            assert(ms.read(1) == b'>')
+    # Initialize the parser of the serial stream
+    parser: MSFrameParser = MSFrameParser()
 
-            #print(f"Size of reading buffer: {len(reading_buffer)}")
-            #AS, TS, LI, temp = parse_SERIAL(reading_buffer)
-
-            #print(f'AS CHANNELS: {AS}')
-            #print(f'TS CHANNELS: {TS}')
-            #print(f'LI CHANNELS: {LI}')
-            #print(f'TEMP: {temp}')
-
-            # Append it to the write queue
-            #write_queue.put(['NA',  reading_buffer])
+    # Read blocks of bytes from the MS and parse the whole messages in them
+    while(not stop_flag.is_set()):
+        for reading_buffer, arrival_ns in read_frames(ms, parser):
+            # Append it to the write queue, with the time it arrived
+            write_queue.put([arrival_ns, reading_buffer])
 
-            # Flush the reading buffer 
-            reading_buffer = None
+    print(f'MS: Skipped {parser.bad_frames} corrupt readings')
     
     # Signal the end of the write queue
     write_queue.put(None)
@@ -4,7 +4,6 @@ import cv2
 import numpy as np
 import psutil
 import pickle
-import queue
 import threading
 import pandas as pd
 from natsort import natsorted
@@ -15,6 +14,7 @@ import setproctitle
 import sys
 import uvc
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import gc
 
 # The FPS we have locked the camera to
@@ -23,38 +23,43 @@ CAM_FPS: int = 120
 # The origial dimensions of the camera before downsampling 
 CAM_IMG_DIMS: np.ndarray = np.array((400, 400), dtype=np.uint16)
 
-"""Unpack chunks of n captured frames. This is used 
-   to reformat the memory-limitation required capture 
-   buffer format into the single frame files the codebase 
-   is built on at the end of a capture."""
-def unpack_capture_chunks(path_to_frames: str):
-    # Declare an accumulator variable to hold the real frame number 
-    # of each frame when we resave it 
-    frame_num: int = 0
+"""Import the control channel used to communicate with the master process"""
+firmware_lib_path = os.path.join(os.path.dirname(__file__), '..', 'raspberry_pi_firmware')
+sys.path.append(os.path.abspath(firmware_lib_path))
+from control_channel import ControlClient, control_socket_path, GO, sleep_until
+from cpu_plan import applied_plan_report
 
-    # First retrieve the frame buffer files
-    frame_buffer_files: list = natsorted(os.listdir(path_to_frames))
+"""Import the ring the capture thread hands items to its writer thread through"""
+from spsc_ring import SPSCRing
 
-    # Iterate over the frame buffer files
-    for i, frame_buffer_file in enumerate(frame_buffer_files):
-        print(f'Pupil unpacking buffer: {i+1}/{len(frame_buffer_files)}')
+"""Import the per-frame means computed at capture time"""
+camera_lib_path = os.path.join(os.path.dirname(__file__), '..', 'camera')
+sys.path.append(os.path.abspath(camera_lib_path))
+from frame_stats import FrameMeans, write_frame_means
 
-        # Load in this buffer 
-        frame_buffer: np.ndarray = np.load(os.path.join(path_to_frames, frame_buffer_file))
+"""Import the frame store the captured buffers are packed into"""
+from frame_store import pack_buffer_files, is_frame_store, open_frame_store
 
-        # Assert we are unpacking a buffer and not a frame
+"""Unpack chunks of n captured frames. This is used 
+   to reformat the memory-limitation required capture 
+   buffer format into a single indexed frame store (see frame_store) 
+   at the end of a capture, so any frame can be read without 
+   loading its buffer, and the buffer files are removed"""
+def unpack_capture_chunks(path_to_frames: str):
+    # First retrieve the frame buffer files in the order they were captured
+    frame_buffer_files: list = [os.path.join(path_to_frames, frame_buffer_file) 
+                                for frame_buffer_file in natsorted(os.listdir(path_to_frames))
+                                if frame_buffer_file.endswith('.npy')]
+
+    # Assert we are unpacking buffers and not frames (only reads their headers)
+    for frame_buffer_file in frame_buffer_files:
+        frame_buffer: np.ndarray = np.load(frame_buffer_file, mmap_mode='r')
         assert(len(frame_buffer.shape) == 3 and frame_buffer.shape[0] == CAM_FPS) 
+        del frame_buffer
 
-        # Iterate over the frames in the buffer 
-        for frame_idx in range(frame_buffer.shape[0]):
-            # Construct the new path to save this file (all buffer files will be overwritten by these)
-            save_path: str = os.path.join(path_to_frames, f'{frame_num}.npy')
-
-            # Save the frame
-            np.save(save_path, frame_buffer[frame_idx])
-
-            # Increment the frame number
-            frame_num += 1 
+    # Append the buffers to the frame store, one after another
+    print(f'Pupil packing {len(frame_buffer_files)} buffers into a frame store')
+    pack_buffer_files(path_to_frames, frame_buffer_files)
 
 
 """Parse the setting file for a video as a data frame"""
@@ -63,6 +68,9 @@ def parse_settings_file(path: str) -> pd.DataFrame:
 
 """Read in a video from a file to an 8-bit unsigned np.array"""
 def vid_array_from_npy_folder(path: str) -> np.array:
+    # Memory map the frames if they have been packed into a frame store
+    if(is_frame_store(path)): return open_frame_store(path)
+
     frames = [np.load(os.path.join(path, frame)) 
               for frame in natsorted(os.listdir(path)) 
               if '.pkl' not in frame and '.txt' not in frame] 
@@ -90,7 +98,7 @@ def reconstruct_video(video_frames: np.array, output_path: str):
 
 """Write a frame and its info in the write queue to disk 
 in the output_path directory and to the settings file"""
-def write_frame(write_queue: queue.Queue, filename: str, generate_settingsfile: bool=True):
+def write_frame(write_queue: SPSCRing, filename: str, generate_settingsfile: bool=True):
     # Ensure the output directory exists (if we are not running via signalcommunication)
     if(not os.path.exists(filename) and generate_settingsfile):
         os.makedirs(filename)
@@ -118,9 +126,6 @@ def write_frame(write_queue: queue.Queue, filename: str, generate_settingsfile:
         # must have been timing related
         if(not os.path.exists(filename)): os.mkdir(filename)
 
-        #print(f'writing {frame_num}')
-        print(f"Pupil Queue size: {write_queue.qsize()}")
-
         # Write the frame
         save_path: str = os.path.join(filename, f'{frame_num}.npy')
 
@@ -128,7 +133,7 @@ def write_frame(write_queue: queue.Queue, filename: str, generate_settingsfile:
 
 
 """Record live from the camera with no specified duration"""
-def record_live(duration: float, write_queue: queue.Queue, 
+def record_live(duration: float, write_queue: SPSCRing, 
                 filename: str, stop_flag: threading.Event,
                 is_subprocess: bool, parent_pid: int,
                 go_flag: threading.Event):
@@ -167,7 +172,7 @@ def record_live(duration: float, write_queue: queue.Queue,
             write_queue.put((frame_buffer, frame_num))
 
     # Signal the end of the write queue
-    write_queue.put(None)
+    write_queue.close()
 
     # Close the camera
     cam.close()
@@ -175,10 +180,10 @@ def record_live(duration: float, write_queue: queue.Queue,
 """A helper function that contains the meat of capturing 
    a video of a set length, for use when communicating 
    via signals"""
-def capture_helper(cam: object, duration: float, write_queue: queue.Queue,
+def capture_helper(cam: object, duration: float, write_queue: SPSCRing,
                   frame_buffer: np.ndarray,
                   filename: str, settings_file: object, 
-                  burst_num: int):
+                  burst_num: int, frame_means: FrameMeans=None):
     print('Pupil Cam: Beginning capture')
 
     # Begin timing capture
@@ -200,6 +205,10 @@ def capture_helper(cam: object, duration: float, write_queue: queue.Queue,
         # Store the grayscale frame + settings into the allocated memory buffers
         frame_buffer[frame_num % CAM_FPS] = frame_obj.gray
 
+        # Compute the mean of the frame while it is still in cache
+        if(frame_means is not None and frame_num < frame_means.frame_means.shape[0]): 
+            frame_means.add(frame_num, frame_buffer[frame_num % CAM_FPS])
+
         # Record the next frame number
         frame_num += 1 
 
@@ -216,9 +225,13 @@ def capture_helper(cam: object, duration: float, write_queue: queue.Queue,
     observed_fps: float = (frame_num)/(end_capture_time-start_capture_time)
     print(f'Pupil cam: captured {frame_num} at ~{observed_fps} fps')
 
+    # Write the means of this burst's frames as a side-car next to it 
+    if(frame_means is not None): 
+        write_frame_means(f'{filename}_frameMeans.npz', frame_means, min(frame_num, frame_means.frame_means.shape[0]))
+
 """Record a video from the Pupil camera of a set duration
    via signal communication with a master process (only inits cams once)"""
-def record_video_signalcom(duration: float, write_queue: queue.Queue, 
+def record_video_signalcom(duration: float, write_queue: SPSCRing, 
                            filename: str, stop_flag: threading.Event,
                            is_subprocess: bool, parent_pid: int,
                            go_flag: threading.Event,
@@ -229,14 +242,6 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
     # Retrieve the name of the controller this recorder is operating out of
     controller_name: str = setproctitle.getproctitle()
     
-    # Define the path to the controller READY files
-    READY_file_dir: str = "/home/rpiControl/combiExperiments/code/lightLogger/raspberry_pi_firmware/READY_files"
-    GO_file_dir: str = "/home/rpiControl/combiExperiments/code/lightLogger/raspberry_pi_firmware/GO_files"
-    STOP_file_dir: str = "/home/rpiControl/combiExperiments/code/lightLogger/raspberry_pi_firmware/STOP_files"
-
-    # Define the name of this controller's READY file 
-    READY_file_name: str = os.path.join(READY_file_dir, f"{controller_name}|READY")
-
     # Connect to and set up camera
     try:
         print(f"Initializing pupil camera")
@@ -255,32 +260,26 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
     # worth of video
     frame_buffer: np.array = np.zeros((CAM_FPS, 400, 400), dtype=np.uint8)
 
-    # If we were run as a subprocess, send a message to the parent 
-    # process that we are ready to go
+    # Initialize the per-frame means of a burst, with an extra second 
+    # worth of frames in case we capture above the desired FPS
+    frame_means: FrameMeans = FrameMeans(int(np.ceil(duration) + 1) * CAM_FPS)
+
+    # Define the starting burst number
+    # and the thus the initial filename
+    # and settings file, and generate them before we report READY
+    filename : str = filename.replace('burstX', f"burst{burst_num}") 
+    if(not os.path.exists(filename)): os.mkdir(filename)
+    settings_file: object = None # None because we are currently not tracking any settings
+
+    # Connect to the parent process' control channel and report that we are 
+    # ready to go, then block (without spinning) until it tells us to GO 
     try:
         print(f'Pupil Cam: Initialized. Sending ready signal to parent: {parent_pid}')
-        
-        # Add a READY file for this controller
-        with open(READY_file_name, 'w') as f: pass
-
-        # While we have not receieved the GO signal, wait 
-        start_wait: float = time.time()
-        last_read: float = time.time()
-        while(not go_flag.is_set()):
-            # Set the GO flag if we have received a GO signal
-            if(len(os.listdir(GO_file_dir)) > 0): go_flag.set()
-
-            # Capture the current time
-            current_wait: float = time.time()
-
-            # If the parent process is no longer existent, something has gone wrong
-            # and we should quit 
-            if(not psutil.pid_exists(parent_pid)):
-                raise Exception('ERROR: Parent process was killed')
-            
-            if((current_wait - last_read) >= 2):
-                print('Pupil Cam: Waiting for GO signal...')
-                last_read = current_wait
+        control: ControlClient = ControlClient(control_socket_path(parent_pid), controller_name)
+        control.send_ready(burst_num, pid=os.getpid(), cpu_plan=applied_plan_report())
+
+        # Wait for the first command. This raises an error if the parent process has died 
+        command: dict = control.wait_for_command()
     
     # Catch if there was an error in some part of the pipeline and we did not receive 
     # a GO signal (parent process was killed)
@@ -293,76 +292,60 @@ def record_video_signalcom(duration: float, write_queue: queue.Queue,
         print(e)
         sys.exit(1)
 
-    # Define the starting burst number
-    # and the thus the initial filename
-    # and settings file
-    filename : str = filename.replace('burstX', f"burst{burst_num}") 
-    settings_file: object = None # None because we are currently not tracking any settings
-
-    # Once the GO signal has been received, begin capturing chunks until we 
-    # receive a stop signal
-    while(True):     
-        # Use the milliseconds of time gaps between GO signals to generate files and hopefully not add 
-        # any delay in the start of a burst capture
+    # Now, the camera was initialized and the first ready was sent and the first command was received
+    # Therefore, capture bursts for as long as the parent tells us to GO
+    while(command['type'] == GO and not stop_flag.is_set()):     
+        # Arm and sleep until the start time the parent scheduled for every controller, 
+        # noting how late we actually started 
+        start_offset_ns: int = control.wait_for_start(command)
+
+        # Record a burst
+        go_flag.set()
+        capture_helper(cam, duration, write_queue,
+                       frame_buffer,
+                       filename, settings_file,
+                       burst_num, frame_means)
+        go_flag.clear()
+
+        # Increment the burst number += 1 
+        burst_num += 1
+
+        # Update the filename for the new burst number
+        filename = filename.replace(f'burst{burst_num-1}', f"burst{burst_num}")
+
+        # Use the time between bursts to generate the directory for the next burst and hopefully 
+        # not add any delay in the start of a burst capture
         # Akin to racing the beam on ATARI 2600, pretty cool! 
-        # Check to see if the STOP file exists, if it does, we end recording
-        if(len(os.listdir(STOP_file_dir)) > 0): break 
-
-        # Set the GO flag if we have received a GO signal
-        if(len(os.listdir(GO_file_dir)) > 0): go_flag.set()
-
-        # Generate the directory for this burst if it does not already exist
         if(not os.path.exists(filename)): os.mkdir(filename)
-    
-        # While we have the GO signal, record a burst
-        while(go_flag.is_set()):
-            # Capture duration worth of frames
-            capture_helper(cam, duration, write_queue,
-                           frame_buffer,
-                           filename, settings_file,
-                           burst_num)
-
-            # Stop recording until we receive the GO signal again 
-            go_flag.clear()
-            
-            # Try except here because multiple controllers could be trying to remove this file at once 
-            # so it could be deleted by the time another goes to delete it
-            try:
-                for file in os.listdir(GO_file_dir): os.remove(os.path.join(GO_file_dir, file))
-            except:
-                pass 
-
-
-            # Report to the parent process we are ready to go for the next burst 
-            assert(not os.path.exists(READY_file_name))
-            with open(READY_file_name, 'w') as f: pass
-            print(f'Pupil: Finished burst: {burst_num+1} | Sending READY signal for parent: {parent_pid}!')
-        
-            # Increment the burst number += 1 
-            burst_num += 1
 
-            # Update the filename for the new burst number
-            filename = filename.replace(f'burst{burst_num-1}', f"burst{burst_num}")
+        # Report to the parent process we are ready to go for the next burst, 
+        # along with when we started the last one 
+        control.send_ready(burst_num, start_time_ns=command['start_time_ns'], start_offset_ns=start_offset_ns)
+        print(f'Pupil: Finished burst: {burst_num} | Sending READY signal for parent: {parent_pid}!')
 
+        # Block until the next GO or STOP. If the parent has died, stop
+        try:
+            command = control.wait_for_command()
+        except ConnectionError:
+            print('Pupil cam: Parent closed the control channel')
+            break
 
     # Append None to the write queue to signal it is time to stop 
-    write_queue.put(None)
+    write_queue.close()
 
-    # Stop recording and close the picam object 
+    # Stop recording and close the camera and the control channel
     cam.close() 
+    control.close()
 
     ## If the last dir we made never got used, remove it
     if(os.path.exists(filename) and len(os.listdir(filename)) == 0): os.rmdir(filename)
 
-    # Remove any left over READY file if it is empty 
-    if(os.path.exists(READY_file_name)): os.remove(READY_file_name)
-
     print(f'Pupil cam: Finishing recording')
 
 """Record a video from the Pupil camera of a set duration. Can be as 
    a subprocess or not. If a subprocess, will need to be reinitialized 
    for every capture."""
-def record_video(duration: float, write_queue: queue.Queue, 
+def record_video(duration: float, write_queue: SPSCRing, 
                  filename: str, stop_flag: threading.Event,
                  is_subprocess: bool, parent_pid: int,
                  go_flag: threading.Event): 
@@ -454,7 +437,7 @@ def record_video(duration: float, write_queue: queue.Queue,
     end_capture_time: float = time.time()
     
     # Signal the end of the write queue
-    write_queue.put(None) 
+    write_queue.close() 
     
     # Calculate the approximate FPS the frames were taken at 
     # (approximate due to time taken for other computation)
@@ -467,11 +450,19 @@ def record_video(duration: float, write_queue: queue.Queue,
     print('Pupil cam: Finishing recording')
 
 
+"""Return the shape and type of the shared buffer a LEAN capture 
+   of duration seconds fills with downsampled frames"""
+def lean_buffer_spec(duration: int) -> tuple:
+    downsampled_image_shape: tuple = tuple(int(dim) for dim in (CAM_IMG_DIMS * 0.1).astype(np.uint16))
+
+    return ((duration + 1) * CAM_FPS, *downsampled_image_shape), np.uint8
+
 def lean_capture_helper(cam: object, duration: int, 
                        downsampled_buffer,
                        frame_buffer: np.ndarray,
                        write_queue: mp.Queue,
-                       world_queue):
+                       slot: int, start_fields: dict,
+                       frame_means: FrameMeans, frame_times: np.ndarray):
 
     # Begin timing capture
     start_time = time.time() 
@@ -494,11 +485,14 @@ def lean_capture_helper(cam: object, duration: int,
 
         # Capture the frame
         frame_obj: uvc_bindings.MJPEGFrame = cam.get_frame_robust()
-        if(frame_num == 0): world_queue.put(True)
+        frame_times[frame_num] = time.monotonic_ns()
 
         # Store the grayscale frame + settings into the allocated memory buffers
         frame_buffer[frame_num] = frame_obj.gray
 
+        # Compute the mean of the frame while it is still in cache
+        frame_means.add(frame_num, frame_buffer[frame_num])
+
         # Record the next frame number
         frame_num += 1 
             
@@ -513,15 +507,17 @@ def lean_capture_helper(cam: object, duration: int,
     for i in range(frame_num):
         cv2.resize(frame_buffer[i], downsampled_buffer.shape[1:], dst=downsampled_buffer[i])
 
-    # Append the chunk to the write queue 
-    write_queue.put(('P', downsampled_buffer[:frame_num], frame_num))
+    # Append only the description of the chunk (and its frames' means) to the write 
+    # queue, the main process reads the frames directly from shared memory
+    write_queue.put(('P', slot, frame_num, observed_fps, start_time, start_fields, frame_means.fields(frame_num),
+                     {'frame_times_ns': frame_times[:frame_num].copy()}))
     
     # Signal the end of the write queue
     write_queue.put(('P', None)) 
 
 
 def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue, 
-                 duration: int, world_queue):
+                 duration: int, world_queue, shared_buffer_name: str):
     # Initialize the camera
     cam: uvc.Capture = initialize_camera()
     #cam = None
@@ -530,9 +526,16 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue,
     # their respective settings. Allocate an additioanl second worth of frames 
     # in case we capture more than the target FPS (like 120.1) for instance
     frame_buffer: np.array = np.empty(((duration + 1) * CAM_FPS, *CAM_IMG_DIMS), dtype=np.uint8)
+    frame_means: FrameMeans = FrameMeans((duration + 1) * CAM_FPS)
+    frame_times: np.array = np.empty((duration + 1) * CAM_FPS, dtype=np.int64)
 
-    downsampled_image_shape: tuple = (CAM_IMG_DIMS * 0.1).astype(np.uint16)
-    downsampled_buffer = np.zeros(((duration+1) * CAM_FPS, *downsampled_image_shape), dtype=np.uint8)
+    # Attach to the shared memory double buffer the downsampled images are stored in. 
+    # We alternate between its two slots so the main process can still be reading 
+    # the last chunk while we capture the next
+    shared_buffer: shared_memory.SharedMemory = shared_memory.SharedMemory(name=shared_buffer_name)
+    downsampled_buffer_shape, downsampled_buffer_type = lean_buffer_spec(duration)
+    downsampled_buffers: np.ndarray = np.ndarray((2, *downsampled_buffer_shape), dtype=downsampled_buffer_type, buffer=shared_buffer.buf)
+    slot: int = 0
 
 
     print('Pupil Cam | Initialized')
@@ -543,9 +546,13 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue,
     while(STOP is False):
         print('Pupil Cam | Awaiting GO')
         # Retrieve whether we should go or not from 
-        # the main process 
+        # the main process. A GO is the CLOCK_MONOTONIC 
+        # time to start the chunk at
         GO: bool | int = receive_queue.get()
 
+        # Forward the GO (or STOP) to the World cam, so it 
+        # starts at the same time as us
+        world_queue.put(GO)
             
         # If GO received special flag, we end completely
         if(GO is False):
@@ -554,15 +561,23 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue,
             break    
 
         # Otherwise, we capture a burst of duration long 
-        while(GO is True):
+        while(GO is not False):
+            # Sleep until the start time shared by all of the sensors, 
+            # noting how late we actually started
+            start_offset_ns: int = sleep_until(GO)
+
             print(f'Pupil Cam | Capturing chunk')
             #gc.disable()
             # Capture a burst of frames
             lean_capture_helper(cam, duration,
-                                downsampled_buffer,
+                                downsampled_buffers[slot],
                                 frame_buffer, 
                                 write_queue,
-                                world_queue)
+                                slot, {'start_time_ns': GO, 'start_offset_ns': start_offset_ns},
+                                frame_means, frame_times)
+
+            # Swap to the other slot for the next chunk
+            slot ^= 1
 
             # Set GO back to False 
             GO = False
@@ -573,9 +588,11 @@ def lean_capture(write_queue: mp.Queue, receive_queue: mp.Queue,
     # Append to the main process queue and let it know we are really done 
     write_queue.put(('P', False))
 
-    # Close the camera
+    # Close the camera and detach from the shared buffer
     print(f'Pupil Cam | Closing')
     cam.close()
+    del downsampled_buffers
+    shared_buffer.close()
 
 # TODO: This does not yet work because no display method seems to work on RPI
 """Preview the camera feed"""
@@ -1,7 +1,6 @@
 # Import public libraries
 import sys
 import threading
-import queue
 import argparse
 import os
 import shutil
@@ -14,6 +13,12 @@ recorder_lib_path = os.path.join(os.path.dirname(__file__), '..', 'camera')
 sys.path.append(os.path.abspath(recorder_lib_path))
 from world_recorder import preview_capture, record_live, record_video, record_video_signalcom, write_frame, vid_array_from_npy_folder, reconstruct_video, unpack_capture_chunks
 
+"""Import the ring the capture thread hands items to the writer thread through"""
+from spsc_ring import SPSCRing, RingMonitor
+
+"""Import the CPU plan the master process launched this controller with"""
+from cpu_plan import ControllerPlan, apply_plan_from_environment
+
 """Parse arguments via the command line"""
 def parse_args() -> tuple:
     parser = argparse.ArgumentParser(description='Record videos from the camera via the RP')
@@ -53,6 +58,10 @@ def main():
     # Set the program title so we can see what it is in TOP 
     setproctitle.setproctitle(os.path.basename(__file__))
 
+    # Apply this controller's CPU plan to the main thread before any other thread
+    # is created, so every thread inherits it
+    cpu_plan: ControllerPlan = apply_plan_from_environment(os.path.basename(__file__))
+
     output_path, duration, initial_gain, initial_exposure, save_video, save_frames, preview, unpack_frames, is_subprocess, parent_pid, use_signalcom, starting_chunk_number = parse_args()
     
     # If the preview flag is true, first display a preview of the camera 
@@ -66,22 +75,24 @@ def main():
     # Retrieve the experiment filename and the video extension
     filename, extension = os.path.splitext(output_path) 
 
-    # Initialize a queue for frames to write 
-    write_queue: queue.Queue = queue.Queue()
+    # Initialize a ring for frames to write, and sample how full it is periodically
+    write_queue: SPSCRing = SPSCRing()
+    ring_monitor: RingMonitor = RingMonitor(write_queue, 'World')
 
-    # Build thread processes for both capturing frames and writing frames 
-    capture_thread: threading.Thread = threading.Thread(target=recorder, args=(duration, write_queue, filename, 
+    # Build thread processes for both capturing frames and writing frames, which 
+    # each apply their own part of the CPU plan to themselves before they run
+    capture_thread: threading.Thread = threading.Thread(target=cpu_plan.with_role('capture', recorder), args=(duration, write_queue, filename, 
                                                                                initial_gain, initial_exposure,
                                                                                stop_flag,
                                                                                is_subprocess,
                                                                                parent_pid,
                                                                                go_flag,
                                                                                starting_chunk_number))
-    write_thread: threading.Thread = threading.Thread(target=write_frame, args=(write_queue, filename, 
+    write_thread: threading.Thread = threading.Thread(target=cpu_plan.with_role('writer', write_frame), args=(write_queue, filename, 
                                                                                 not use_signalcom))
     
     # Begin the threads
-    for thread in (capture_thread, write_thread):
+    for thread in (capture_thread, write_thread, ring_monitor):
         thread.start()
 
     # Try capturing
@@ -100,6 +111,9 @@ def main():
         # then wait for the write thread to complete
         for thread in (capture_thread, write_thread):
             thread.join()
+
+        # Stop monitoring the ring and report its final state
+        ring_monitor.stop()
     
     print('Capture/Write processes finished')
 
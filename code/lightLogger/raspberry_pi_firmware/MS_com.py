@@ -1,7 +1,6 @@
 import os
 import numpy as np
 import argparse
-import queue
 import threading
 import signal
 import sys
@@ -12,6 +11,12 @@ ms_lib_path = os.path.join(os.path.dirname(__file__), '..', 'miniSpect')
 sys.path.append(os.path.abspath(ms_lib_path))
 from MS_recorder import record_video, record_live, record_video_signalcom, write_SERIAL
 
+"""Import the ring the capture thread hands items to the writer thread through"""
+from spsc_ring import SPSCRing, RingMonitor
+
+"""Import the CPU plan the master process launched this controller with"""
+from cpu_plan import ControllerPlan, apply_plan_from_environment
+
 """Parse the command line arguments"""
 def parse_args() -> str:
     parser = argparse.ArgumentParser(description='Communicate serially with the MS and save its readings to a desired location.')
@@ -39,6 +44,10 @@ def main():
     # Set the program title so we can see what it is in TOP 
     setproctitle.setproctitle(os.path.basename(__file__))
 
+    # Apply this controller's CPU plan to the main thread before any other thread
+    # is created, so every thread inherits it
+    cpu_plan: ControllerPlan = apply_plan_from_environment(os.path.basename(__file__))
+
     # Initialize output directory and names 
     # of reading files
     output_directory, duration, is_subprocess, parent_pid, use_signalcom, starting_chunk_number = parse_args()
@@ -48,20 +57,22 @@ def main():
     # Select whether to use the set-duration video recorder or the live recorder
     recorder: object = record_video_signalcom if use_signalcom is True else record_live if duration == float('INF') else record_video
 
-    # Initialize write_queue for data to write
-    write_queue: queue.Queue = queue.Queue()
+    # Initialize a ring for data to write, and sample how full it is periodically
+    write_queue: SPSCRing = SPSCRing()
+    ring_monitor: RingMonitor = RingMonitor(write_queue, 'MS')
 
-    # Build thread processes for both capturing frames and writing frames 
-    capture_thread: threading.Thread = threading.Thread(target=recorder, args=(duration, write_queue,
+    # Build thread processes for both capturing frames and writing frames, which 
+    # each apply their own part of the CPU plan to themselves before they run
+    capture_thread: threading.Thread = threading.Thread(target=cpu_plan.with_role('capture', recorder), args=(duration, write_queue,
                                                                                output_directory, 
                                                                                reading_names, stop_flag,
                                                                                is_subprocess, parent_pid, go_flag,
                                                                                starting_chunk_number))
-    write_thread: threading.Thread = threading.Thread(target=write_SERIAL, args=(write_queue, reading_names, 
+    write_thread: threading.Thread = threading.Thread(target=cpu_plan.with_role('writer', write_SERIAL), args=(write_queue, reading_names, 
                                                                                 output_directory, not use_signalcom))
     
     # Begin the threads
-    for thread in (capture_thread, write_thread):
+    for thread in (capture_thread, write_thread, ring_monitor):
         thread.start()
 
     # Try capturing
@@ -79,6 +90,9 @@ def main():
         # Then wait for the write thread to complete
         for thread in (capture_thread, write_thread):
             thread.join()
+
+        # Stop monitoring the ring and report its final state
+        ring_monitor.stop()
   
 
 if(__name__ == '__main__'):
@@ -7,7 +7,10 @@ import threading
 """Import utility functions from the device recorder"""
 recorder_lib_path = os.path.join(os.path.dirname(__file__), '..', 'sunglasses')
 sys.path.append(os.path.abspath(recorder_lib_path))
-from recorder import record_live, record
+from recorder import record_live, record, READ_INTERVAL
+
+"""Import the CPU plan the master process launched this controller with"""
+from cpu_plan import ControllerPlan, apply_plan_from_environment
 
 """If we receive a SIGTERM, terminate gracefully via keyboard interrupt"""
 def handle_sigterm(signum, frame):
@@ -35,14 +38,20 @@ def parse_args() -> tuple:
     parser.add_argument('duration', type=float, help='Duration of the recording')
     parser.add_argument('--is_subprocess', default=0, type=int, help='A flag to tell this process if it has been run as a subprocess or not')
     parser.add_argument('--parent_pid', default=0, type=int, help='A flag to tell this process what the pid is of the parent process which called it')
+    parser.add_argument('--sample_rate', default=1/READ_INTERVAL, type=float, help='The rate (Hz) to sample the sensor at')
    
     args = parser.parse_args()
     
-    return args.output_path, args.duration, bool(args.is_subprocess), args.parent_pid
+    return args.output_path, args.duration, bool(args.is_subprocess), args.parent_pid, args.sample_rate
 
 def main():
     # Parse the command line arguments
-    output_path, duration, is_subprocess, parent_pid = parse_args()
+    output_path, duration, is_subprocess, parent_pid, sample_rate = parse_args()
+
+    # Apply this controller's CPU plan. It captures from the main thread, 
+    # so that thread is given the capture settings as well
+    cpu_plan: ControllerPlan = apply_plan_from_environment(os.path.basename(__file__))
+    cpu_plan.apply('capture')
         
     # Select whether to use the set-duration video recorder or the live recorder
     recorder: object = record_live if duration == float('INF') else record 
@@ -51,7 +60,7 @@ def main():
     try:
         recorder(duration, output_path, 
                 is_subprocess, parent_pid,
-                go_flag)
+                go_flag, sample_rate)
     
     # If the capture was canceled via Ctrl + C
     except KeyboardInterrupt:
@@ -0,0 +1,445 @@
+"""Import public libraries"""
+import numpy as np
+import multiprocessing as mp
+import threading
+import functools
+import argparse
+import pathlib
+import types
+import queue
+import json
+import time
+import sys
+import os
+import psutil
+
+"""Import custom libraries"""
+# First generate the path to the lightLogger dir and Pi utility file
+light_logger_dir_path: str = str(pathlib.Path(__file__).parents[1])
+pi_util_path: str = os.path.join(os.path.dirname(__file__), 'utility')
+
+# Append the paths of the recorders and utilities to the current path
+for path in (os.path.join(light_logger_dir_path, 'camera'), os.path.join(light_logger_dir_path, 'miniSpect'),
+             os.path.join(light_logger_dir_path, 'pupil'), pi_util_path):
+    sys.path.append(path)
+
+# Import the libraries
+import rpi_firmware2
+import world_recorder
+import MS_recorder
+import pupil_recorder
+import chunk_container
+
+"""The names of the sensors in the chunk containers, and the rate (Hz) each nominally samples at"""
+SENSOR_NAMES: dict = {'W': 'World', 'M': 'MS', 'P': 'Pupil'}
+NOMINAL_RATES: dict = {'W': world_recorder.CAM_FPS, 'M': 1, 'P': pupil_recorder.CAM_FPS}
+
+"""An interval longer than GAP_FACTOR nominal periods means samples were dropped"""
+GAP_FACTOR: float = 1.5
+
+"""The number of bins of the inter-frame interval histograms, which span 0 to 4 nominal periods"""
+INTERVAL_HIST_BINS: int = 40
+
+"""The metrics compared against a baseline, whether higher is better for each, and the smallest
+   change (in the metric's own units) that can count as a regression, so noise around 0 does not.
+   The sensors' metrics have no fixed smallest change, as it depends on the sensor (see SENSOR_FLOORS)"""
+COMPARED_METRICS: dict = {'mean_fps': (True, None),
+                          'drop_rate': (False, None),
+                          'interval_p99_ms': (False, None),
+                          'latency_s_mean': (False, 0.05),
+                          'write_s_mean': (False, 0.05),
+                          'max_depth': (False, 1),
+                          'cpu_percent_mean': (False, 2),
+                          'rss_mb_max': (False, 10)}
+
+"""The smallest change in each sensor's metrics that can count as a regression, as a fraction
+   of the sensor's nominal rate (FPS), of its samples (drop rate, so 0.005 is 1 frame per second
+   at 200 FPS) and of its nominal period (interval p99, so 0.1 is 0.5 ms at 200 FPS)"""
+SENSOR_FLOOR_FRACTIONS: dict = {'mean_fps': 0.005, 'drop_rate': 0.005, 'interval_p99_ms': 0.1}
+SENSOR_FLOORS: dict = {SENSOR_NAMES[sensor]: {'mean_fps': SENSOR_FLOOR_FRACTIONS['mean_fps'] * rate,
+                                              'drop_rate': SENSOR_FLOOR_FRACTIONS['drop_rate'],
+                                              'interval_p99_ms': SENSOR_FLOOR_FRACTIONS['interval_p99_ms'] * 1e3 / rate}
+                       for sensor, rate in NOMINAL_RATES.items()}
+
+"""Paces a fake sensor's samples at a nominal rate. Samples arrive every period with
+   a little random delay, and as a real sensor only queues a few samples,
+   ones older than queue_length periods are lost while the reader is busy"""
+class FakeSensorClock:
+    def __init__(self, rate: float, jitter: float=0.05, queue_length: int=4, seed: int=0):
+        self.period: float = 1 / rate
+        self.jitter_s: float = jitter * self.period
+        self.queue_length: int = queue_length
+        self.rng: np.random.Generator = np.random.default_rng(seed)
+
+        # The sensor starts streaming when it is first read
+        self.start_time: float = None
+        self.sample_num: int = -1
+
+    """Block until the next sample arrives, and return its number"""
+    def wait(self) -> int:
+        current_time: float = time.monotonic()
+        if(self.start_time is None): self.start_time = current_time
+
+        # Skip the samples that have been overwritten in the sensor's queue
+        newest_sample: int = int((current_time - self.start_time) / self.period)
+        self.sample_num = max(self.sample_num + 1, newest_sample - self.queue_length + 1)
+
+        # Wait for this sample to arrive
+        arrival_time: float = self.start_time + self.sample_num * self.period + abs(self.rng.normal(0, self.jitter_s))
+        if(arrival_time > current_time): time.sleep(arrival_time - current_time)
+
+        return self.sample_num
+
+"""Stands in for the Picamera2 world camera, returning raw frames of a
+   flickering source at the camera's FPS"""
+class FakeWorldCamera:
+    def __init__(self, fps: float=world_recorder.CAM_FPS, flicker_hz: float=10, jitter: float=0.05, seed: int=0):
+        self.clock: FakeSensorClock = FakeSensorClock(fps, jitter, seed=seed)
+        self.controls: dict = {'AnalogueGain': 1.0, 'ExposureTime': 100}
+
+        # Generate one cycle of the flicker. The raw frames have twice as many columns,
+        # as the recorder keeps only the odd ones
+        rng: np.random.Generator = np.random.default_rng(0)
+        t: np.ndarray = np.arange(max(1, int(round(fps / flicker_hz)))) / fps
+        noise: np.ndarray = rng.integers(0, 16, (480, 1280), dtype=np.uint8)
+        self.frames: np.ndarray = np.clip(noise[None] + (100 + 60 * np.sin(2 * np.pi * flicker_hz * t))[:, None, None], 0, 255).astype(np.uint8)
+
+    def start(self, *args, **kwargs) -> None: pass
+    def stop(self) -> None: pass
+    def close(self) -> None: pass
+
+    def set_controls(self, controls: dict) -> None:
+        self.controls |= controls
+
+    def capture_metadata(self) -> dict:
+        self.clock.wait()
+        return dict(self.controls)
+
+    def capture_array(self, name: str='main') -> np.ndarray:
+        frame_num: int = self.clock.wait()
+        return self.frames[frame_num % self.frames.shape[0]].copy()
+
+    """Capture a request, whose metadata carries the time the sensor read the frame out at"""
+    def capture_request(self) -> object:
+        frame_num: int = self.clock.wait()
+        frame: np.ndarray = self.frames[frame_num % self.frames.shape[0]].copy()
+        metadata: dict = {'SensorTimestamp': int((self.clock.start_time + frame_num * self.clock.period) * 1e9),
+                          'FrameDuration': int(self.clock.period * 1e6), **self.controls}
+
+        return types.SimpleNamespace(make_array=lambda name: frame, get_metadata=lambda: dict(metadata), release=lambda: None)
+
+"""Stands in for the uvc pupil camera, returning grayscale frames at the camera's FPS"""
+class FakePupilCamera:
+    def __init__(self, fps: float=pupil_recorder.CAM_FPS, jitter: float=0.05, seed: int=1):
+        self.clock: FakeSensorClock = FakeSensorClock(fps, jitter, seed=seed)
+        self.frames: np.ndarray = np.random.default_rng(1).integers(0, 255, (8, *pupil_recorder.CAM_IMG_DIMS), dtype=np.uint8)
+
+    def close(self) -> None: pass
+
+    def get_frame_robust(self) -> object:
+        frame_num: int = self.clock.wait()
+        return types.SimpleNamespace(gray=self.frames[frame_num % self.frames.shape[0]].copy())
+
+"""Stands in for the MS' serial connection, sending a <...> framed reading each period"""
+class FakeMiniSpect:
+    def __init__(self, rate: float=NOMINAL_RATES['M'], jitter: float=0.05, seed: int=2):
+        self.clock: FakeSensorClock = FakeSensorClock(rate, jitter, queue_length=1, seed=seed)
+        self.in_waiting: int = 0
+
+    def close(self) -> None: pass
+
+    def read(self, size: int=1) -> bytes:
+        reading_num: int = self.clock.wait()
+        body: bytes = reading_num.to_bytes(4, 'little') + bytes(MS_recorder.DATA_LENGTH - 4)
+
+        return b'<' + body + b'>'
+
+"""Run a sensor's LEAN recorder against a fake sensor in place of its hardware.
+   The recorder's initializer is replaced inside the recorder's own process"""
+def fake_recorder(sensor: str, *args) -> None:
+    if(sensor == 'W'): world_recorder.initialize_camera = lambda *_: FakeWorldCamera()
+    elif(sensor == 'M'): MS_recorder.initialize_ms = lambda *_: FakeMiniSpect()
+    elif(sensor == 'P'): pupil_recorder.initialize_camera = lambda *_: FakePupilCamera()
+
+    recorder: object = {'W': world_recorder.lean_capture, 'M': MS_recorder.lean_capture, 'P': pupil_recorder.lean_capture}[sensor]
+    recorder(*args)
+
+"""Samples the depth of the queue into the write process as well as the CPU time
+   and resident memory of each process of a capture at a fixed interval"""
+class CaptureMonitor(threading.Thread):
+    def __init__(self, processes: list, receive_queue: mp.Queue, interval: float=0.5):
+        super().__init__(daemon=True)
+        self.processes: dict = {process.name: psutil.Process(process.pid) for process in processes}
+        self.receive_queue: mp.Queue = receive_queue
+        self.interval: float = interval
+        self.stop_event: threading.Event = threading.Event()
+
+        # The samples of each, as (seconds since start, value)
+        self.start_time: float = time.monotonic()
+        self.queue_depths: list = []
+        self.cpu_times: dict = {name: [] for name in self.processes}
+        self.rss: dict = {name: [] for name in self.processes}
+
+    """Take one sample of everything"""
+    def sample(self) -> None:
+        elapsed_time: float = time.monotonic() - self.start_time
+        self.queue_depths.append((elapsed_time, self.receive_queue.qsize()))
+
+        for name, process in self.processes.items():
+            try:
+                with process.oneshot():
+                    cpu_times = process.cpu_times()
+                    self.cpu_times[name].append((elapsed_time, cpu_times.user + cpu_times.system))
+                    self.rss[name].append((elapsed_time, process.memory_info().rss))
+
+            # The process may have already finished
+            except psutil.NoSuchProcess:
+                pass
+
+    def run(self) -> None:
+        self.sample()
+        while(not self.stop_event.wait(self.interval)):
+            self.sample()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.join()
+
+    """Summarize the queue depth over time and the CPU and memory use of each process"""
+    def report(self) -> tuple:
+        depths: np.ndarray = np.array(self.queue_depths, dtype=np.float64).reshape(-1, 2)
+        queue_depth: dict = {'times_s': depths[:, 0].round(3).tolist(), 'depths': depths[:, 1].astype(int).tolist(),
+                             'max_depth': int(depths[:, 1].max(initial=0))}
+
+        processes: dict = {}
+        for name in self.processes:
+            cpu_times: np.ndarray = np.array(self.cpu_times[name], dtype=np.float64).reshape(-1, 2)
+            rss: np.ndarray = np.array(self.rss[name], dtype=np.float64).reshape(-1, 2)
+            if(cpu_times.shape[0] < 2): continue
+
+            # The CPU use is the CPU time spent over the wall time it was spent in
+            cpu_seconds: float = float(cpu_times[-1, 1] - cpu_times[0, 1])
+            processes[name] = {'cpu_seconds': cpu_seconds,
+                               'cpu_percent_mean': 100 * cpu_seconds / float(cpu_times[-1, 0] - cpu_times[0, 0]),
+                               'rss_mb_max': float(rss[:, 1].max()) / 2**20}
+
+        return queue_depth, processes
+
+"""Summarize one sensor's chunks: the FPS it achieved, the histogram of the intervals
+   between its samples and how many samples were dropped (found from gaps in them)"""
+def sensor_report(sensor: str, chunks: list) -> dict:
+    period: float = 1 / NOMINAL_RATES[sensor]
+
+    # Find the intervals between the samples within each chunk
+    time_field: str = 'arrival_ns' if sensor == 'M' else 'frame_times_ns'
+    intervals: np.ndarray = np.concatenate([np.diff(np.asarray(chunk[time_field], dtype=np.int64)) / 1e9
+                                            for chunk in chunks] + [np.empty(0)])
+
+    # Each gap is missing as many samples as periods fit in it (less the one that ended it)
+    gaps: np.ndarray = intervals[intervals > GAP_FACTOR * period]
+    dropped_samples: int = int(np.sum(np.round(gaps / period) - 1))
+    num_samples: int = int(sum(chunk['num_frames'] for chunk in chunks))
+
+    # Bin the intervals, counting those past the last bin separately
+    counts, edges = np.histogram(intervals * 1e3, bins=INTERVAL_HIST_BINS, range=(0, 4 * period * 1e3))
+    fps: np.ndarray = np.array([chunk['fps'] for chunk in chunks], dtype=np.float64)
+
+    return {'nominal_fps': NOMINAL_RATES[sensor],
+            'num_chunks': len(chunks),
+            'num_samples': num_samples,
+            'mean_fps': float(fps.mean()) if fps.shape[0] > 0 else 0.0,
+            'min_fps': float(fps.min()) if fps.shape[0] > 0 else 0.0,
+            'dropped_samples': dropped_samples,
+            'drop_rate': dropped_samples / max(1, num_samples + dropped_samples),
+            'interval_p50_ms': float(np.percentile(intervals, 50) * 1e3) if intervals.shape[0] > 0 else 0.0,
+            'interval_p99_ms': float(np.percentile(intervals, 99) * 1e3) if intervals.shape[0] > 0 else 0.0,
+            'interval_max_ms': float(intervals.max(initial=0) * 1e3),
+            'interval_hist_edges_ms': edges.round(4).tolist(),
+            'interval_hist_counts': counts.tolist(),
+            'interval_hist_overflow': int(np.sum(intervals * 1e3 > edges[-1]))}
+
+"""Summarize how long the write process took to write each chunk"""
+def writer_report(write_stats: list) -> dict:
+    if(len(write_stats) == 0): return {}
+
+    latencies: np.ndarray = np.array([stats['latency_s'] for stats in write_stats])
+    write_times: np.ndarray = np.array([stats['write_s'] for stats in write_stats])
+    total_bytes: int = sum(stats['bytes'] for stats in write_stats)
+
+    return {'num_chunks': len(write_stats),
+            'latency_s_mean': float(latencies.mean()),
+            'latency_s_p95': float(np.percentile(latencies, 95)),
+            'latency_s_max': float(latencies.max()),
+            'write_s_mean': float(write_times.mean()),
+            'write_mb_per_s': total_bytes / 2**20 / max(float(write_times.sum()), 1e-9)}
+
+"""Capture n_bursts bursts of burst_duration seconds with the LEAN pipeline into output_path,
+   against fake sensors if desired, and return a report of how it performed"""
+def run_benchmark(output_path: str, n_bursts: int, burst_duration: int, fake: bool=True,
+                  init_time: float=2, monitor_interval: float=0.5) -> dict:
+    if(not os.path.exists(output_path)): os.makedirs(output_path)
+
+    # Replace the recorders' hardware with fakes if desired
+    recorders: tuple = tuple(functools.partial(fake_recorder, sensor) for sensor in SENSOR_NAMES) if fake else None
+
+    # Run the capture while monitoring it
+    stats_queue: mp.Queue = mp.Queue()
+    start_time: float = time.time()
+    processes, shared_buffers, receive_queue = rpi_firmware2.start_capture(n_bursts, burst_duration, output_path, recorders,
+                                                                          stats_queue, init_time)
+    monitor: CaptureMonitor = CaptureMonitor(processes, receive_queue, monitor_interval)
+    monitor.start()
+    rpi_firmware2.finish_capture(processes, shared_buffers)
+    monitor.stop()
+    elapsed_time: float = time.time() - start_time
+
+    # Gather how long each chunk took to write
+    write_stats: list = []
+    while(True):
+        try:
+            write_stats.append(stats_queue.get(timeout=0.1))
+        except queue.Empty:
+            break
+
+    # Read each sensor's chunk descriptions from the side-car containers written
+    # next to the chunks, so the frames themselves never have to be read
+    chunks: dict = {sensor: [] for sensor in SENSOR_NAMES}
+    for chunk_num in range(len(write_stats)):
+        sidecar: dict = chunk_container.read_chunk_container(os.path.join(output_path, f'{chunk_num}_frameMeans{chunk_container.CHUNK_CONTAINER_EXTENSION}'))
+        for sensor, fields in sidecar.items():
+            chunks[sensor].append(fields)
+
+    queue_depth, process_stats = monitor.report()
+
+    return {'config': {'n_bursts': n_bursts, 'burst_duration': burst_duration, 'fake': fake,
+                       'elapsed_s': elapsed_time, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'sensors': {SENSOR_NAMES[sensor]: sensor_report(sensor, sensor_chunks) for sensor, sensor_chunks in chunks.items()},
+            'writer': writer_report(write_stats),
+            'queue': queue_depth,
+            'processes': process_stats}
+
+"""Combine the reports of several trials into one, whose numbers are the medians over
+   the trials (so one unlucky trial does not move them) and whose other values 
+   (e.g. the histograms) are those of the first trial"""
+def median_report(reports: list) -> dict:
+    combined: dict = {}
+    for key, value in reports[0].items():
+        values: list = [report.get(key) for report in reports]
+        if(isinstance(value, dict)):
+            combined[key] = median_report([value for value in values if isinstance(value, dict)])
+        elif(isinstance(value, (int, float)) and not isinstance(value, bool) and all(isinstance(value, (int, float)) for value in values)):
+            combined[key] = float(np.median(values))
+        else:
+            combined[key] = value
+
+    return combined
+
+"""Flatten the compared metrics of a report into a dict of 'path/to/metric' -> value"""
+def flatten_metrics(report: dict, prefix: str='') -> dict:
+    metrics: dict = {}
+    for key, value in report.items():
+        if(isinstance(value, dict)):
+            metrics |= flatten_metrics(value, f'{prefix}{key}/')
+        elif(key in COMPARED_METRICS):
+            metrics[f'{prefix}{key}'] = value
+
+    return metrics
+
+"""Return the smallest change in a metric (by its 'path/to/metric') that can count as a regression"""
+def metric_floor(metric: str) -> float:
+    *path, name = metric.split('/')
+    if(path[0] == 'sensors'): return SENSOR_FLOORS[path[1]][name]
+
+    return COMPARED_METRICS[name][1]
+
+"""Compare a report to a baseline report. A metric has regressed if it is worse than its
+   baseline by more than its smallest meaningful change and the noise of the baseline: the 
+   spread (max - min) of the metric over the baseline's trials, so the comparison is as tight 
+   as the benchmark's own run-to-run variation allows. The writer's and processes' metrics 
+   must also be worse by more than tolerance (relative), while the sensors' floors are 
+   already scaled to each sensor.
+   Returns a dict of metric -> (baseline, value, change, noise, regressed)"""
+def compare_reports(report: dict, baseline: dict, tolerance: float=0.1) -> dict:
+    metrics: dict = flatten_metrics(report)
+    baseline_metrics: dict = flatten_metrics(baseline)
+    baseline_trials: list = [flatten_metrics(trial) for trial in baseline.get('trials', [])]
+
+    comparison: dict = {}
+    for metric, value in metrics.items():
+        if(metric not in baseline_metrics): continue
+        higher_is_better, _ = COMPARED_METRICS[metric.split('/')[-1]]
+        baseline_value: float = baseline_metrics[metric]
+        trial_values: list = [trial[metric] for trial in baseline_trials if metric in trial]
+        noise: float = max(trial_values) - min(trial_values) if len(trial_values) > 1 else 0.0
+
+        # Find how much worse (positive) or better (negative) the metric is
+        change: float = (baseline_value - value) if higher_is_better else (value - baseline_value)
+        relative_change: float = 0.0 if metric.startswith('sensors/') else tolerance * abs(baseline_value)
+        regressed: bool = change > max(relative_change, metric_floor(metric), noise)
+        comparison[metric] = (baseline_value, value, change, noise, regressed)
+
+    return comparison
+
+"""Parse arguments from the command line"""
+def parse_args() -> tuple:
+    parser = argparse.ArgumentParser(description='Benchmark the LEAN capture pipeline, reporting per-sensor throughput, dropped samples, writer latency, queue depth and process CPU/memory use')
+
+    parser.add_argument('output_path', type=str, help='The directory to write the chunks and the report (benchmark_report.json) to')
+    parser.add_argument('--n_bursts', type=int, default=3, help='The number of bursts to capture')
+    parser.add_argument('--burst_duration', type=int, default=5, help='The duration of each burst in seconds')
+    parser.add_argument('--fake', type=int, default=1, help='Capture from fake sensors (1) or the real hardware (0)')
+    parser.add_argument('--init_time', type=float, default=2, help='The time in seconds to allow the sensors to initialize')
+    parser.add_argument('--baseline', type=str, default=None, help='A previous report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='The relative change in a writer or process metric that counts as a regression')
+    parser.add_argument('--save_baseline', type=str, default=None, help='A path to also save the report to as a new baseline')
+    parser.add_argument('--n_trials', type=int, default=5, help='The number of times to run the benchmark. The report holds the median of each metric over the trials, and their spread is the noise a later run is compared against')
+    parser.add_argument('--fail_on_regression', type=int, choices=[0,1], default=1, help='Exit with an error if a metric regressed from the baseline')
+
+    args = parser.parse_args()
+
+    return args.output_path, args.n_bursts, args.burst_duration, bool(args.fake), args.init_time, args.baseline, args.tolerance, args.save_baseline, args.n_trials, bool(args.fail_on_regression)
+
+def main():
+    output_path, n_bursts, burst_duration, fake, init_time, baseline_path, tolerance, save_baseline_path, n_trials, fail_on_regression = parse_args()
+
+    # Run the benchmark n_trials times, each into its own directory, 
+    # and summarize them by the median of each metric
+    trials: list = [run_benchmark(os.path.join(output_path, f'trial{trial_num}'), n_bursts, burst_duration, fake, init_time)
+                    for trial_num in range(n_trials)]
+    report: dict = median_report(trials) | {'trials': trials}
+
+    # Print a summary of each sensor and the writer
+    for name, sensor in report['sensors'].items():
+        print(f"{name} | FPS: {sensor['mean_fps']:.2f}/{sensor['nominal_fps']} | Dropped: {sensor['dropped_samples']} ({100 * sensor['drop_rate']:.3f}%) | Interval p99: {sensor['interval_p99_ms']:.3f} ms")
+    if(len(report['writer']) > 0):
+        print(f"Writer | Latency mean: {report['writer']['latency_s_mean']:.3f} s | Write mean: {report['writer']['write_s_mean']:.3f} s | Max queue depth: {report['queue']['max_depth']}")
+    for name, process in report['processes'].items():
+        print(f"{name} | CPU: {process['cpu_percent_mean']:.1f}% | Max RSS: {process['rss_mb_max']:.1f} MB")
+
+    # Compare to the baseline if given
+    regressions: list = []
+    if(baseline_path is not None):
+        with open(baseline_path, 'r') as f:
+            baseline: dict = json.load(f)
+
+        comparison: dict = compare_reports(report, baseline, tolerance)
+        report['comparison'] = {metric: {'baseline': baseline_value, 'value': value, 'change': change, 'noise': noise, 
+                                         'floor': metric_floor(metric), 'regressed': regressed}
+                                for metric, (baseline_value, value, change, noise, regressed) in comparison.items()}
+        regressions = [metric for metric, (*_, regressed) in comparison.items() if regressed]
+        for metric, (baseline_value, value, change, noise, regressed) in comparison.items():
+            print(f"{'REGRESSED' if regressed else 'ok':>9} | {metric}: {baseline_value:.4g} -> {value:.4g} | Floor: {metric_floor(metric):.4g} | Baseline noise: {noise:.4g}")
+
+    # Save the report (and the new baseline if desired)
+    for path in (os.path.join(output_path, 'benchmark_report.json'), save_baseline_path):
+        if(path is None): continue
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    # Fail if anything regressed (unless told not to), so this can gate changes
+    if(len(regressions) > 0):
+        print(f'ERROR: {len(regressions)} metrics regressed from the baseline')
+        if(fail_on_regression is True): sys.exit(1)
+
+if(__name__ == '__main__'):
+    main()
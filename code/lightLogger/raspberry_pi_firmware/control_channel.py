@@ -0,0 +1,266 @@
+import socket
+import selectors
+import json
+import time
+import os
+import argparse
+import multiprocessing as mp
+
+"""Define the types of messages sent over the control channel. READY is sent from
+   a controller to the master when it is ready for a burst, GO and STOP are sent from
+   the master to all of the controllers to begin a burst or finish recording"""
+READY: str = 'READY'
+GO: str = 'GO'
+STOP: str = 'STOP'
+
+"""Define how far in the future (in seconds) the master schedules the start of a burst. 
+   This must be long enough for every controller to receive the GO and arm itself"""
+START_DELAY: float = 0.05
+
+"""Define how long before a scheduled start (in nanoseconds) a controller stops sleeping 
+   and spins instead, as the scheduler may wake a sleeping process late"""
+SPIN_MARGIN_NS: int = 2_000_000
+
+"""Return the path of the control channel socket of the master process with a given pid.
+   Controllers are already passed the pid of their parent, so they can find the socket from it"""
+def control_socket_path(master_pid: int) -> str:
+    return os.path.join('/tmp', f'lightLogger_control_{master_pid}.sock')
+
+"""Encode a control message as a line of JSON. Every message carries the burst number
+   it refers to and the CLOCK_MONOTONIC time in nanoseconds it was sent at"""
+def encode_message(message_type: str, burst_num: int, **fields) -> bytes:
+    message: dict = {'type': message_type, 'burst_num': burst_num, 'time_ns': time.monotonic_ns()} | fields
+
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+"""Return a start time START_DELAY seconds in the future on CLOCK_MONOTONIC, 
+   which is shared by every process on the machine"""
+def schedule_start(start_delay: float=START_DELAY) -> int:
+    return time.monotonic_ns() + int(start_delay * 1e9)
+
+"""Sleep until CLOCK_MONOTONIC reaches start_time_ns, then return how late 
+   (in nanoseconds) we actually woke up. Sleeps through most of the wait and only 
+   spins for the last SPIN_MARGIN_NS to wake up on time without burning a core"""
+def sleep_until(start_time_ns: int) -> int:
+    # Sleep through the bulk of the wait 
+    remaining_ns: int = start_time_ns - time.monotonic_ns()
+    if(remaining_ns > SPIN_MARGIN_NS):
+        time.sleep((remaining_ns - SPIN_MARGIN_NS) / 1e9)
+
+    # Then spin until the start time 
+    current_time_ns: int = time.monotonic_ns()
+    while(current_time_ns < start_time_ns):
+        current_time_ns = time.monotonic_ns()
+
+    return current_time_ns - start_time_ns
+
+"""Read whole lines from a socket into a list of decoded messages. The unparsed
+   remainder is kept in the pending bytearray for the next read. Raises
+   ConnectionError if the other side has closed the connection"""
+def receive_messages(sock: socket.socket, pending: bytearray) -> list:
+    data: bytes = sock.recv(4096)
+    if(len(data) == 0):
+        raise ConnectionError('ERROR: Control channel connection closed')
+
+    # Split off every complete line and keep the rest
+    pending += data
+    *lines, remainder = pending.split(b'\n')
+    pending[:] = remainder
+
+    return [json.loads(line.decode('utf-8')) for line in lines if len(line) > 0]
+
+"""The master process' end of the control channel. Listens on a Unix domain socket
+   for the named controllers to connect, then blocks (rather than spins) while
+   waiting for their READY messages"""
+class ControlServer:
+    def __init__(self, socket_path: str, controller_names: list):
+        # Remove a stale socket from a previous run with the same pid
+        if(os.path.exists(socket_path)): os.remove(socket_path)
+
+        # Open the listening socket
+        self.socket_path: str = socket_path
+        self.listener: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(socket_path)
+        self.listener.listen(len(controller_names))
+
+        # The controllers we expect, their connections once they have introduced
+        # themselves, and the bytes received from each that are not yet parsed
+        self.controller_names: list = list(controller_names)
+        self.connections: dict = {}
+        self.pending: dict = {}
+
+        # Wait on the listener and all of the connections at once
+        self.selector: selectors.BaseSelector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+    """Block until every controller has sent a READY message for burst_num
+       (or any burst if burst_num is None), or timeout seconds have passed.
+       Returns a dict of controller name -> its READY message"""
+    def wait_for_ready(self, timeout: float, burst_num: int=None) -> dict:
+        ready_messages: dict = {}
+        deadline: float = time.monotonic() + timeout
+        while(len(ready_messages) < len(self.controller_names)):
+            # Block until a controller connects or sends a message
+            remaining_time: float = deadline - time.monotonic()
+            if(remaining_time <= 0):
+                raise TimeoutError(f'ERROR: Master process did not receive enough READY signals by timeout: {sorted(ready_messages)}/{self.controller_names}')
+
+            for key, _ in self.selector.select(remaining_time):
+                # Accept new controllers. They are registered once they introduce themselves
+                if(key.fileobj is self.listener):
+                    connection, _ = self.listener.accept()
+                    self.pending[connection] = bytearray()
+                    self.selector.register(connection, selectors.EVENT_READ)
+                    continue
+
+                # Otherwise, parse the messages from this controller
+                for message in receive_messages(key.fileobj, self.pending[key.fileobj]):
+                    self.connections[message['name']] = key.fileobj
+
+                    # Note the controller is READY if this is for the burst we are waiting on
+                    if(message['type'] == READY and (burst_num is None or message['burst_num'] == burst_num)):
+                        ready_messages[message['name']] = message
+
+        return ready_messages
+
+    """Send a message to every connected controller"""
+    def broadcast(self, message_type: str, burst_num: int, **fields) -> None:
+        message: bytes = encode_message(message_type, burst_num, **fields)
+        for connection in self.connections.values():
+            connection.sendall(message)
+
+    """Tell every controller to capture burst_num, starting together at 
+       start_time_ns on CLOCK_MONOTONIC (scheduled START_DELAY from now if not given). 
+       Returns the start time"""
+    def broadcast_go(self, burst_num: int, start_time_ns: int=None, **fields) -> int:
+        if(start_time_ns is None): start_time_ns = schedule_start()
+        self.broadcast(GO, burst_num, start_time_ns=start_time_ns, **fields)
+
+        return start_time_ns
+
+    """Tell every controller to finish recording"""
+    def broadcast_stop(self, burst_num: int) -> None:
+        self.broadcast(STOP, burst_num)
+
+    """Close all of the connections and remove the socket"""
+    def close(self) -> None:
+        self.selector.close()
+        for connection in self.pending:
+            connection.close()
+        self.listener.close()
+        if(os.path.exists(self.socket_path)): os.remove(self.socket_path)
+
+"""A controller's end of the control channel"""
+class ControlClient:
+    def __init__(self, socket_path: str, name: str, timeout: float=15):
+        # Connect to the master, retrying until it has begun listening
+        self.name: str = name
+        self.sock: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        deadline: float = time.monotonic() + timeout
+        while(True):
+            try:
+                self.sock.connect(socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if(time.monotonic() >= deadline): raise
+                time.sleep(0.05)
+
+        # The bytes received that are not yet parsed, and the messages parsed but not yet returned
+        self.pending: bytearray = bytearray()
+        self.messages: list = []
+
+    """Report to the master that we are ready to capture burst_num"""
+    def send_ready(self, burst_num: int, **fields) -> None:
+        self.sock.sendall(encode_message(READY, burst_num, name=self.name, **fields))
+
+    """Block until the master sends a GO or STOP, and return that message.
+       Raises ConnectionError if the master process has died"""
+    def wait_for_command(self) -> dict:
+        while(len(self.messages) == 0):
+            self.messages += receive_messages(self.sock, self.pending)
+
+        return self.messages.pop(0)
+
+    """Sleep until the start time of a GO command, and return the offset 
+       (in nanoseconds) this controller actually started at from it"""
+    def wait_for_start(self, command: dict) -> int:
+        return sleep_until(command['start_time_ns'])
+
+    """Close the connection to the master"""
+    def close(self) -> None:
+        self.sock.close()
+
+"""A stand in for a sensor controller, which follows the control protocol
+   but sleeps instead of capturing. Used to test the protocol without hardware"""
+def fake_controller(socket_path: str, name: str, burst_seconds: float, results_queue: mp.Queue) -> None:
+    control: ControlClient = ControlClient(socket_path, name)
+
+    # Report READY for the first burst and then follow commands until STOP
+    burst_num: int = 0
+    control.send_ready(burst_num)
+    while(True):
+        command: dict = control.wait_for_command()
+        if(command['type'] == STOP): break
+
+        # Note how long after the GO was sent we received it, then 
+        # wait for the burst to start and note how late we started
+        latency_ns: int = time.monotonic_ns() - command['time_ns']
+        start_offset_ns: int = control.wait_for_start(command)
+        results_queue.put((name, command['burst_num'], latency_ns, start_offset_ns))
+
+        # "Capture" a burst then report READY for the next
+        time.sleep(burst_seconds)
+        burst_num = command['burst_num'] + 1
+        control.send_ready(burst_num, start_time_ns=command['start_time_ns'], start_offset_ns=start_offset_ns)
+
+    control.close()
+
+"""Parse arguments from the command line"""
+def parse_args() -> tuple:
+    parser = argparse.ArgumentParser(description='Test the control channel protocol with fake sensor controller processes')
+
+    parser.add_argument('--n_controllers', type=int, default=3, help='The number of fake controllers to spawn')
+    parser.add_argument('--n_bursts', type=int, default=5, help='The number of bursts to capture')
+    parser.add_argument('--burst_seconds', type=float, default=0.5, help='The duration of each burst')
+
+    args = parser.parse_args()
+
+    return args.n_controllers, args.n_bursts, args.burst_seconds
+
+"""Main used for testing purposes. Runs the protocol between this process as
+   the master and fake controller processes, and reports the GO latencies
+   and how closely the controllers started each burst together"""
+def main():
+    n_controllers, n_bursts, burst_seconds = parse_args()
+
+    # Open the master's end of the channel and spawn the controllers
+    names: list = [f'fake_controller_{i}' for i in range(n_controllers)]
+    server: ControlServer = ControlServer(control_socket_path(os.getpid()), names)
+    results_queue: mp.Queue = mp.Queue()
+    processes: list = [mp.Process(target=fake_controller, args=(server.socket_path, name, burst_seconds, results_queue))
+                       for name in names]
+    for process in processes: process.start()
+
+    # Capture the bursts
+    server.wait_for_ready(timeout=15, burst_num=0)
+    for burst_num in range(n_bursts):
+        server.broadcast_go(burst_num)
+        server.wait_for_ready(timeout=burst_seconds + 15, burst_num=burst_num+1)
+    server.broadcast_stop(n_bursts)
+
+    for process in processes: process.join()
+    server.close()
+
+    # Report the latency between sending GO and each controller receiving it, 
+    # as well as how late after the scheduled start each controller started
+    latencies_ms: list = []
+    start_offsets_ms: list = []
+    while(not results_queue.empty()):
+        name, burst_num, latency_ns, start_offset_ns = results_queue.get()
+        latencies_ms.append(latency_ns / 1e6)
+        start_offsets_ms.append(start_offset_ns / 1e6)
+    print(f'GO latency over {len(latencies_ms)} receipts | mean: {sum(latencies_ms)/len(latencies_ms):.3f} ms | max: {max(latencies_ms):.3f} ms')
+    print(f'Start offset over {len(start_offsets_ms)} starts | mean: {sum(start_offsets_ms)/len(start_offsets_ms):.3f} ms | max: {max(start_offsets_ms):.3f} ms')
+
+if(__name__ == '__main__'):
+    main()
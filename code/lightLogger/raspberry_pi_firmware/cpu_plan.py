@@ -0,0 +1,236 @@
+import os
+import json
+import ctypes
+import platform
+import threading
+import argparse
+
+"""A declarative plan of the CPU cores, scheduling and I/O priority of each controller's
+   threads, read from the same config file as the controllers. Each line of the plan is
+
+       cpu_plan <controller> <role> [cpus=2,3] [policy=fifo] [priority=50] [nice=-10] [io=realtime:0]
+
+   where the controller is the name of a controller script (e.g. Camera_com.py) or master
+   for the master process, and the role is process (every thread of the controller), capture
+   or writer. Settings not given are left as they are. The policy is one of SCHED_POLICIES,
+   whose priority (1-99) only applies to the real-time policies, and the I/O priority is one
+   of IO_CLASSES with an optional level (0-7, lower is higher priority)"""
+CPU_PLAN_KEYWORD: str = 'cpu_plan'
+CPU_PLAN_ROLES: tuple = ('process', 'capture', 'writer')
+
+# The environment variable the master passes each controller its part of the plan in
+CPU_PLAN_ENV: str = 'LIGHTLOGGER_CPU_PLAN'
+
+# The scheduling policies a thread can be given
+SCHED_POLICIES: dict = {'other': os.SCHED_OTHER, 'batch': os.SCHED_BATCH, 'idle': os.SCHED_IDLE,
+                        'fifo': os.SCHED_FIFO, 'rr': os.SCHED_RR} if hasattr(os, 'SCHED_FIFO') else {}
+
+# The policies that take a (real-time) priority
+REALTIME_POLICIES: tuple = ('fifo', 'rr')
+
+# The I/O scheduling classes a thread can be given (see ioprio_set(2))
+IO_CLASSES: dict = {'none': 0, 'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+# The I/O priority applies to a single thread (IOPRIO_WHO_PROCESS), and is encoded as its class
+# shifted above its level. Python has no wrapper for it, so it is called by syscall number
+IOPRIO_WHO_PROCESS: int = 1
+IOPRIO_CLASS_SHIFT: int = 13
+IOPRIO_SYSCALLS: dict = {'x86_64': (251, 252), 'aarch64': (30, 31), 'armv7l': (314, 315), 'armv6l': (314, 315)}
+
+"""Parse one line of the plan's settings (key=value tokens) into a dict of settings"""
+def parse_settings(tokens: list) -> dict:
+    settings: dict = {}
+    for token in tokens:
+        key, value = token.split('=')
+        if(key == 'cpus'):
+            settings[key] = sorted(int(cpu) for cpu in value.split(','))
+        elif(key == 'policy'):
+            if(value not in SCHED_POLICIES): raise Exception(f'ERROR: Unsupported scheduling policy: {value}')
+            settings[key] = value
+        elif(key in ('priority', 'nice')):
+            settings[key] = int(value)
+        elif(key == 'io'):
+            io_class, _, io_level = value.partition(':')
+            if(io_class not in IO_CLASSES): raise Exception(f'ERROR: Unsupported I/O class: {io_class}')
+            settings[key] = [io_class, int(io_level) if len(io_level) > 0 else 4]
+        else:
+            raise Exception(f'ERROR: Unknown CPU plan setting: {key}')
+
+    # Reject settings the kernel would, rather than finding out when they are applied. The
+    # real-time policies need a priority (the kernel rejects 0), which no other policy takes
+    if(settings.get('policy') in REALTIME_POLICIES):
+        if(not 1 <= settings.get('priority', 0) <= 99): raise Exception(f"ERROR: The {settings['policy']} policy needs a priority from 1 to 99")
+    elif('priority' in settings):
+        raise Exception(f"ERROR: A priority only applies to the real-time policies: {REALTIME_POLICIES}")
+    if(not -20 <= settings.get('nice', 0) <= 19): raise Exception(f"ERROR: The nice value must be from -20 to 19: {settings['nice']}")
+    if('io' in settings and not 0 <= settings['io'][1] <= 7): raise Exception(f"ERROR: The I/O priority level must be from 0 to 7: {settings['io'][1]}")
+
+    return settings
+
+"""Return whether a line of the config file is part of the CPU plan"""
+def is_cpu_plan_line(line: str) -> bool:
+    return line.strip().split(' ')[0] == CPU_PLAN_KEYWORD
+
+"""Parse the CPU plan out of the config file, as a dict of controller -> role -> settings"""
+def parse_cpu_plan(config_path: str) -> dict:
+    plan: dict = {}
+    with open(config_path, 'r') as f:
+        for line in f:
+            if(not is_cpu_plan_line(line)): continue
+
+            _, controller, role, *tokens = line.split()
+            if(role not in CPU_PLAN_ROLES): raise Exception(f'ERROR: Unknown CPU plan role: {role}')
+            plan.setdefault(controller, {})[role] = parse_settings(tokens)
+
+    return plan
+
+"""Return the environment to launch a controller with, carrying its part of the plan"""
+def plan_environment(plan: dict, controller: str) -> dict:
+    return os.environ | {CPU_PLAN_ENV: json.dumps(plan.get(controller, {}))}
+
+"""Call ioprio_set/ioprio_get for a thread (only available on Linux)"""
+def ioprio_syscall(get: bool, tid: int, ioprio: int=0) -> int:
+    if(platform.machine() not in IOPRIO_SYSCALLS): raise OSError(f'ioprio syscalls unknown on {platform.machine()}')
+    libc: ctypes.CDLL = ctypes.CDLL(None, use_errno=True)
+    syscall_num: int = IOPRIO_SYSCALLS[platform.machine()][1 if get else 0]
+
+    ret: int = libc.syscall(syscall_num, IOPRIO_WHO_PROCESS, tid) if get else libc.syscall(syscall_num, IOPRIO_WHO_PROCESS, tid, ioprio)
+    if(ret < 0):
+        errno: int = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    return ret
+
+"""Apply settings to a thread (by its native id). Returns the errors raised applying each setting"""
+def apply_settings(tid: int, settings: dict) -> dict:
+    errors: dict = {}
+    for key, value in settings.items():
+        try:
+            if(key == 'cpus'):
+                os.sched_setaffinity(tid, value)
+            elif(key == 'policy'):
+                os.sched_setscheduler(tid, SCHED_POLICIES[value], os.sched_param(settings.get('priority', 0)))
+            elif(key == 'nice'):
+                os.setpriority(os.PRIO_PROCESS, tid, value)
+            elif(key == 'io'):
+                ioprio_syscall(False, tid, (IO_CLASSES[value[0]] << IOPRIO_CLASS_SHIFT) | value[1])
+        except OSError as e:
+            errors[key] = str(e)
+
+    return errors
+
+"""Read back the settings a thread (by its native id) actually has"""
+def read_settings(tid: int) -> dict:
+    policies: dict = {policy_num: name for name, policy_num in SCHED_POLICIES.items()}
+    settings: dict = {'cpus': sorted(os.sched_getaffinity(tid)),
+                      'policy': policies.get(os.sched_getscheduler(tid), 'unknown'),
+                      'priority': os.sched_getparam(tid).sched_priority,
+                      'nice': os.getpriority(os.PRIO_PROCESS, tid)}
+    try:
+        ioprio: int = ioprio_syscall(True, tid)
+        io_classes: dict = {io_class_num: name for name, io_class_num in IO_CLASSES.items()}
+        settings['io'] = [io_classes.get(ioprio >> IOPRIO_CLASS_SHIFT, 'unknown'), ioprio & ((1 << IOPRIO_CLASS_SHIFT) - 1)]
+    except OSError:
+        settings['io'] = None
+
+    return settings
+
+"""Apply settings to a thread, then read them back to verify they took. Returns a
+   report of what was requested, what the thread actually has and whether they match"""
+def apply_and_verify(tid: int, settings: dict) -> dict:
+    errors: dict = apply_settings(tid, settings)
+    actual: dict = read_settings(tid)
+
+    mismatched: list = [key for key, value in settings.items() if key in actual and actual[key] != value]
+
+    return {'tid': tid, 'requested': settings, 'actual': actual,
+            'verified': len(errors) == 0 and len(mismatched) == 0, 'errors': errors, 'mismatched': mismatched}
+
+"""Print a summary of a report"""
+def print_report(name: str, role: str, report: dict) -> None:
+    state: str = 'OK' if report['verified'] else f"FAILED {report['errors'] or report['mismatched']}"
+    print(f"CPU plan | {name} {role} (tid {report['tid']}) | Requested: {report['requested']} | Actual: {report['actual']} | {state}")
+
+"""A controller's part of the plan, applied to its own threads. The process settings are applied
+   to the main thread before any other thread is created, so every thread inherits them, and each
+   thread with a role of its own applies its settings to itself before it runs. The reports of
+   what was applied are kept so they can be sent to the master process"""
+class ControllerPlan:
+    def __init__(self, name: str, roles: dict):
+        self.name: str = name
+        self.roles: dict = roles
+        self.reports: dict = {}
+
+    """Apply the settings of a role to a thread (by default, the calling thread)"""
+    def apply(self, role: str, tid: int=None) -> None:
+        if(role not in self.roles): return
+
+        tid = threading.get_native_id() if tid is None else tid
+        self.reports[role] = apply_and_verify(tid, self.roles[role])
+        print_report(self.name, role, self.reports[role])
+
+    """Wrap a thread's target so the thread applies the settings of its role to itself
+       before it runs the target. Applying them from the thread that started it instead
+       would leave the thread's first iterations under the process settings"""
+    def with_role(self, role: str, target: callable) -> callable:
+        def run_with_role(*args, **kwargs):
+            self.apply(role)
+            return target(*args, **kwargs)
+
+        return run_with_role
+
+"""Retrieve this controller's part of the plan from the environment the master launched it with"""
+def plan_from_environment(name: str) -> ControllerPlan:
+    return ControllerPlan(name, json.loads(os.environ.get(CPU_PLAN_ENV, '{}')))
+
+# The plan of this process once it has been applied (see applied_plan_report)
+applied_plan: ControllerPlan = None
+
+"""Retrieve this controller's part of the plan from the environment and apply its process
+   settings to the calling (main) thread. The plan is kept so the recorders can report it"""
+def apply_plan_from_environment(name: str) -> ControllerPlan:
+    global applied_plan
+    applied_plan = plan_from_environment(name)
+    applied_plan.apply('process')
+
+    return applied_plan
+
+"""Return the reports of the plan applied in this process, to send to the master process"""
+def applied_plan_report() -> dict:
+    return {} if applied_plan is None else applied_plan.reports
+
+"""Parse arguments from the command line"""
+def parse_args() -> tuple:
+    parser = argparse.ArgumentParser(description='Apply the CPU plan of a config file to threads of this process and verify it')
+
+    parser.add_argument('config_path', type=str, help='The config file to read the CPU plan from')
+    parser.add_argument('controller', type=str, help='The controller whose part of the plan to apply')
+
+    args = parser.parse_args()
+
+    return args.config_path, args.controller
+
+"""Main used for testing purposes. Applies a controller's plan to this process' main thread and
+   to a capture and writer thread, printing what was requested and what actually took"""
+def main():
+    config_path, controller = parse_args()
+    plan: dict = parse_cpu_plan(config_path)
+    print(f'Parsed CPU plan: {plan}')
+
+    # Pass the plan through the environment, as the master process does
+    os.environ |= plan_environment(plan, controller)
+    controller_plan: ControllerPlan = apply_plan_from_environment(controller)
+
+    # Start threads that wait until they are told to finish
+    finish: threading.Event = threading.Event()
+    threads: dict = {role: threading.Thread(target=controller_plan.with_role(role, finish.wait)) for role in ('capture', 'writer')}
+    for thread in threads.values():
+        thread.start()
+
+    finish.set()
+    for thread in threads.values(): thread.join()
+
+    print(json.dumps(applied_plan_report(), indent=4))
+
+if(__name__ == '__main__'):
+    main()
@@ -9,10 +9,12 @@ import traceback
 import queue
 import io
 import setproctitle
-import shutil
 import threading
 import datetime
 import multiprocessing as mp
+import json
+from control_channel import ControlServer, control_socket_path
+from cpu_plan import ControllerPlan, parse_cpu_plan, is_cpu_plan_line, plan_environment, print_report
 
 # Define the time in seconds to wait before 
 # raising a timeout error
@@ -76,6 +78,9 @@ def parse_process_args(config_path: str) -> tuple:
              # Skip commented lines 
             if(len(line.strip()) == 0 or line.strip()[0] == '#'): continue
 
+            # Skip the lines of the CPU plan (see parse_cpu_plan)
+            if(is_cpu_plan_line(line)): continue
+
             # First line is going to be the overarching experiment name + path
             if(experiment_name is None):
                 experiment_name = line.strip()
@@ -114,12 +119,15 @@ def parse_process_args(config_path: str) -> tuple:
    from all of the sensors by recalling 
    the controllers repeatedly (and thus 
    reinitializing all of the sensors over and over)"""
-def capture_burst_multi_init(info_file: object, component_controllers: list, CPU_priorities: list, 
+def capture_burst_multi_init(info_file: object, component_controllers: list, cpu_plan: dict, 
                              burst_seconds: float, burst_num: int, shell_output: bool= True) -> None:
 
     # Determine the current pid of this master process
     master_pid: int = os.getpid()
 
+    # Apply the master's part of the CPU plan to itself
+    ControllerPlan('master', cpu_plan.get('master', {})).apply('process')
+
     # List to keep track of process objects
     processes: list = []
 
@@ -143,31 +151,18 @@ def capture_burst_multi_init(info_file: object, component_controllers: list, CPU
     signal.signal(signal.SIGUSR1, handle_readysig)
 
     # Iterate over the other scripts and start them with their associated arguments
-    for (script, args), (core, priority) in zip(component_controllers.items(), CPU_priorities):
+    for script, args in component_controllers.items():
         # In the args, we must replace the burstX with the burst number
         # and the parent process ID with the parent processID of this file 
         args: str = args.replace('burstX', f'burst{burst_num}').replace('--parent_pid X', f'--parent_pid {master_pid}')
 
-        # Launch the subprocess
+        # Launch the subprocess with its part of the CPU plan, 
+        # which it applies to its own threads
         p = subprocess.Popen(args,
                              stdout=sys.stdout,
                              stderr=sys.stderr,
-                             shell=shell_output)
-
-        # Turn p into a psutil process so we can set core 
-        # affinity and niceity
-        psutil_process: psutil.Process = psutil.Process(p.pid)
-
-        # Set the cpu affinity (which core this will run on)
-        # as well as its niceity (priority)
-        psutil_process.cpu_affinity([core])
-
-        # Have to include this to define niceity because 
-        # using the psutil_process.nice() command requires sudo 
-        # privelges, which if I run this script with, says my 
-        # libraries don't exist
-        # Also do before change and after to ensure both are top priority
-        os.system(f"sudo renice -n -20 -p {p.pid}")
+                             shell=shell_output,
+                             env=plan_environment(cpu_plan, script))
 
         # Append this process to the list of processes 
         # and its pid to the list of pids
@@ -236,68 +231,62 @@ def capture_burst_multi_init(info_file: object, component_controllers: list, CPU
     return
 
 """Helper function to send STOP signals to the subprocesses"""
-def stop_subprocesses(pids: dict, master_pid: int, processes: list, STOP_file_dir: str):
+def stop_subprocesses(control_server: ControlServer, burst_num: int, processes: list):
     print(f'Master process: Sending STOP signals')
 
-    # Send the STOP signal by creating a file
-    with open(os.path.join(STOP_file_dir, 'STOP.txt'), 'w') as f: pass
+    # Send the STOP signal over the control channel
+    control_server.broadcast_stop(burst_num)
     
     # Close the processes after recording 
     for process in processes:
         process.wait()
 
-""""""
-def monitor_READY_dir(ready_dir_path: str, controllers_ready: dict):
-    # Scan the READY flag directory for which controllers are ready
-    ready_files: list = os.listdir(ready_dir_path)
+    # Close the control channel 
+    control_server.close()
 
-    # Update the controllers_ready dict to include those that are now ready we haven't seen 
-    for ready_file in ready_files:
-        # Retrieve the name of this controller
-        controller_name: str = ready_file.split('|')[0].strip()
+"""Helper function to record when each controller actually started a burst 
+   relative to the start time scheduled for all of them"""
+def log_burst_start(start_offsets_file: object, burst_num: int, ready_messages: dict):
+    for controller, message in ready_messages.items():
+        start_offsets_file.write(f"{burst_num},{controller},{message['start_time_ns']},{message['start_offset_ns']}\n")
 
-        # Update it to be ready if it's not already
-        if(controllers_ready[controller_name] is not True): 
-            controllers_ready[controller_name] = True
+"""Helper function to record the CPU plan the master process and each controller
+   actually applied, and to warn of any setting that did not take"""
+def log_cpu_plan(cpu_plan_path: str, master_plan: ControllerPlan, ready_messages: dict):
+    applied_plan: dict = {'master': {'pid': os.getpid(), 'cpu_plan': master_plan.reports}}
+    applied_plan |= {controller: {'pid': message.get('pid'), 'cpu_plan': message.get('cpu_plan', {})}
+                     for controller, message in ready_messages.items()}
 
-"""Helper function to clear the READY folder of READY files"""
-def clear_READY_dir(READY_dir_path: str, controllers_ready: dict):
-    for file in os.listdir(READY_dir_path):
-        os.remove(os.path.join(READY_dir_path, file))
+    with open(cpu_plan_path, 'w') as f:
+        json.dump(applied_plan, f, indent=4)
 
-    # Reset component controllers to False
-    for controller in controllers_ready:
-        controllers_ready[controller] = False
+    # Warn of the settings that were not applied as planned
+    for controller, applied in applied_plan.items():
+        for role, report in applied['cpu_plan'].items():
+            if(not report['verified']): print_report(controller, role, report)
 
 """Capture a burst of length burst_seconds
    from all of the sensors by calling the controllers 
    once and communicating with signals when to start/stop
-   the next chunk"""
-def capture_burst_single_init(info_file: object, component_controllers: list, CPU_priorities: list, 
+   the next chunk. Every burst is scheduled to start at the same
+   CLOCK_MONOTONIC time on all controllers"""
+def capture_burst_single_init(info_file: object, component_controllers: list, cpu_plan: dict, 
                               burst_seconds: float, n_bursts: int, shell_output: bool= True,
-                              burst_num: int=0) -> None:
+                              burst_num: int=0, start_offsets_file: object=None) -> None:
 
     # Determine the current pid of this master process
     master_pid: int = os.getpid()
 
-    # Give it max priority 
-    os.system(f"sudo renice -n -20 -p {master_pid}")
+    # Apply the master's part of the CPU plan to itself
+    master_plan: ControllerPlan = ControllerPlan('master', cpu_plan.get('master', {}))
+    master_plan.apply('process')
 
     # List to keep track of process objects
     processes: list = []
 
-    # Initialize a dictionary of all of the controller names and if they are ready 
-    controllers_ready: dict = {controller: False
-                              for controller in component_controllers}
-    
-    # Define the directory to look for the READY, GO, and STOP signal files in
-    READY_file_dir: str = os.path.join(os.path.dirname(__file__), 'READY_files')
-    GO_file_dir: str =  os.path.join(os.path.dirname(__file__), 'GO_files')
-    STOP_file_dir: str = os.path.join(os.path.dirname(__file__), 'STOP_files')
-
-    # Initialize the directories if they do not exist 
-    for dir_ in (READY_file_dir, GO_file_dir, STOP_file_dir):
-        if(not os.path.exists(dir_)): os.mkdir(dir_)
+    # Open the control channel the controllers will connect to. They find it 
+    # from the pid of this master process, which they are passed
+    control_server: ControlServer = ControlServer(control_socket_path(master_pid), component_controllers.keys())
 
     # Iterate over the other scripts and start them with their associated arguments
     for script, args in component_controllers.items():
@@ -306,47 +295,24 @@ def capture_burst_single_init(info_file: object, component_controllers: list, CP
         args: str = args.replace('--parent_pid X', f'--parent_pid {master_pid}') + f' --starting_chunk_number {burst_num}'
 
         # Launch the subprocess
+        # Launch the subprocess with its part of the CPU plan, 
+        # which it applies to its own threads
         p = subprocess.Popen(args,
                              stdout=sys.stdout,
                              stderr=sys.stderr,
                              text=True,
-                             shell=shell_output)
+                             shell=shell_output,
+                             env=plan_environment(cpu_plan, script))
 
         # Append this process to the list of processes 
         # and its pid to the list of pids
         processes.append(p)
 
-    # Wait for all of the sensors to initialize by waiting for their signals (which wi)
+    # Wait for all of the sensors to initialize by waiting for their READY messages. 
+    # This blocks on the control channel rather than polling
     try:
-        start_wait: float = time.time()
-        last_read: float = time.time()
-        while(True):
-            # If all controllers initialized, proceed    
-            if(all(controllers_ready[controller] is True for controller in controllers_ready)):
-                print('Master Process: All sensors initialized')
-
-                # Clear the READY file dir
-                clear_READY_dir(READY_file_dir, controllers_ready)
-
-                # Break out of initialization while loop
-                break 
-
-            # Capture the current time
-            current_wait: float = time.time()
-
-            # If we waited N seconds without all sensors being ready, throw an error
-            if((current_wait - start_wait) >= sensor_initialization_timeout):
-                raise Exception('ERROR: Master process did not receive enough READY signals by timeout')
-            
-            # Every 2 seconds, output a message
-            if((current_wait - last_read) >= 2):
-                # Monitor the READY dir for incoming signals
-                monitor_READY_dir(READY_file_dir, controllers_ready)
-
-                print(f'Waiting for all controllers to initialize: {controllers_ready}')
-                
-                # Update the last read time
-                last_read = current_wait
+        ready_messages: dict = control_server.wait_for_ready(timeout=sensor_initialization_timeout, burst_num=burst_num)
+        print('Master Process: All sensors initialized')
     
     # Catch and safely handle when the sensors error in their initialization
     except Exception as e:
@@ -354,33 +320,12 @@ def capture_burst_single_init(info_file: object, component_controllers: list, CP
         traceback.print_exc()
         print(e)
         print('Master Process: Did not receive sensors ready signal in time. Exiting...')
+        control_server.close()
         sys.exit(1)
 
-    # Retrieve the pids of the actual process (most recent PID, per my working theory, thus last in sorted list)
-    # for each of the component controllers 
-    pids: dict = {controller: pid 
-                 for controller, pid 
-                 in zip(component_controllers.keys(), [find_pid(key)[-1] 
-                                                      for key in component_controllers.keys()])}
-
-    # Now, we are going to set the priorities and CPU cores 
-    for (controller, pid), (core, priority) in zip(pids.items(), CPU_priorities):
-        print(f'Affixing {controller} | pid: {pid} to CPU core: {core} with priority: {priority}')
-
-        # Turn p into a psutil process so we can set core 
-        # affinity and niceity
-        psutil_process: psutil.Process = psutil.Process(p.pid)
-
-        # Set the cpu affinity (which core this will run on)
-        # as well as its niceity (priority)
-        psutil_process.cpu_affinity([core])
-
-        # Have to include this to define niceity because 
-        # using the psutil_process.nice() command requires sudo 
-        # privelges, which if I run this script with, says my 
-        # libraries don't exist
-        # Also do before change and after to ensure both are top priority
-        os.system(f"sudo renice -n -20 -p {p.pid}")
+    # Record the CPU plan each controller applied to its threads (which it reports
+    # with its first READY message) next to the info file of this run
+    log_cpu_plan(os.path.join(os.path.dirname(info_file.name), 'cpu_plan.json'), master_plan, ready_messages)
 
     # Have all sensors sleep for N seconds 
     time.sleep(sensor_initialization_time)
@@ -396,45 +341,16 @@ def capture_burst_single_init(info_file: object, component_controllers: list, CP
         # Once all sensors are initialized, send a go signal to them
         print(f'Master process: {master_pid} sending GO signals...')
 
-        # Make a file in the GO directory to signify a GO 
-        with open(os.path.join(GO_file_dir, 'GO.txt'), 'w') as f: pass
-
-        # Wait until we have received all of the sensors have finished 
-        # this chunk before saying go to the next one
-        last_read: float = time.time()
-        start_wait: float = time.time()
-        current_wait: float = last_read 
+        # Send GO over the control channel. This schedules the start of the burst 
+        # a short time in the future, which all of the controllers sleep until
+        control_server.broadcast_go(burst_num)
     
         # Wait for the subcontrollers to be ready for the next chunk
         try:
-            while(True):
-                 # If all controllers initialized, proceed    
-                if(all(controllers_ready[controller] is True for controller in controllers_ready)):
-                    print('Master Process: All sensors initialized')
-
-                    # Clear the READY file dir
-                    clear_READY_dir(READY_file_dir, controllers_ready)
-
-                    # Break out of inter-burst while loop
-                    break 
-
-                # If we waited N seconds without all sensors being ready, throw an error
-                if((current_wait - start_wait) >= sensor_initialization_timeout):
-                    raise Exception('ERROR: Master process did not receive enough READY signals by timeout')
-
-                # Capture the current time since we begun waiting
-                current_wait: float = time.time()
-                if((current_wait - last_read) >= 2):
-                    # Monitor the READY dir for READY signals 
-                    monitor_READY_dir(READY_file_dir, controllers_ready)
-
-                    print(f'Master Process: Waiting for sensors to be ready... {controllers_ready}')
-                    
-                    # Update the last read time
-                    last_read = current_wait
-
-        # If we didn't receive enough ready signals, something has gone wrong. Likely, the signal 
-        # just disappeared, but could be other reasons. We are going to safely exit, then begin the program again
+            ready_messages: dict = control_server.wait_for_ready(timeout=burst_seconds + sensor_initialization_timeout, burst_num=burst_num+1)
+
+        # If we didn't receive enough ready signals, something has gone wrong. Likely, a controller 
+        # has died, but could be other reasons. We are going to safely exit, then begin the program again
         except Exception as e:
             traceback.print_exc()
             print(e)
@@ -443,32 +359,22 @@ def capture_burst_single_init(info_file: object, component_controllers: list, CP
             if(isinstance(e, KeyboardInterrupt)):
                 return -1
 
-            # Clear the READY signals
-            clear_READY_dir(READY_file_dir, controllers_ready)
-
-            # Clear the other signals. Less work because we don't need 
-            # to wait on processes or reset the controllers_ready variable to None 
-            for dir_ in (GO_file_dir, STOP_file_dir):
-                for file in os.listdir(dir_):
-                    os.remove(os.path.join(dir_, file))
-
             # Kill the subprocesses (allow for devices to be freed and so on)
-            stop_subprocesses(pids, master_pid, processes, STOP_file_dir)
+            stop_subprocesses(control_server, burst_num, processes)
 
             return burst_num+1
 
         print(f'Master Process: Sensors ready!')
+
+        # Record how closely the controllers started this burst together
+        if(start_offsets_file is not None): log_burst_start(start_offsets_file, burst_num, ready_messages)
         #time.sleep(sensor_initialization_time)
 
         # Increment the burst number 
         burst_num += 1
 
     # Stop the subprocesses
-    stop_subprocesses(pids, master_pid, processes, STOP_file_dir)
-
-    # Clear the signal directories 
-    for dir_ in (READY_file_dir, GO_file_dir, STOP_file_dir):
-        shutil.rmtree(dir_)
+    stop_subprocesses(control_server, burst_num, processes)
 
     return burst_num
 
@@ -504,8 +410,13 @@ def run_control_software():
     experiment_info_file: str = open(os.path.join(experiment_name, 'info_file.csv'), 'a')
     experiment_info_file.write('CHUNK_START,CHUNK_END,CRASH\n')
 
-    # Assign max priority to all processes
-    cores_and_priorities: list = [(process_num, -20) for process_num in range(len(component_controllers))]
+    # Initialize a .csv to track when each sensor actually started each burst
+    # relative to the start time scheduled for all of them 
+    start_offsets_file: object = open(os.path.join(experiment_name, 'burst_start_offsets.csv'), 'a')
+    start_offsets_file.write('BURST,CONTROLLER,START_TIME_NS,START_OFFSET_NS\n')
+
+    # Parse the cores, scheduling and I/O priority to give each controller's threads
+    cpu_plan: dict = parse_cpu_plan(config_path)
 
     # Now, add the burst seconds of capture argument for the controllers we are 
     # using
@@ -532,19 +443,21 @@ def run_control_software():
     while(burst_num_reached < n_bursts):
         print(f"Starting attempt: {attempt}")
 
-        burst_num_reached = capture_burst_single_init(experiment_info_file, component_controllers, cores_and_priorities,
-                                burst_seconds, n_bursts, shell_output=True, burst_num=burst_num_reached)
+        burst_num_reached = capture_burst_single_init(experiment_info_file, component_controllers, cpu_plan,
+                                burst_seconds, n_bursts, shell_output=True, burst_num=burst_num_reached,
+                                start_offsets_file=start_offsets_file)
         
 
-        time.speep(sensor_initialization_time)
+        time.sleep(sensor_initialization_time)
 
         # Exit on keyboard interrupt
         if(burst_num_reached < 0):
             return 
     
 
-    # Close the info file
+    # Close the info files
     experiment_info_file.close()
+    start_offsets_file.close()
 
 
 def main():
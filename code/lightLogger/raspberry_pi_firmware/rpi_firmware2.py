@@ -1,15 +1,13 @@
 """Import public libraries"""
 import numpy as np 
 import multiprocessing as mp 
+from multiprocessing import shared_memory
 import pathlib
 import os
 import sys
-from picamera2 import Picamera2
-import serial
 import time
 import queue
 import collections
-import dill
 
 """Import custom libraries"""
 # First generate the path to the lightLogger dir and Pi utility file
@@ -22,20 +20,52 @@ MS_recorder_path: str = os.path.join(light_logger_dir_path, 'miniSpect')
 pupil_recorder_path: str = os.path.join(light_logger_dir_path, 'pupil')
 
 # Append these paths to the current path
-for path in (world_cam_recorder_path, MS_recorder_path, pupil_recorder_path):
+for path in (world_cam_recorder_path, MS_recorder_path, pupil_recorder_path, pi_util_path):
     sys.path.append(path)
 
 # Import the libraries 
 import world_recorder 
 import MS_recorder
 import pupil_recorder
+import chunk_container
+from control_channel import schedule_start
 
 # Placeholder for testing purposes
 test_filepath: str = "/media/rpiControl/FF5E-7541/bufferTest5_5hz_0NDF"
 
-""""""
+"""Gather a sensor's chunk from the shared memory slot described by the 
+   message it sent, as the fields to write to the chunk container. Sensors 
+   may also send a dict of extra fields (e.g. per-frame timestamps) to store"""
+def read_shared_chunk(name: str, vals: list, shared_buffers: dict) -> dict:
+    # Extract the slot the sensor filled as well as how much of it is valid
+    slot, n_frames, observed_fps, start_time, *extra_fields = vals
+    sensor_buffers: np.ndarray = shared_buffers[name]
+
+    # The MS fills its slot with a flat stream of raw readings, so view them 
+    # as one reading per row, while the cameras fill theirs with frames
+    frames: np.ndarray = sensor_buffers[slot][:n_frames]
+    if(name == 'M'):
+        frames = sensor_buffers[slot][:n_frames * MS_recorder.DATA_LENGTH].reshape(n_frames, MS_recorder.DATA_LENGTH)
+
+    chunk_fields: dict = {'frames': frames, 'num_frames': n_frames, 'fps': observed_fps, 'start_time': start_time}
+    for fields in extra_fields:
+        chunk_fields |= fields
+
+    return chunk_fields
+
+"""Gather the chunks the sensors capture and write them into chunk containers in output_path, 
+   sending GO signals for the next chunk once every sensor is ready. If given a stats_queue, 
+   a dict of how long each chunk took to write is put into it"""
 def write_process(names: tuple, receive_queue: mp.Queue, 
-                 send_queue: mp.Queue, n_chunks: int):
+                 send_queue: mp.Queue, n_chunks: int, 
+                 shared_buffer_specs: dict, output_path: str=test_filepath,
+                 stats_queue: mp.Queue=None):
+    # Attach to the shared memory double buffers each sensor writes its chunks into, 
+    # so that only a short description of each chunk has to pass through the queue
+    shared_buffer_handles: dict = {name: shared_memory.SharedMemory(name=shared_buffer_name)
+                                   for name, (shared_buffer_name, shape, dtype) in shared_buffer_specs.items()}
+    shared_buffers: dict = {name: np.ndarray((2, *shape), dtype=dtype, buffer=shared_buffer_handles[name].buf)
+                            for name, (shared_buffer_name, shape, dtype) in shared_buffer_specs.items()}
 
     # Define a dictionary to hold the chunk information for each sensor
     write_dict: dict = {name[0]: None
@@ -59,6 +89,7 @@ def write_process(names: tuple, receive_queue: mp.Queue,
     # While true, monitor the ready queue
     chunks_completed: int = 0
     chunk_filecounter: int = 0 
+    first_chunk_time: float = None
     waiting_for_values: bool = True
     while(waiting_for_values is True):
             # Retrieve an item from the received data queue
@@ -96,8 +127,9 @@ def write_process(names: tuple, receive_queue: mp.Queue,
                     print(f'Chunks completed: {chunks_completed}/{n_chunks}')
 
                     # Determine whether to send GO or STOP based on if we have captured 
-                    # the desired number of chunks 
-                    signal: bool = True if chunks_completed < n_chunks else False
+                    # the desired number of chunks. A GO is the CLOCK_MONOTONIC time 
+                    # all of the sensors will start the next chunk at
+                    signal: bool | int = schedule_start() if chunks_completed < n_chunks else False
 
                     # Clear the READY dict 
                     for name, state in ready_dict.items():
@@ -120,17 +152,34 @@ def write_process(names: tuple, receive_queue: mp.Queue,
                 # to make sure we are not overwriting any data
                 assert(write_dict[name] is None)
 
-                # Place this sensor's data into the dictionary, 
-                write_dict[name] = vals
+                # Place this sensor's data into the dictionary, read from 
+                # the shared memory slot it just filled. Note when the first 
+                # sensor's part of this chunk arrived
+                write_dict[name] = read_shared_chunk(name, vals, shared_buffers)
+                if(first_chunk_time is None): first_chunk_time = time.time()
 
                 # If all sensors have something to write from a chunk, we are ready to write
                 if(all(value is not None for sensor, value in write_dict.items())):
                     # Generate the path to this file
-                    filepath: str = os.path.join(test_filepath, f"{chunk_filecounter}.pkl")
-
-                    # Dump the object to the file
-                    with open(filepath, 'wb') as f:
-                        dill.dump(write_dict, f, protocol=-1) # -1 for best
+                    filepath: str = os.path.join(output_path, f"{chunk_filecounter}{chunk_container.CHUNK_CONTAINER_EXTENSION}")
+                    write_start_time: float = time.time()
+
+                    # Write the sensors' frames straight from shared memory into the chunk container
+                    chunk_container.write_chunk_container(filepath, write_dict)
+
+                    # Write everything but the frames (e.g. the per-frame means) into a small side-car 
+                    # container next to it, so analyses of the mean signal never have to read the frames
+                    means_filepath: str = os.path.join(output_path, f"{chunk_filecounter}_frameMeans{chunk_container.CHUNK_CONTAINER_EXTENSION}")
+                    chunk_container.write_chunk_container(means_filepath, {sensor: {field: value for field, value in fields.items() if field != 'frames'}
+                                                                           for sensor, fields in write_dict.items()})
+
+                    # Report how long the chunk waited for the other sensors and took to write
+                    write_end_time: float = time.time()
+                    if(stats_queue is not None):
+                        stats_queue.put({'chunk': chunk_filecounter, 'write_s': write_end_time - write_start_time, 
+                                         'latency_s': write_end_time - first_chunk_time, 'bytes': os.path.getsize(filepath),
+                                         'queue_size': receive_queue.qsize()})
+                    first_chunk_time = None
 
                     # Clear the write dict
                     for name in write_dict.keys():
@@ -139,14 +188,19 @@ def write_process(names: tuple, receive_queue: mp.Queue,
                     # Increment the chunk file this is 
                     chunk_filecounter += 1 
 
-def main():
+    # Detach from the shared buffers
+    del shared_buffers
+    for shared_buffer in shared_buffer_handles.values():
+        shared_buffer.close()
+
+"""Allocate the shared buffers, spawn the write process and one recorder process per sensor, 
+   then send the first GO once they have had init_time seconds to initialize. Returns the 
+   processes (write process first) and the shared buffers, to be passed to finish_capture"""
+def start_capture(n_bursts: int, burst_duration: int, output_path: str=test_filepath,
+                  recorders: tuple=None, stats_queue: mp.Queue=None, init_time: float=2) -> tuple:
     # Initailize a list to hold process objects and wait for their execution to finish
     processes: list = []
 
-    # Define the number of recording bursts and duration (s) of a recording burst 
-    n_bursts: int = 6 * 20 # 2 minutes
-    burst_duration: int = 10
-
     # Initialize a multiprocessing-safe queue to store data 
     # from the sensors
     receive_data_queue: mp.Queue = mp.Queue()
@@ -161,17 +215,30 @@ def main():
     # Initialize tuples of names for the processes we will use
     names: tuple = ('Output', 'World', 'MS', 'Pupil') #'MS', 'Pupil')
 
-    # Define the recorders used by the processes as well as their respective arguments
-    recorders: tuple = (write_process, world_recorder.lean_capture, MS_recorder.lean_capture, pupil_recorder.lean_capture) #MS_recorder.lean_capture, pupil_recorder.lean_capture)
-    process_args: tuple = tuple([ (names[1:], receive_data_queue, send_data_queue, n_bursts) ] + [ (receive_data_queue, send_data_queue, burst_duration, world_queue) for i in range(len(names[1:])) ])
+    # Define the recorders used by the processes 
+    if(recorders is None): recorders = (world_recorder.lean_capture, MS_recorder.lean_capture, pupil_recorder.lean_capture) #MS_recorder.lean_capture, pupil_recorder.lean_capture)
+    recorders = (write_process, *recorders)
+    
+    # Allocate a shared memory double buffer for each sensor to write its chunks into. 
+    # The sensors and the write process attach to these by name, so the chunks 
+    # themselves are never pickled through the queue
+    buffer_specs: tuple = (world_recorder.lean_buffer_spec(burst_duration), MS_recorder.lean_buffer_spec(burst_duration), pupil_recorder.lean_buffer_spec(burst_duration))
+    shared_buffers: list = []
+    shared_buffer_specs: dict = {}
+    for name, (shape, dtype) in zip(names[1:], buffer_specs):
+        shared_buffer: shared_memory.SharedMemory = shared_memory.SharedMemory(create=True, size=2 * int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        shared_buffers.append(shared_buffer)
+        shared_buffer_specs[name[0]] = (shared_buffer.name, shape, dtype)
+
+    # Define the arguments of the processes
+    process_args: tuple = tuple([ (names[1:], receive_data_queue, send_data_queue, n_bursts, shared_buffer_specs, output_path, stats_queue) ] + [ (receive_data_queue, send_data_queue, burst_duration, world_queue, shared_buffer.name) for shared_buffer in shared_buffers ])
 
     # Generate the process objects
-    start_time: float = time.time()
     for p_num, (name, recorder, args) in enumerate(zip(names, recorders, process_args)):
         print(f'Beginning process: {name}')
 
         # Spawn the recorder process (not yet started)
-        process: mp.Process = mp.Process(target=recorder, args=(*args,))    
+        process: mp.Process = mp.Process(target=recorder, args=(*args,), name=name)    
 
         # Append this process object to the list 
         processes.append(process)
@@ -179,15 +246,35 @@ def main():
         # Start the process 
         process.start()
 
-    # Sleep for 2 seconds to allow for initialization, then send GO signals 
-    # for the first time
-    time.sleep(2)
-    for _ in range(len(names[1:]) - 1): send_data_queue.put(True)
+    # Sleep to allow for initialization, then send GO signals 
+    # for the first time, scheduling all of the sensors to start together
+    time.sleep(init_time)
+    start_time_ns: int = schedule_start()
+    for _ in range(len(names[1:]) - 1): send_data_queue.put(start_time_ns)
 
+    return processes, shared_buffers, receive_data_queue
+
+"""Wait for the processes of a capture to finish, then free its shared buffers"""
+def finish_capture(processes: list, shared_buffers: list) -> None:
     # Wait for the processes to finish 
     for process in processes:
         process.join()
 
+    # Free the shared buffers 
+    for shared_buffer in shared_buffers:
+        shared_buffer.close()
+        shared_buffer.unlink()
+
+def main():
+    # Define the number of recording bursts and duration (s) of a recording burst 
+    n_bursts: int = 6 * 20 # 2 minutes
+    burst_duration: int = 10
+
+    # Capture the bursts and wait for them to finish
+    start_time: float = time.time()
+    processes, shared_buffers, _ = start_capture(n_bursts, burst_duration)
+    finish_capture(processes, shared_buffers)
+
     end_time: float = time.time()
 
     elapsed_time: float = end_time - start_time
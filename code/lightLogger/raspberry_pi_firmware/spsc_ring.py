@@ -0,0 +1,212 @@
+import threading
+import queue
+import argparse
+import time
+
+# The number of items a write ring holds before the capture thread starts dropping them
+DEFAULT_CAPACITY: int = 1024
+
+# The shortest and longest time in seconds the consumer sleeps while waiting for an item.
+# The writers are not latency sensitive, so they back off rather than spin
+MIN_POLL_INTERVAL: float = 50e-6
+MAX_POLL_INTERVAL: float = 0.005
+
+# The interval in seconds at which a ring's counters are sampled and reported
+MONITOR_INTERVAL: float = 5
+
+"""A bounded single producer, single consumer ring over preallocated slots, used to hand
+   items from a capture thread to its writer thread in place of a queue.Queue. The producer
+   only ever writes the tail and the consumer only ever writes the head, so neither side takes
+   a lock: an item is stored in its slot before the tail is advanced past it, and the GIL makes
+   each of those stores atomic. The producer never blocks. If the ring is full, the item is
+   dropped and counted as an overflow. The producer closes the ring when it is done, and once
+   the consumer has drained it, get returns None, as the None sentinel on a queue did"""
+class SPSCRing:
+    def __init__(self, capacity: int=DEFAULT_CAPACITY):
+        self.capacity: int = capacity
+        self.slots: list = [None] * capacity
+
+        # The total number of items enqueued (written only by the producer)
+        # and dequeued (written only by the consumer)
+        self.tail: int = 0
+        self.head: int = 0
+        self.closed: bool = False
+
+        # Counters for monitoring, written only by the producer
+        self.overflows: int = 0
+        self.high_water: int = 0
+
+    """Enqueue an item. Returns whether there was room for it"""
+    def put(self, item: object) -> bool:
+        tail: int = self.tail
+        depth: int = tail - self.head
+        if(depth >= self.capacity):
+            self.overflows += 1
+            return False
+
+        # Store the item before publishing it by advancing the tail
+        self.slots[tail % self.capacity] = item
+        self.tail = tail + 1
+        if(depth + 1 > self.high_water): self.high_water = depth + 1
+
+        return True
+
+    """Enqueue as many of a list of items as there is room for at once, counting the rest
+       as overflows. Returns the number enqueued"""
+    def put_batch(self, items: list) -> int:
+        tail: int = self.tail
+        depth: int = tail - self.head
+        n_items: int = min(len(items), self.capacity - depth)
+        self.overflows += len(items) - n_items
+        if(n_items == 0): return 0
+
+        # Copy the items into their slots in at most two pieces, as they may wrap around the end
+        start: int = tail % self.capacity
+        first_piece: int = min(n_items, self.capacity - start)
+        self.slots[start:start + first_piece] = items[:first_piece]
+        self.slots[:n_items - first_piece] = items[first_piece:n_items]
+
+        self.tail = tail + n_items
+        if(depth + n_items > self.high_water): self.high_water = depth + n_items
+
+        return n_items
+
+    """Signal the consumer that no more items will be enqueued"""
+    def close(self) -> None:
+        self.closed = True
+
+    """Wait until there is an item to dequeue. Returns whether there is one
+       (False once the ring is closed and drained)"""
+    def wait(self) -> bool:
+        poll_interval: float = MIN_POLL_INTERVAL
+        while(True):
+            # Check whether the ring was closed before checking for items, as every
+            # item enqueued before it was closed is then already visible
+            closed: bool = self.closed
+            if(self.head != self.tail): return True
+            if(closed): return False
+
+            time.sleep(poll_interval)
+            poll_interval = min(2 * poll_interval, MAX_POLL_INTERVAL)
+
+    """Dequeue the next item, waiting for one if the ring is empty.
+       Returns None once the ring is closed and drained"""
+    def get(self) -> object:
+        if(not self.wait()): return None
+
+        # Take the item and free its slot (so the ring does not keep it alive),
+        # then hand the slot back to the producer by advancing the head
+        head: int = self.head
+        item: object = self.slots[head % self.capacity]
+        self.slots[head % self.capacity] = None
+        self.head = head + 1
+
+        return item
+
+    """Dequeue every item waiting (up to max_items) at once, waiting for at least one if
+       the ring is empty. Returns an empty list once the ring is closed and drained"""
+    def get_batch(self, max_items: int=None) -> list:
+        if(not self.wait()): return []
+
+        head: int = self.head
+        n_items: int = self.tail - head
+        if(max_items is not None): n_items = min(n_items, max_items)
+
+        # Take the items in at most two pieces, as they may wrap around the end
+        start: int = head % self.capacity
+        first_piece: int = min(n_items, self.capacity - start)
+        items: list = self.slots[start:start + first_piece] + self.slots[:n_items - first_piece]
+        self.slots[start:start + first_piece] = [None] * first_piece
+        self.slots[:n_items - first_piece] = [None] * (n_items - first_piece)
+
+        self.head = head + n_items
+
+        return items
+
+    """Return the number of items waiting to be dequeued"""
+    def qsize(self) -> int:
+        return self.tail - self.head
+
+    """Return a snapshot of the ring's counters"""
+    def stats(self) -> dict:
+        tail, head = self.tail, self.head
+
+        return {'depth': tail - head, 'high_water': self.high_water, 'enqueued': tail,
+                'dequeued': head, 'overflows': self.overflows}
+
+"""Periodically samples the counters of a ring and reports them, so the capture
+   and writer threads never have to print the state of the ring themselves"""
+class RingMonitor(threading.Thread):
+    def __init__(self, ring: SPSCRing, name: str, interval: float=MONITOR_INTERVAL):
+        super().__init__(daemon=True)
+        self.ring: SPSCRing = ring
+        self.name: str = name
+        self.interval: float = interval
+        self.stop_event: threading.Event = threading.Event()
+
+    """Report the counters of the ring"""
+    def report(self) -> None:
+        stats: dict = self.ring.stats()
+        print(f"{self.name} queue | Depth: {stats['depth']} | High water: {stats['high_water']}/{self.ring.capacity} | Written: {stats['dequeued']} | Overflows: {stats['overflows']}")
+
+    def run(self) -> None:
+        while(not self.stop_event.wait(self.interval)):
+            self.report()
+
+    """Stop monitoring, reporting the final counters"""
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.join()
+        self.report()
+
+"""Parse arguments from the command line"""
+def parse_args() -> tuple:
+    parser = argparse.ArgumentParser(description='Time handing items from a producer thread to a consumer thread through a ring and through a queue.Queue')
+
+    parser.add_argument('--n_items', type=int, default=200000, help='The number of items to hand off')
+    parser.add_argument('--batch_size', type=int, default=1, help='The number of items the producer enqueues at once')
+
+    args = parser.parse_args()
+
+    return args.n_items, args.batch_size
+
+"""Main used for testing purposes. Hands items off through a ring and a queue.Queue,
+   checking every item arrives in order and timing both"""
+def main():
+    n_items, batch_size = parse_args()
+
+    # Hand the items off through a ring large enough to never overflow
+    ring: SPSCRing = SPSCRing(n_items)
+    received: list = []
+    consumer: threading.Thread = threading.Thread(target=lambda: [received.extend(batch) for batch in iter(ring.get_batch, [])])
+    start_time: float = time.time()
+    consumer.start()
+    for start in range(0, n_items, batch_size):
+        ring.put_batch(list(range(start, min(start + batch_size, n_items))))
+    ring.close()
+    consumer.join()
+    print(f'SPSCRing: handed off {n_items} items in {time.time() - start_time:.3f} seconds | {ring.stats()}')
+    assert(received == list(range(n_items)))
+
+    # Hand the items off through a queue, one at a time
+    write_queue: queue.Queue = queue.Queue()
+    received = []
+    consumer = threading.Thread(target=lambda: [received.append(item) for item in iter(write_queue.get, None)])
+    start_time = time.time()
+    consumer.start()
+    for item in range(n_items):
+        write_queue.put(item)
+    write_queue.put(None)
+    consumer.join()
+    print(f'queue.Queue: handed off {n_items} items in {time.time() - start_time:.3f} seconds')
+    assert(received == list(range(n_items)))
+
+    # Check that a full ring drops and counts the overflow rather than blocking
+    ring = SPSCRing(4)
+    assert(ring.put_batch(list(range(6))) == 4 and ring.stats()['overflows'] == 2)
+    assert(ring.put(6) is False and ring.get_batch() == [0, 1, 2, 3])
+    ring.close()
+    assert(ring.get() is None)
+
+if(__name__ == '__main__'):
+    main()
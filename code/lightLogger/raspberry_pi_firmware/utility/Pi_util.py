@@ -9,6 +9,9 @@ import ctypes
 import pandas as pd
 import cv2
 import json
+import weakref
+import collections
+import concurrent.futures
 
 # Import the MS utility library 
 light_logger_dir_path: str = str(pathlib.Path(__file__).parents[2]) 
@@ -16,8 +19,50 @@ MS_recorder_path: str = os.path.join(light_logger_dir_path, 'miniSpect')
 sys.path.append(MS_recorder_path)
 import MS_util
 
-"""Parse an entire recording captured with the C++ implementation of RPI firmware"""
-def parse_chunks_binary(recording_dir_path: str, use_mean_frame: bool=False, start_chunk: int=0, end_chunk: int=None) -> list:
+# Import the chunk container library from alongside this file
+sys.path.append(os.path.dirname(__file__))
+import chunk_container
+
+"""Apply a chunk parser to each of the chunk paths, yielding the parsed chunks in order. 
+   If workers > 1, the chunks are fanned out to a pool of that many processes, and each 
+   parsed chunk is yielded as soon as it and all of the chunks before it are finished. Only 
+   a few chunks per worker are in flight at once, so streaming a long recording does not 
+   hold all of it in memory"""
+def map_chunks(chunk_parser: callable, chunk_paths: list, workers: int=1, *args):
+    # If we only have one worker, simply parse the chunks in this process
+    if(workers <= 1):
+        for chunk_path in chunk_paths:
+            yield chunk_parser(chunk_path, *args)
+
+        return 
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # Keep the chunks submitted to the pool in order, yielding the oldest 
+        # once enough are in flight to keep the workers busy
+        pending: collections.deque = collections.deque()
+        for chunk_path in chunk_paths:
+            pending.append(executor.submit(chunk_parser, chunk_path, *args))
+
+            if(len(pending) >= 2 * workers):
+                yield pending.popleft().result()
+
+        # Yield the remaining chunks 
+        while(len(pending) > 0):
+            yield pending.popleft().result()
+
+"""Parse an entire recording captured with the C++ implementation of RPI firmware.
+   If workers > 1, the chunks are parsed by a pool of that many processes. If sensors 
+   is given, only those sensors are decoded (e.g. ('W',) never decodes the pupil frames)"""
+def parse_chunks_binary(recording_dir_path: str, use_mean_frame: bool=False, start_chunk: int=0, end_chunk: int=None,
+                        workers: int=1, sensors: tuple=None) -> list:
+    performance_json, chunks = iter_chunks_binary(recording_dir_path, use_mean_frame, start_chunk, end_chunk, workers, sensors)
+
+    return {"performance_dict": performance_json, 'chunks': list(chunks)}
+
+"""Stream the chunks of a recording captured with the C++ implementation of RPI firmware.
+   Returns the performance data as well as a generator of the parsed chunks, in order"""
+def iter_chunks_binary(recording_dir_path: str, use_mean_frame: bool=False, start_chunk: int=0, end_chunk: int=None,
+                       workers: int=1, sensors: tuple=None) -> tuple:
     # First, let's find all of the chunks in sorted order
     chunk_filepaths: list = [os.path.join(recording_dir_path, file)
                             for file in natsorted(os.listdir(recording_dir_path))
@@ -33,30 +78,106 @@ def parse_chunks_binary(recording_dir_path: str, use_mean_frame: bool=False, sta
         # read in as unsigned int 
         performance_json['controller_names'] = [chr(name) for name in performance_json['controller_names']]
 
-    # Now, let's read in all of the chunks
-    chunks: list = [parse_chunk_binary(chunk_path, performance_json, use_mean_frame=use_mean_frame)
-                    for chunk_path in chunk_filepaths]
+    # Now, let's read in all of the chunks as they are needed
+    chunks = map_chunks(parse_chunk_binary, chunk_filepaths, workers, performance_json, use_mean_frame, sensors)
+
+    return performance_json, chunks
+
+"""Define the return type of the CPP deserialization function"""
+class chunk_struct(ctypes.Structure):
+    _fields_ = [
+        ("M", ctypes.POINTER(ctypes.c_uint8)),
+        ("W", ctypes.POINTER(ctypes.c_uint8)),
+        ("P", ctypes.POINTER(ctypes.c_uint8)),
+        ("S", ctypes.POINTER(ctypes.c_uint8)),
+        ("M_size",ctypes.c_int64),
+        ("W_size", ctypes.c_int64),
+        ("P_size", ctypes.c_int64),
+        ("S_size", ctypes.c_int64),
+        ("buffers", ctypes.c_void_p), # Opaque pointer to the CPP vectors that own the sensors' buffers
+    ]
+
+# The CPP deserialization library, loaded once on first use 
+chunk_parser_lib: ctypes.CDLL = None
+
+"""Import the CPP deserialization library, loading it only the 
+   first time it is needed"""
+def import_chunk_parser_lib() -> ctypes.CDLL:
+    global chunk_parser_lib
+
+    # If we have already loaded the library, simply return it
+    if(chunk_parser_lib is not None):
+        return chunk_parser_lib
 
-    return {"performance_dict": performance_json, 'chunks': chunks}
-
-"""Parse an individual chunk that was captured with the C++ implementation of RPI firmware"""
-def parse_chunk_binary(chunk_path: str, performance_json: dict, use_mean_frame: bool=False) -> dict:
     # Load in the CPP deserialization library
     cpp_parser_lib = ctypes.CDLL(os.path.join(os.path.dirname(__file__), "parse_chunk_binary.so"))
 
-    # Define the return type of the CPP deserialization function
-    class chunk_struct(ctypes.Structure):
-        _fields_ = [
-            ("M", ctypes.POINTER(ctypes.c_uint8)),
-            ("W", ctypes.POINTER(ctypes.c_uint8)),
-            ("P", ctypes.POINTER(ctypes.c_uint8)),
-            ("S", ctypes.POINTER(ctypes.c_uint8)),
-            ("M_size",ctypes.c_uint64),
-            ("W_size", ctypes.c_uint64),
-            ("P_size", ctypes.c_uint64),
-            ("S_size", ctypes.c_uint64),
-        ]
+    # Define argument and return type for the CPP deserialization function
+    cpp_parser_lib.parse_chunk_binary.argtypes = [ctypes.c_char_p]
+    cpp_parser_lib.parse_chunk_binary.restype = ctypes.POINTER(chunk_struct)
+
+    # Define the argument type for free_chunk_struct
+    cpp_parser_lib.free_chunk_struct.argtypes = [ctypes.POINTER(chunk_struct)]
+    cpp_parser_lib.free_chunk_struct.restype = None
+
+    chunk_parser_lib = cpp_parser_lib
+
+    return chunk_parser_lib
+
+"""A chunk deserialized by the CPP library. Its buffers are np.ndarray views of the CPP 
+   memory, with no copies made. The CPP memory is freed once both the chunk is closed 
+   (or its with block exits) and no views of its buffers remain"""
+class BinaryChunk:
+    def __init__(self, chunk_path: str):
+        lib: ctypes.CDLL = import_chunk_parser_lib()
+
+        # Deserialize the chunk using CPP
+        chunk_ptr: ctypes.POINTER(chunk_struct) = lib.parse_chunk_binary(chunk_path.encode('utf-8'))
+        chunk: chunk_struct = chunk_ptr.contents
+
+        # Free the chunk when the last object referencing its memory is garbage collected. 
+        # Every view of the buffers below keeps this owner alive through its base
+        owner: ctypes.c_void_p = ctypes.c_void_p(chunk.buffers)
+        weakref.finalize(owner, lib.free_chunk_struct, chunk_ptr)
+
+        # Let's splice out only the fields with sensor values and their buffer sizes 
+        sensor_fields_and_sizes: dict = {field.split('_')[0]: getattr(chunk, field)  
+                                         for (field, _) 
+                                         in chunk._fields_
+                                         if '_size' in field} # Retrieve the sensor name by splicing out the _size portion of the name which is like M_size
+        
+        # Ensure that the CPP executed without error
+        if(any(buffer_size == -1 for sensor, buffer_size in sensor_fields_and_sizes.items())):   # Error code: -1 means that the file does not exist
+            raise FileNotFoundError(f'ERROR: Chunk file does not exist: {chunk_path}')
+        if(any(buffer_size == -2 for sensor, buffer_size in sensor_fields_and_sizes.items())):   # Error code -2 means that the file could not be opened
+            raise IOError(f'ERROR: Could not open chunk file: {chunk_path}')
+
+        # Now, we will iterate over the fields and view them as numpy arrays
+        self.buffers: dict = {}
+        for sensor_field, buffer_size in sensor_fields_and_sizes.items():
+            # Empty vectors may not have any memory to point to
+            if(buffer_size == 0):
+                self.buffers[sensor_field] = np.empty((0,), dtype=np.uint8)
+                continue
+
+            # View the CPP memory as a ctypes array that keeps the owner alive, then as a numpy array
+            buffer_as_ctypes = (ctypes.c_uint8 * buffer_size).from_address(ctypes.addressof(getattr(chunk, sensor_field).contents))
+            buffer_as_ctypes._owner = owner
+            self.buffers[sensor_field] = np.frombuffer(buffer_as_ctypes, dtype=np.uint8)
+
+    """Drop this chunk's references to the buffers, freeing the CPP memory 
+       if there are no other views of it"""
+    def close(self) -> None:
+        self.buffers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
 
+"""Parse an individual chunk that was captured with the C++ implementation of RPI firmware"""
+def parse_chunk_binary(chunk_path: str, performance_json: dict, use_mean_frame: bool=False, sensors: tuple=None) -> dict:
     """Define the parser for the MS bytes for a given chunk"""
     def ms_parser(buffer: np.ndarray) -> tuple:
         # First, we will convert the numpy bytes arr to Python bytes arr 
@@ -161,69 +282,319 @@ def parse_chunk_binary(chunk_path: str, performance_json: dict, use_mean_frame:
 
         return buffer.view(np.uint16)
 
-        
-    # Define argument and return type for the CPP deserialization function
-    cpp_parser_lib.parse_chunk_binary.argtypes = [ctypes.c_char_p]
-    cpp_parser_lib.parse_chunk_binary.restype = ctypes.POINTER(chunk_struct)
-
-    # Define the argument type for free_chunk_struct
-    cpp_parser_lib.free_chunk_struct.argtypes = [ctypes.POINTER(chunk_struct)]
-    cpp_parser_lib.free_chunk_struct.restype = None
 
     # Define the set of parsers for each sensor
     parsers: dict = {'M': ms_parser, 'W': world_parser,
                      'P': pupil_parser, 'S': sunglasses_parser}
 
-    """Helper function to parse chunks. Passes the path to CPP,
-       executes, and reads in the deserialized data as np.arrays.
-       Returns both the parsed chunk as a dictionary as well as its 
-       CPP memory pointer to free. """
-    def parse_chunk(path: str) -> tuple:
-        # Initialize a container to hold return values 
-        chunk_dict: dict = {}
+    # Deserialize the binary file via CPP and parse each sensor's buffer, which is 
+    # viewed directly in the CPP memory. That memory is freed once the chunk is closed 
+    # and no parsed value still views it
+    chunk_dict: dict = {}
+    with BinaryChunk(chunk_path) as chunk:
+        for sensor_field, buffer_as_np in chunk.buffers.items():
+            # Skip the sensors we do not want to decode
+            if(sensors is not None and sensor_field not in sensors): continue
 
-        # Convert the Python string path to a chunk binary file
-        # into a bytes object (C-compatible string)
-        c_path: bytes = path.encode('utf-8')
+            chunk_dict[sensor_field] = parsers[sensor_field](buffer_as_np)
 
-        # Deserialize the chunk using CPP
-        chunk_ptr: ctypes.POINTER(chunk_struct) = cpp_parser_lib.parse_chunk_binary(c_path)
-        chunk: chunk_struct = chunk_ptr.contents
+    return chunk_dict
 
-        # Let's splice out only the fields with sensor values and their buffer sizes 
-        sensor_fields_and_sizes: list = {field.split('_')[0]: getattr(chunk, field)  
-                                        for (field, _) 
-                                        in chunk._fields_
-                                        if '_size' in field} # Retrieve the sensor name by splicing out the _size portion of the name which is like M_size
-        
-        # Assert that the CPP executed without error
-        assert(all(buffer_size != -1 for sensor, buffer_size in sensor_fields_and_sizes.items()))   # Error code: -1 means that the file does not exist
-        assert(all(buffer_size != -2 for sensor, buffer_size in sensor_fields_and_sizes.items()))   # Error code -2 means that the file could not be opened
+# Define the order in which the CPP firmware serializes the sensors' buffers in a chunk
+CHUNK_BINARY_SENSOR_ORDER: tuple = ('M', 'W', 'P', 'S')
+
+"""Find where each sensor's buffer lies inside a chunk captured with the CPP 
+   implementation of RPI firmware, without reading the buffers themselves. 
+   The chunks are a cereal binary archive of a vector of byte vectors, which is 
+   a uint64 count followed by a uint64 size and the raw bytes of each vector. 
+   Returns a dict of sensor name -> (offset, size) in bytes"""
+def index_chunk_binary(chunk_path: str) -> dict:
+    # Initialize a container for the locations of the buffers 
+    chunk_index: dict = {}
+
+    with open(chunk_path, 'rb') as f:
+        # Read the number of buffers in the chunk
+        num_buffers: int = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        assert(num_buffers == len(CHUNK_BINARY_SENSOR_ORDER))
+
+        # Read the size of each buffer, note where it starts, then skip over it 
+        for sensor in CHUNK_BINARY_SENSOR_ORDER:
+            buffer_size: int = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            chunk_index[sensor] = (f.tell(), buffer_size)
+            f.seek(buffer_size, os.SEEK_CUR)
+
+    return chunk_index
+
+"""Memory map a buffer of a chunk as a flat array of bytes"""
+def map_chunk_buffer(chunk_path: str, offset: int, size: int) -> np.ndarray:
+    # Empty buffers cannot be memory mapped, so simply create them
+    if(size == 0):
+        return np.empty((0,), dtype=np.uint8)
+
+    return np.memmap(chunk_path, dtype=np.uint8, mode='r', offset=offset, shape=(size,))
+
+"""A sensor's readings across all of the chunks of a recording, which can be indexed
+   like one long array of frames (e.g. sensor[frame], sensor[start:end], sensor[[frames]]).
+   Only the chunks an index touches are decoded, and only the most recently decoded
+   chunk is kept, so iterating over a recording takes constant memory"""
+class LazySensor:
+    def __init__(self, chunk_readers: list, chunk_length_readers: list):
+        # Functions to decode each chunk into an array of frames, and to 
+        # find the number of frames in each chunk
+        self.chunk_readers: list = chunk_readers
+        self.chunk_length_readers: list = chunk_length_readers
+
+        # The offset of each chunk's first frame, found on first use 
+        self._chunk_starts: np.ndarray = None
+
+        # The most recently decoded chunk
+        self._cached_chunk_num: int = None
+        self._cached_chunk: np.ndarray = None
+
+    """Return the offset of the first frame of each chunk, and the total number of frames, last"""
+    def chunk_starts(self) -> np.ndarray:
+        if(self._chunk_starts is None):
+            chunk_lengths: list = [length_reader() for length_reader in self.chunk_length_readers]
+            self._chunk_starts = np.concatenate(([0], np.cumsum(chunk_lengths, dtype=np.int64)))
+
+        return self._chunk_starts
+
+    """Return the number of chunks the sensor's readings are split across"""
+    def num_chunks(self) -> int:
+        return len(self.chunk_readers)
+
+    """Return the decoded frames of a single chunk"""
+    def chunk(self, chunk_num: int) -> np.ndarray:
+        if(chunk_num != self._cached_chunk_num):
+            self._cached_chunk = self.chunk_readers[chunk_num]()
+            self._cached_chunk_num = chunk_num
+
+        return self._cached_chunk
+
+    """Iterate over the decoded frames one chunk at a time"""
+    def iter_chunks(self):
+        for chunk_num in range(self.num_chunks()):
+            yield self.chunk(chunk_num)
+
+    def __len__(self) -> int:
+        return int(self.chunk_starts()[-1])
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def __getitem__(self, key: int | slice | list | np.ndarray) -> np.ndarray:
+        chunk_starts: np.ndarray = self.chunk_starts()
+
+        # A single frame only needs the chunk it is in
+        if(isinstance(key, (int, np.integer))):
+            frame: int = int(key) + len(self) if key < 0 else int(key)
+            if(frame < 0 or frame >= len(self)):
+                raise IndexError(f'ERROR: Frame {key} out of range for sensor with {len(self)} frames')
+
+            chunk_num: int = int(np.searchsorted(chunk_starts, frame, side='right')) - 1
+            return self.chunk(chunk_num)[frame - chunk_starts[chunk_num]]
+
+        # Otherwise, find the frames we are indexing and group them by the chunks they are in
+        frames: np.ndarray = np.arange(len(self))[key] if isinstance(key, slice) else np.asarray(key, dtype=np.int64)
+        frames = np.where(frames < 0, frames + len(self), frames)
+        if(np.any((frames < 0) | (frames >= len(self)))):
+            raise IndexError(f'ERROR: Frames out of range for sensor with {len(self)} frames')
+
+        chunk_nums: np.ndarray = np.searchsorted(chunk_starts, frames, side='right') - 1
+
+        # Split the frames into runs from the same chunk, preserving their order
+        run_starts: np.ndarray = np.flatnonzero(np.diff(chunk_nums, prepend=-1))
+        runs: list = np.split(np.arange(len(frames)), run_starts[1:])
+
+        # Decode only the chunks we need and gather the frames from each 
+        parts: list = [self.chunk(int(chunk_nums[run[0]]))[frames[run] - chunk_starts[chunk_nums[run[0]]]]
+                       for run in runs
+                       if len(run) > 0]
+
+        # If we did not index any frames, return an empty array of the right shape
+        if(len(parts) == 0):
+            return self.chunk(0)[:0] if self.num_chunks() > 0 else np.empty((0,))
+
+        return np.concatenate(parts)
+
+"""The readings of the MS across a recording, with each of its channels 
+   accessible as a LazySensor (e.g. ms.AS[t0:t1])"""
+class LazyMS:
+    def __init__(self, readings: LazySensor):
+        # The raw readings, one row of bytes per reading
+        self.readings: LazySensor = readings
+
+        # Each channel is a view of its field within the readings
+        for channel in MS_util.MS_READING_DTYPE.names:
+            channel_readers: list = [lambda chunk_num=chunk_num, channel=channel: readings.chunk(chunk_num).reshape(-1).view(MS_util.MS_READING_DTYPE)[channel]
+                                     for chunk_num in range(readings.num_chunks())]
+            setattr(self, channel, LazySensor(channel_readers, readings.chunk_length_readers))
+
+    def __len__(self) -> int:
+        return len(self.readings)
+
+"""A recording captured with the CPP implementation of RPI firmware, opened lazily. 
+   Opening only indexes where each sensor's buffer lies in each chunk file. The 
+   frames are memory mapped (World, MS, Sunglasses) or decoded (Pupil) only 
+   once they are indexed, e.g. rec.world[frames] or rec.ms.AS[t0:t1]"""
+class Recording:
+    def __init__(self, recording_dir_path: str, start_chunk: int=0, end_chunk: int=None):
+        # First, let's find all of the chunks in sorted order
+        self.chunk_paths: list = [os.path.join(recording_dir_path, file)
+                                  for file in natsorted(os.listdir(recording_dir_path))
+                                  if 'chunk' in file][start_chunk:end_chunk]
+
+        # Load in the performance data
+        with open(os.path.join(recording_dir_path, 'performance.json'), 'r') as f:
+            self.performance_dict: dict = json.load(f)
+
+            # Need to re-interpret the controller names as char, as they are by default 
+            # read in as unsigned int 
+            self.performance_dict['controller_names'] = [chr(name) for name in self.performance_dict['controller_names']]
+
+        # Find where each sensor's buffer lies in each chunk
+        self.chunk_indices: list = [index_chunk_binary(chunk_path) for chunk_path in self.chunk_paths]
+
+        # Retrieve the shape of an individual reading of the World and MS
+        world_frame_shape: tuple = tuple(self.sensor_size('W'))
+        ms_reading_length: int = self.sensor_size('M')[0]
+
+        # Build the sensors from how to decode each chunk's buffer, and how to count its frames
+        self.world: LazySensor = self.build_sensor('W', lambda buffer: buffer.view(np.uint16).reshape(-1, *world_frame_shape),
+                                                        lambda size: size // (2 * int(np.prod(world_frame_shape))))
+        self.ms: LazyMS = LazyMS(self.build_sensor('M', lambda buffer: buffer.reshape(-1, ms_reading_length),
+                                                        lambda size: size // ms_reading_length))
+        self.sunglasses: LazySensor = self.build_sensor('S', lambda buffer: buffer.view(np.uint16),
+                                                             lambda size: size // 2)
+
+        # The Pupil frames are MJPEG compressed, so they must be decoded and 
+        # their number found by walking the markers of the images
+        pupil_frame_shape: tuple = tuple(self.sensor_size('P'))
+        self.pupil: LazySensor = LazySensor([lambda chunk_num=chunk_num: decode_mjpeg_buffer(self.map_buffer(chunk_num, 'P'), pupil_frame_shape)
+                                             for chunk_num in range(len(self))],
+                                            [lambda chunk_num=chunk_num: len(find_mjpeg_frames(self.map_buffer(chunk_num, 'P').tobytes()))
+                                             for chunk_num in range(len(self))])
+
+    """Return the size of an individual reading of a sensor from the performance data"""
+    def sensor_size(self, sensor: str) -> list:
+        return self.performance_dict['sensor_size_settings'][self.performance_dict['controller_names'].index(sensor)]
+
+    """Memory map a sensor's buffer within a chunk"""
+    def map_buffer(self, chunk_num: int, sensor: str) -> np.ndarray:
+        return map_chunk_buffer(self.chunk_paths[chunk_num], *self.chunk_indices[chunk_num][sensor])
+
+    """Build a LazySensor over the memory mapped buffers of a sensor"""
+    def build_sensor(self, sensor: str, decoder: callable, length_from_size: callable) -> LazySensor:
+        return LazySensor([lambda chunk_num=chunk_num: decoder(self.map_buffer(chunk_num, sensor))
+                           for chunk_num in range(len(self))],
+                          [lambda chunk_num=chunk_num: length_from_size(self.chunk_indices[chunk_num][sensor][1])
+                           for chunk_num in range(len(self))])
+
+    """Return the number of chunks in the recording"""
+    def __len__(self) -> int:
+        return len(self.chunk_paths)
+
+"""Open a recording captured with the C++ implementation of RPI firmware 
+   lazily, without reading any of its frames"""
+def open_recording(recording_dir_path: str, start_chunk: int=0, end_chunk: int=None) -> Recording:
+    return Recording(recording_dir_path, start_chunk, end_chunk)
+
+# The markers of a JPEG image that stand alone, without a length and payload after them
+# (TEM, RST0-7, SOI and EOI)
+JPEG_STANDALONE_MARKERS: frozenset = frozenset([0x01, *range(0xD0, 0xD8), 0xD8, 0xD9])
+
+"""Find the (start, end) byte offsets of each MJPEG compressed image in a buffer. The
+   start and end of image markers (FFD8/FFD9) can also appear inside an image, e.g. in 
+   an embedded thumbnail, so rather than searching for them, each image is walked 
+   marker by marker: segments are skipped by their length, and the entropy coded data 
+   after a start of scan is skipped up to the first marker that is not a stuffed byte 
+   (FF00) or a restart marker. Each image then ends at its own end of image marker, 
+   and the next image is searched for from there"""
+def find_mjpeg_frames(buffer_as_bytes: bytes) -> list:
+    frames: list = []
+
+    start: int = buffer_as_bytes.find(b'\xFF\xD8')
+    while(start != -1):
+        # Walk the segments after the start of image marker until the end of image marker 
+        position: int = start + 2
+        while(True):
+            # If we ran out of bytes before the ending delim, the image is malformed, so throw an error
+            if(position + 1 >= len(buffer_as_bytes)):
+                raise Exception('ERROR: Could not find an ending delimeter in pupil buffer')
 
-        # Now, we will iterate over the fields and read them in as numpy arrays
-        for sensor_field, buffer_size in sensor_fields_and_sizes.items():
-            # Next, we will read in a numpy array of that size
-            buffer_as_np: np.ndarray = np.ctypeslib.as_array(getattr(chunk, sensor_field), shape=(buffer_size,))
+            if(buffer_as_bytes[position] != 0xFF):
+                raise Exception(f'ERROR: Expected a JPEG marker at byte {position} of pupil buffer')
 
-            # Append this buffer name and its parsed value to the Python dict 
-            chunk_dict[sensor_field] = parsers[sensor_field](buffer_as_np)
+            # Markers may be padded with any number of FF bytes
+            marker: int = buffer_as_bytes[position + 1]
+            if(marker == 0xFF):
+                position += 1
+                continue
+            position += 2
 
-        # Return the data as Python-compatible objects    
-        return chunk_ptr, chunk_dict
+            if(marker == 0xD9): break
+            if(marker in JPEG_STANDALONE_MARKERS): continue
 
-    # Deserialize the binary file via CPP and read in the
-    # chunk's data into numpy arrays. 
-    cpp_chunk_pointer, chunk_dict = parse_chunk(chunk_path)
+            # Skip the segment's payload, whose length includes the two bytes of the length
+            segment_end: int = position + int.from_bytes(buffer_as_bytes[position:position + 2], 'big')
+            position = segment_end
 
-    # Free the memory allocated in CPP for the chunk (note: for some reason this causes a segfault sometimes. I've commented it out
-    # for now, but may need to see if this memory is actually freed or leaks in some way without this)
-    #cpp_parser_lib.free_chunk_struct(cpp_chunk_pointer)
+            # The entropy coded data follows a start of scan, and runs until 
+            # the first marker that is not a stuffed byte or a restart marker
+            if(marker == 0xDA):
+                while(True):
+                    position = buffer_as_bytes.find(b'\xFF', position)
+                    if(position == -1 or position + 1 >= len(buffer_as_bytes)):
+                        raise Exception('ERROR: Could not find an ending delimeter in pupil buffer')
 
-    return chunk_dict
+                    next_byte: int = buffer_as_bytes[position + 1]
+                    if(next_byte == 0x00 or 0xD0 <= next_byte <= 0xD7): position += 2
+                    else: break
+
+        # Include the ending delim in the bytes of this frame
+        frames.append((start, position))
+
+        # Find the next image after the end of this one
+        start = buffer_as_bytes.find(b'\xFF\xD8', position)
+
+    return frames
+
+"""Split a buffer of MJPEG compressed images on their start and end delimeters
+   and decode them into an array of grayscale frames"""
+def decode_mjpeg_buffer(buffer: np.ndarray, frame_shape: tuple) -> np.ndarray:
+    buffer_as_bytes: bytes = buffer.tobytes()
+    frames: list = [np.frombuffer(buffer_as_bytes, dtype=np.uint8, count=end-start, offset=start)
+                    for start, end in find_mjpeg_frames(buffer_as_bytes)]
+
+    # If we got an empty buffer, simply return an empty array
+    if(len(frames) == 0):
+        return np.empty((0, *frame_shape), dtype=np.uint8)
+
+    return np.array([cv2.imdecode(frame, cv2.IMREAD_GRAYSCALE) for frame in frames], dtype=np.uint8)
 
 """Parse chunks that are stored in .pkl format, instead of broken down 
-   into folders and cleanly stored"""
-def parse_chunks_pkl(experiment_path: str, use_mean_frame: bool=False) -> list:
+   into folders and cleanly stored. If workers > 1, the chunks are parsed by a 
+   pool of that many processes. If sensors is given, only those sensors are decoded"""
+def parse_chunks_pkl(experiment_path: str, use_mean_frame: bool=False, workers: int=1, sensors: tuple=None) -> list:
+    return list(iter_chunks_pkl(experiment_path, use_mean_frame, workers, sensors))
+
+"""Stream the parsed chunks stored in .pkl format, in order"""
+def iter_chunks_pkl(experiment_path: str, use_mean_frame: bool=False, workers: int=1, sensors: tuple=None):
+    # First, we must find the gather the sorted paths to the chunks
+    # which are stored in .pkl files
+    chunk_paths: list = natsorted([os.path.join(experiment_path, file) 
+                                    for file in os.listdir(experiment_path)
+                                    if '.pkl' in file])
+
+    # Next, we will parse the chunks as they are needed
+    for chunk_num, parsed_chunk in enumerate(map_chunks(parse_chunk_pkl, chunk_paths, workers, use_mean_frame, sensors)):
+        print(f'Parsed chunk: {chunk_num+1}/{len(chunk_paths)}')
+
+        yield parsed_chunk
+
+"""Load and parse an individual chunk stored in .pkl format"""
+def parse_chunk_pkl(path: str, use_mean_frame: bool=False, sensors: tuple=None) -> dict:
 
     # First, define some helper functions
     """Parser for the raw World data per chunk"""
@@ -302,49 +673,87 @@ def parse_chunks_pkl(experiment_path: str, use_mean_frame: bool=False) -> list:
                             'P': pupil_parser,
                             'M': ms_parser}
 
-    # First, we must find the gather the sorted paths to the chunks
-    # which are stored in .pkl files
-    chunk_paths: list = natsorted([os.path.join(experiment_path, file) 
-                                    for file in os.listdir(experiment_path)
-                                    if '.pkl' in file])
+    # Read in the dictionary of values from this chunk
+    with open(path, 'rb') as f:
+        chunk: dict = pickle.load(f)
 
-    # Initialize a list to hold the sorted chunks after 
-    # they have been loaded in
-    sorted_chunks: list = []
+    # Next, we will iterate over the sensors and their respective data in the chunk and parse them 
+    parsed_chunk: dict = {}
+    for key, val in chunk.items():
+        # Skip the sensors we do not want to decode
+        if(sensors is not None and key not in sensors): continue
 
-    # Next, we will iterate over the chunk files and load them in 
-    for chunk_num, path in enumerate(chunk_paths):
-        print(f'Loading chunk: {chunk_num+1}/{len(chunk_paths)}')
+        # Parse this sensor's data with its appropriate sensor and note 
+        # this sensor's parsed info for this chunk 
+        parsed_chunk[key] = sensor_parsers[key](val)
 
-        # Read in the file and append it to the sorted chunks 
-        # list
-        with open(path, 'rb') as f:
-            # Read in the dictionary of values from this chunk
-            chunk_dict: dict = pickle.load(f)
+    return parsed_chunk
 
-            # Append it to the sorted chunk list 
-            sorted_chunks.append(chunk_dict)
 
-    # Next, we will iterate over the chunks and their sensors and their respective data in the chunk and parse them 
+# The timing fields the recorders store with each sensor's chunk, passed through as is when
+# present: the CLOCK_MONOTONIC time the chunk was scheduled to start at, how late the sensor 
+# actually started it, and when each of its frames/readings arrived
+CHUNK_TIMING_FIELDS: tuple = ('start_time_ns', 'start_offset_ns', 'frame_times_ns', 'arrival_ns', 'frame_metadata')
+
+"""Parse chunks that are stored in the columnar chunk container format. The frames
+   of each chunk are returned as read-only np.memmaps, so slicing them reads only 
+   the requested frames from disk instead of deserializing entire chunks"""
+def parse_chunks_container(experiment_path: str, use_mean_frame: bool=False, start_chunk: int=0, end_chunk: int=None) -> list:
+    # First, let's find all of the chunks in sorted order
+    chunk_paths: list = find_chunk_containers(experiment_path)[start_chunk:end_chunk]
+
+    # Next, we will iterate over the chunk files and open them
     parsed_chunks: list = []
-    for chunk_num, chunk in enumerate(sorted_chunks):
-        print(f'Parsing chunk: {chunk_num+1}/{len(sorted_chunks)}')
+    for chunk_num, path in enumerate(chunk_paths):
+        # Memory map the sensors' frames in this chunk
+        chunk: dict = chunk_container.read_chunk_container(path)
+
         # initialize a new dictionary to hold sensors' parsed information
         parsed_chunk: dict = {}
+        for sensor, fields in chunk.items():
+            # Retrieve the shared information of all sensors, as a float for MATLAB use later
+            sensor_info: dict = {'num_frames_captured': float(fields['num_frames']), 'FPS': fields['fps'], 'start_time': fields['start_time']}
+            sensor_info |= {field: fields[field] for field in CHUNK_TIMING_FIELDS if field in fields}
+            
+            # Use the MS util parsing library to unpack the raw readings, which are small
+            if(sensor == 'M'):
+                AS_channels, TS_channels, LS_channels, LS_temp = MS_util.parse_readings(fields['frames'].tobytes())
+                parsed_chunk[sensor] = {name: readings_df for readings_df, name in zip((AS_channels, TS_channels, LS_channels, LS_temp), ('A', 'T', 'L', 'c'))} | sensor_info
+                continue
+            
+            # Otherwise, leave the frames on disk unless we only want the mean of each frame
+            frame_buffer: np.ndarray = fields['frames'] if use_mean_frame is False else np.mean(fields['frames'], axis=(1,2))
+            parsed_chunk[sensor] = {'frame_buffer': frame_buffer} | sensor_info
 
-        for key, val in chunk.items():
-            # Parse this sensor's data with its appropriate sensor
-            parsed_data: dict = sensor_parsers[key](val)
-
-            # Note this sensor's parsed info for this chunk 
-            parsed_chunk[key] = parsed_data
-        
         # Append this parsed chunk to the growing list of parsed chunks 
         parsed_chunks.append(parsed_chunk)
 
-
     return parsed_chunks
 
+"""Find the chunk containers of a recording in sorted order (not including
+   the side-car containers of the sensors' per-frame means)"""
+def find_chunk_containers(experiment_path: str) -> list:
+    return natsorted([os.path.join(experiment_path, file) 
+                      for file in os.listdir(experiment_path)
+                      if file.endswith(chunk_container.CHUNK_CONTAINER_EXTENSION)
+                      and not file.endswith(f'_frameMeans{chunk_container.CHUNK_CONTAINER_EXTENSION}')])
+
+"""Stream one sensor's samples from a recording of chunk containers, yielding the
+   (timestamps_ns, values) of each chunk in order. The cameras' values are the means 
+   of their frames, read from the side-cars so the frames are never loaded, while the 
+   MS' values are its readings (readings, channels) of each of its chips' channels"""
+def iter_sensor_stream(experiment_path: str, sensor: str, start_chunk: int=0, end_chunk: int=None):
+    for chunk_path in find_chunk_containers(experiment_path)[start_chunk:end_chunk]:
+        # Unpack the MS' raw readings, which are small
+        if(sensor == 'M'):
+            fields: dict = chunk_container.read_chunk_container(chunk_path)[sensor]
+            channels: tuple = MS_util.parse_SERIAL(fields['frames'].tobytes())
+            yield fields['arrival_ns'], np.column_stack([chip_channels.reshape(chip_channels.shape[0], -1).astype(np.float64) for chip_channels in channels])
+            continue
+
+        means_path: str = chunk_path.replace(chunk_container.CHUNK_CONTAINER_EXTENSION, f'_frameMeans{chunk_container.CHUNK_CONTAINER_EXTENSION}')
+        fields: dict = chunk_container.read_chunk_container(means_path)[sensor]
+        yield fields['frame_times_ns'], fields['frame_means']
 
 """Function for filtering out BAD chunks (dropped frames and thus poor fit)
    from a recording. Given """
@@ -371,7 +780,7 @@ def parse_chunks_paths(experiment_path: str) -> list:
     for burst_idx, burst_name in enumerate(burst_names):
         # Initialize an empty dictionary for all sensors
         chunk_dict: dict = {name: ""
-                           for name in ('MS', 'Pupil', 'World', 'Sunglasses', 'WorldSettings', 'WorldFPS')}
+                           for name in ('MS', 'Pupil', 'World', 'Sunglasses', 'WorldSettings', 'WorldFPS', 'WorldFrameMeans', 'PupilFrameMeans')}
         
         # Find all of the files of this burst
         burst_files: list = (os.path.join(experiment_path, file)
@@ -384,6 +793,10 @@ def parse_chunks_paths(experiment_path: str) -> list:
             if('world' in os.path.basename(file).lower() and os.path.isdir(file)):
                 chunk_dict['World'] = file
 
+            # Append the cameras' per-frame means side-cars to their categories
+            elif('_framemeans' in os.path.basename(file).lower() and not os.path.isdir(file)):
+                chunk_dict['WorldFrameMeans' if 'world' in os.path.basename(file).lower() else 'PupilFrameMeans'] = file
+
             # Append the world sensor's settings file to the category
             elif('_settingshistory' in os.path.basename(file).lower() and not os.path.isdir(file)):
                 chunk_dict['WorldSettings'] = file 
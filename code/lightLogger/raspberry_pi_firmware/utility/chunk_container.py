@@ -0,0 +1,136 @@
+import os
+import json
+import struct
+import numpy as np
+
+"""Layout of a chunk container file.
+
+   [MAGIC (8 bytes)][header length (little endian uint64)][JSON header][padding][array 0][padding][array 1]...
+
+   The header is a JSON dict of sensor name -> dict of that sensor's fields. Fields which
+   were np.ndarrays when written (e.g. the frames, per-frame timestamps) are stored as
+   {"offset", "shape", "dtype"} descriptions of a contiguous array in the file, while all other
+   fields (e.g. fps, number of frames, chunk start time) are stored in the header as is. Every
+   array begins on an ARRAY_ALIGNMENT byte boundary so it can be memory mapped directly."""
+CHUNK_CONTAINER_MAGIC: bytes = b'LLCHUNK1'
+CHUNK_CONTAINER_EXTENSION: str = '.chunk'
+ARRAY_ALIGNMENT: int = 64
+
+"""Describe a dtype so it survives the JSON header. Structured dtypes (e.g. per-frame
+   metadata records) are described by their fields, as their str loses them"""
+def describe_dtype(dtype: np.dtype) -> str | list:
+    return dtype.descr if dtype.names is not None else dtype.str
+
+"""Rebuild a dtype from its description in the header"""
+def dtype_from_description(description: str | list) -> np.dtype:
+    if(isinstance(description, list)): return np.dtype([tuple(field) for field in description])
+
+    return np.dtype(description)
+
+"""Return the number of bytes of padding needed to align an offset"""
+def padding_for(offset: int) -> int:
+    return -offset % ARRAY_ALIGNMENT
+
+"""Write a dict of sensor name -> dict of sensor fields to a chunk container at path.
+   The arrays are written straight from their memory with a single gathered os.writev,
+   so they are never copied into a pickle or one large bytes object"""
+def write_chunk_container(path: str, sensors: dict) -> None:
+    # Initialize the header as well as the list of arrays to write after it, in order
+    header: dict = {}
+    arrays: list = []
+
+    # Pass over the sensors to find the arrays and their sizes. Their offsets
+    # are relative to the start of the data section for now
+    data_offset: int = 0
+    for sensor, fields in sensors.items():
+        header[sensor] = {}
+        for field, value in fields.items():
+            # Store everything that is not an array directly in the header
+            if(not isinstance(value, np.ndarray)):
+                header[sensor][field] = value
+                continue
+
+            # Otherwise, record where this array will go in the file
+            array: np.ndarray = np.ascontiguousarray(value)
+            data_offset += padding_for(data_offset)
+            header[sensor][field] = {'offset': data_offset, 'shape': list(array.shape), 'dtype': describe_dtype(array.dtype)}
+            arrays.append((data_offset, array))
+            data_offset += array.nbytes
+
+    # Encode the header with the offsets made absolute. The start of the data section depends
+    # on the length of the header, which depends on the offsets, so iterate until they agree
+    data_start: int = 0
+    while(True):
+        header_bytes: bytes = json.dumps(offset_arrays(header, data_start)).encode('utf-8')
+        header_end: int = len(CHUNK_CONTAINER_MAGIC) + 8 + len(header_bytes)
+        if(header_end + padding_for(header_end) == data_start): break
+        data_start = header_end + padding_for(header_end)
+
+    # Gather the pieces of the file in order
+    pieces: list = [CHUNK_CONTAINER_MAGIC, struct.pack('<Q', len(header_bytes)), header_bytes, bytes(padding_for(header_end))]
+    written_offset: int = 0
+    for array_offset, array in arrays:
+        pieces.append(bytes(array_offset - written_offset))
+        pieces.append(memoryview(array.reshape(-1)).cast('B'))
+        written_offset = array_offset + array.nbytes
+
+    # Write all of the pieces with as few system calls as possible. os.writev may write
+    # only some of the bytes, so keep writing from wherever it stopped
+    fd: int = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        pieces = [memoryview(piece) for piece in pieces if len(piece) > 0]
+        while(len(pieces) > 0):
+            bytes_written: int = os.writev(fd, pieces)
+            while(len(pieces) > 0 and bytes_written >= len(pieces[0])):
+                bytes_written -= len(pieces[0])
+                pieces.pop(0)
+            if(len(pieces) > 0): pieces[0] = pieces[0][bytes_written:]
+    finally:
+        os.close(fd)
+
+"""Return a copy of a header with the offsets of its arrays shifted by data_start"""
+def offset_arrays(header: dict, data_start: int) -> dict:
+    return {sensor: {field: (value | {'offset': value['offset'] + data_start}) if is_array_description(value) else value
+                     for field, value in fields.items()}
+            for sensor, fields in header.items()}
+
+"""Return whether a header field describes an array stored in the file"""
+def is_array_description(value: object) -> bool:
+    return isinstance(value, dict) and set(value.keys()) == {'offset', 'shape', 'dtype'}
+
+"""Read only the header of a chunk container"""
+def read_chunk_container_header(path: str) -> dict:
+    with open(path, 'rb') as f:
+        # Ensure this is actually a chunk container
+        magic: bytes = f.read(len(CHUNK_CONTAINER_MAGIC))
+        if(magic != CHUNK_CONTAINER_MAGIC):
+            raise Exception(f'ERROR: {path} is not a chunk container')
+
+        # Read in the JSON header
+        header_length, = struct.unpack('<Q', f.read(8))
+        return json.loads(f.read(header_length).decode('utf-8'))
+
+"""Open a chunk container, returning a dict of sensor name -> dict of sensor fields.
+   The arrays are returned as read-only np.memmaps, so no frames are read from
+   disk until they are sliced"""
+def read_chunk_container(path: str) -> dict:
+    header: dict = read_chunk_container_header(path)
+
+    # Replace each array description with a memory map of that array
+    sensors: dict = {}
+    for sensor, fields in header.items():
+        sensors[sensor] = {}
+        for field, value in fields.items():
+            if(not is_array_description(value)):
+                sensors[sensor][field] = value
+                continue
+
+            # Empty arrays cannot be memory mapped, so simply create them
+            shape: tuple = tuple(value['shape'])
+            if(np.prod(shape) == 0):
+                sensors[sensor][field] = np.empty(shape, dtype=dtype_from_description(value['dtype']))
+                continue
+
+            sensors[sensor][field] = np.memmap(path, dtype=dtype_from_description(value['dtype']), mode='r', offset=value['offset'], shape=shape)
+
+    return sensors
@@ -22,14 +22,17 @@ extern "C" {
     // Define a struct to return to Python filled with basic types.
     //This is because Python only supports returning and not something like vector
     struct chunk_struct {
-        uint8_t* M; 
-        uint8_t* W;
-        uint8_t* P; 
-        uint8_t* S; 
+        uint8_t* M = nullptr; 
+        uint8_t* W = nullptr;
+        uint8_t* P = nullptr; 
+        uint8_t* S = nullptr; 
         int64_t M_size = 0;
         int64_t W_size = 0; 
         int64_t P_size = 0;
         int64_t S_size = 0;
+        // The deserialized buffers the pointers above point into. Python treats this 
+        // as an opaque pointer, and it is deleted along with the chunk in free_chunk_struct
+        std::vector<std::vector<uint8_t>>* buffers = nullptr; 
     };
 
     /*
@@ -60,9 +63,10 @@ extern "C" {
         // Ensure the file exists. If not, return with error code -1
         if(!fs::exists(filepath)) {
             chunk->M_size = -1;
-            chunk->M_size = -1;
-            chunk->M_size = -1;
-            chunk->M_size = -1;
+            chunk->W_size = -1;
+            chunk->P_size = -1;
+            chunk->S_size = -1;
+            return chunk; 
         }
 
         // Open the file and read it as binary
@@ -72,16 +76,19 @@ extern "C" {
         // error code two  
         if(!in_file.is_open()) {
             chunk->M_size = -2;
-            chunk->M_size = -2;
-            chunk->M_size = -2;
-            chunk->M_size = -2;
+            chunk->W_size = -2;
+            chunk->P_size = -2;
+            chunk->S_size = -2;
+            return chunk; 
         }
 
         // Create a cereal input archive for deserialization
         cereal::BinaryInputArchive in_archive(in_file);
 
-        // Read in the data to an initialized variable
-        std::vector<std::vector<uint8_t>> chunk_vector; 
+        // Read in the data to a heap allocated variable owned by the chunk, so that 
+        // Python can view the buffers directly instead of us copying them
+        chunk->buffers = new std::vector<std::vector<uint8_t>>; 
+        std::vector<std::vector<uint8_t>>& chunk_vector = *chunk->buffers;
         in_archive(chunk_vector); 
 
         // Iterate over the sizes of each of the buffers and print out the size
@@ -102,23 +109,19 @@ extern "C" {
         }
         */
 
-        // Now we need to allocate heap memory for each of these readings and copy them over 
-        // so that Python can retrieve them and free them later
+        // Now point Python to each of these readings in place. They stay alive 
+        // until Python frees the chunk
         chunk->M_size = chunk_vector[0].size(); // First retrieve the number of values in the buffer
-        chunk->M = new uint8_t[chunk->M_size]; // Allocate an array for the MS readings
-        std::copy(chunk_vector[0].begin(), chunk_vector[0].end(), chunk->M); // Copy over the memory to the return value
+        chunk->M = chunk_vector[0].data(); // Point to the MS readings
 
         chunk->W_size = chunk_vector[1].size(); // First retrieve the number of values in the buffer
-        chunk->W = new uint8_t[chunk->W_size]; // Allocate an array for the World Camera readings
-        std::copy(chunk_vector[1].begin(), chunk_vector[1].end(), chunk->W); // Copy over the memory to the return value
+        chunk->W = chunk_vector[1].data(); // Point to the World Camera readings
 
         chunk->P_size = chunk_vector[2].size(); // First retrieve the number of values in the buffer
-        chunk->P = new uint8_t[chunk->P_size]; // Allocate an array for the Pupil Camera readings
-        std::copy(chunk_vector[2].begin(), chunk_vector[2].end(), chunk->P); // Copy over the memory to the return value
+        chunk->P = chunk_vector[2].data(); // Point to the Pupil Camera readings
 
         chunk->S_size = chunk_vector[3].size(); // First retrieve the number of values in the buffer
-        chunk->S = new uint8_t[chunk->S_size]; // Allocate an array for the sunglasses readings
-        std::copy(chunk_vector[3].begin(), chunk_vector[3].end(), chunk->S); // Copy over the memory to the return value
+        chunk->S = chunk_vector[3].data(); // Point to the sunglasses readings
         
         return chunk; 
     }
@@ -132,10 +135,8 @@ extern "C" {
           the chunk itself. 
     */
     void free_chunk_struct(chunk_struct* chunk) {
-        delete[] chunk->M;
-        delete[] chunk->W;
-        delete[] chunk->P;
-        delete[] chunk->S;
+        // The sensors' pointers point into the buffers, so deleting them frees everything
+        delete chunk->buffers;
 
         delete chunk;
     }
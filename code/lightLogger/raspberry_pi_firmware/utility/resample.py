@@ -0,0 +1,317 @@
+import numpy as np
+import itertools
+import argparse
+import time
+import os
+import sys
+
+"""The rate (Hz) each sensor's stream nominally samples at. Gaps in a stream
+   are found against these. The world and pupil cameras are locked to 200 and
+   120 FPS, the MS sends a reading every second and the sunglasses are read
+   every 5 seconds"""
+NOMINAL_RATES: dict = {'W': 200, 'P': 120, 'M': 1, 'S': 1/5}
+
+# An interval longer than this many nominal periods is a gap (i.e. samples were dropped)
+GAP_FACTOR: float = 1.5
+
+# How a stream's samples can be interpolated onto the timeline
+INTERPOLATION_METHODS: tuple = ('linear', 'nearest', 'previous')
+
+"""Find the gaps in a stream of samples taken at timestamps_ns (CLOCK_MONOTONIC ns),
+   as intervals longer than gap_factor nominal periods. Returns the index of the
+   sample before each gap, along with how many samples are missing from it"""
+def find_gaps(timestamps_ns: np.ndarray, nominal_rate: float, gap_factor: float=GAP_FACTOR) -> tuple:
+    nominal_period_ns: float = 1e9 / nominal_rate
+    intervals_ns: np.ndarray = np.diff(timestamps_ns)
+
+    gap_indices: np.ndarray = np.flatnonzero(intervals_ns > gap_factor * nominal_period_ns)
+    missing_samples: np.ndarray = np.maximum(np.round(intervals_ns[gap_indices] / nominal_period_ns) - 1, 1).astype(np.int64)
+
+    return gap_indices, missing_samples
+
+"""Find potentially dropped frames in a signal without timestamps (e.g. a sinusoidal
+   modulation), as the indices where the absolute value of its derivative is at least
+   threshold (by default, its 98th percentile). Mirrors findDroppedFrames.m, but
+   returns 0 indexed indices of the sample before each jump"""
+def find_dropped_frames(signal: np.ndarray, threshold: float=None) -> np.ndarray:
+    sequential_differences: np.ndarray = np.abs(np.diff(np.asarray(signal, dtype=np.float64)))
+    if(threshold is None): threshold = np.percentile(sequential_differences, 98)
+
+    return np.flatnonzero(sequential_differences >= threshold)
+
+"""Interpolate samples (samples, ...) taken at the increasing timestamps_ns at the times
+   grid_ns, which must lie between the first and last timestamp. Timeline points inside an
+   interval longer than max_gap_ns are NaN rather than interpolated across, if desired"""
+def interpolate_samples(grid_ns: np.ndarray, timestamps_ns: np.ndarray, values: np.ndarray,
+                        method: str='linear', max_gap_ns: float=None) -> np.ndarray:
+    if(method not in INTERPOLATION_METHODS):
+        raise Exception(f'ERROR: Unsupported interpolation method: {method}')
+
+    values = np.asarray(values, dtype=np.float64)
+    if(timestamps_ns.shape[0] == 1): return np.repeat(values, grid_ns.shape[0], axis=0)
+
+    # Find the interval each time on the timeline falls into, as the samples before and after it
+    before: np.ndarray = np.clip(np.searchsorted(timestamps_ns, grid_ns, side='right') - 1, 0, timestamps_ns.shape[0] - 2)
+    after: np.ndarray = before + 1
+    span_ns: np.ndarray = timestamps_ns[after] - timestamps_ns[before]
+    elapsed_ns: np.ndarray = grid_ns - timestamps_ns[before]
+
+    # Find how far through the interval each time is (samples may share a timestamp,
+    # e.g. MS readings that arrived in the same block, so avoid dividing by 0)
+    weights: np.ndarray = np.where(span_ns > 0, elapsed_ns / np.maximum(span_ns, 1), 0)
+    if(method == 'nearest'): weights = (weights > 0.5).astype(np.float64)
+    elif(method == 'previous'): weights = (weights >= 1).astype(np.float64)
+    weights = weights.reshape(-1, *(1,) * (values.ndim - 1))
+
+    resampled: np.ndarray = values[before] * (1 - weights) + values[after] * weights
+
+    # Don't make up samples inside gaps that are too long
+    if(max_gap_ns is not None):
+        resampled[(span_ns > max_gap_ns) & (elapsed_ns > 0) & (elapsed_ns < span_ns)] = np.nan
+
+    return resampled
+
+"""Resamples one sensor's stream onto a uniform timeline of rate (Hz) starting at start_ns,
+   one chunk at a time. Only the last sample of each chunk is kept to interpolate across
+   the boundary with the next, so a stream of any length can be resampled. Every point
+   on the timeline is emitted once the stream's samples have reached it, and points before
+   the stream's first sample are NaN. The gaps found against nominal_rate are recorded"""
+class StreamResampler:
+    def __init__(self, rate: float, start_ns: int, nominal_rate: float=None,
+                 method: str='linear', max_gap_s: float=None):
+        if(method not in INTERPOLATION_METHODS):
+            raise Exception(f'ERROR: Unsupported interpolation method: {method}')
+
+        # Describe the timeline
+        self.period_ns: float = 1e9 / rate
+        self.start_ns: int = int(start_ns)
+        self.method: str = method
+        self.max_gap_ns: float = None if max_gap_s is None else max_gap_s * 1e9
+        self.nominal_rate: float = nominal_rate
+
+        # The index of the next point on the timeline to emit
+        self.next_point: int = 0
+
+        # The last sample of the previous chunk
+        self.last_timestamp_ns: np.ndarray = None
+        self.last_value: np.ndarray = None
+
+        # Count the samples received, as well as the time of the sample
+        # before each gap and how many samples are missing from it
+        self.num_samples: int = 0
+        self.gap_starts_ns: list = []
+        self.missing_samples: list = []
+
+    """Return the times of the points [first, last) on the timeline"""
+    def timeline(self, first: int, last: int) -> np.ndarray:
+        return self.start_ns + np.round(np.arange(first, last) * self.period_ns).astype(np.int64)
+
+    """Feed the next chunk of samples (samples, ...) taken at timestamps_ns. Returns the
+       times of the points on the timeline they reached and the samples resampled at them"""
+    def feed(self, timestamps_ns: np.ndarray, values: np.ndarray) -> tuple:
+        timestamps_ns = np.asarray(timestamps_ns, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        assert(timestamps_ns.shape[0] == values.shape[0])
+        if(timestamps_ns.shape[0] == 0): return self.timeline(0, 0), np.empty((0, *values.shape[1:]))
+        self.num_samples += timestamps_ns.shape[0]
+
+        # Resume from the last sample of the previous chunk
+        if(self.last_timestamp_ns is not None):
+            timestamps_ns = np.concatenate((self.last_timestamp_ns, timestamps_ns))
+            values = np.concatenate((self.last_value, values))
+        self.last_timestamp_ns, self.last_value = timestamps_ns[-1:], values[-1:]
+
+        # Record the gaps in this chunk (including the one across the boundary with the last)
+        if(self.nominal_rate is not None):
+            gap_indices, missing_samples = find_gaps(timestamps_ns, self.nominal_rate)
+            self.gap_starts_ns.append(timestamps_ns[gap_indices])
+            self.missing_samples.append(missing_samples)
+
+        # Find the points on the timeline these samples have now reached
+        last_point: int = int(np.floor((timestamps_ns[-1] - self.start_ns) / self.period_ns)) + 1
+        if(last_point <= self.next_point): return self.timeline(0, 0), np.empty((0, *values.shape[1:]))
+        grid_ns: np.ndarray = self.timeline(self.next_point, last_point)
+        self.next_point = last_point
+
+        # Resample the stream at these points, leaving the ones before it began as NaN
+        resampled: np.ndarray = np.full((grid_ns.shape[0], *values.shape[1:]), np.nan)
+        started: np.ndarray = grid_ns >= timestamps_ns[0]
+        resampled[started] = interpolate_samples(grid_ns[started], timestamps_ns, values, self.method, self.max_gap_ns)
+
+        return grid_ns, resampled
+
+    """Summarize the gaps found in the stream so far"""
+    def gap_report(self) -> dict:
+        gap_starts_ns: np.ndarray = np.concatenate(self.gap_starts_ns) if len(self.gap_starts_ns) > 0 else np.empty(0, dtype=np.int64)
+        missing_samples: np.ndarray = np.concatenate(self.missing_samples) if len(self.missing_samples) > 0 else np.empty(0, dtype=np.int64)
+        total_missing: int = int(np.sum(missing_samples))
+
+        return {'num_samples': self.num_samples, 'num_gaps': int(gap_starts_ns.shape[0]), 'missing_samples': total_missing,
+                'drop_rate': total_missing / max(1, self.num_samples + total_missing),
+                'gap_starts_ns': gap_starts_ns, 'gap_missing_samples': missing_samples}
+
+"""Aligns the streams of several sensors onto one uniform timeline of rate (Hz). Each stream
+   is an iterable of (timestamps_ns, values) chunks, which are only read as they are needed,
+   and the aligned timeline is yielded in blocks as soon as every stream has reached it. The
+   timeline starts once every stream has begun (unless start_ns is given), and streams that
+   end early are NaN for the rest of it"""
+class StreamAligner:
+    def __init__(self, streams: dict, rate: float, start_ns: int=None, method: str='linear',
+                 max_gap_s: float=None, nominal_rates: dict=NOMINAL_RATES):
+        # Read the first chunk of every stream, skipping empty ones, so we know
+        # when they begin and the shape of their samples
+        self.streams: dict = {name: iter(chunks) for name, chunks in streams.items()}
+        self.first_chunks: dict = {}
+        for name, chunks in self.streams.items():
+            self.first_chunks[name] = next((chunk for chunk in chunks if len(chunk[0]) > 0), None)
+            if(self.first_chunks[name] is None):
+                raise Exception(f'ERROR: Stream {name} has no samples')
+
+        if(start_ns is None): start_ns = max(int(timestamps_ns[0]) for timestamps_ns, _ in self.first_chunks.values())
+
+        # Initialize a resampler for each stream
+        self.resamplers: dict = {name: StreamResampler(rate, start_ns, nominal_rates.get(name), method, max_gap_s)
+                                 for name in self.streams}
+
+    """Yield the aligned streams in blocks, as the times of the points on the
+       timeline and a dict of each stream's samples resampled at them"""
+    def blocks(self):
+        # The blocks of each stream resampled but not yet yielded
+        pending: dict = {name: [] for name in self.streams}
+        sample_shapes: dict = {name: np.shape(values)[1:] for name, (_, values) in self.first_chunks.items()}
+        reached: dict = {name: 0 for name in self.streams}
+        ended: set = set()
+        yielded: int = 0
+        first_chunks: dict = dict(self.first_chunks)
+
+        while(len(ended) < len(self.streams)):
+            # Read from the stream that is furthest behind
+            name: str = min((name for name in self.streams if name not in ended), key=lambda name: reached[name])
+            chunk: tuple = first_chunks.pop(name) if name in first_chunks else next(self.streams[name], None)
+            if(chunk is None):
+                ended.add(name)
+            else:
+                _, resampled = self.resamplers[name].feed(*chunk)
+                pending[name].append(resampled)
+                reached[name] += resampled.shape[0]
+
+            # Yield as much of the timeline as every stream still going has reached.
+            # Once they have all ended, yield the rest of the timeline
+            running: list = [reached[name] for name in self.streams if name not in ended]
+            end_point: int = min(running) if len(running) > 0 else max(reached.values())
+            if(end_point <= yielded): continue
+
+            block: dict = {}
+            for name in self.streams:
+                resampled: np.ndarray = np.concatenate(pending[name]) if len(pending[name]) > 0 else np.empty((0, *sample_shapes[name]))
+
+                # Streams that ended before the end of the block are NaN for the rest of it
+                n_points: int = end_point - yielded
+                if(resampled.shape[0] < n_points):
+                    resampled = np.concatenate((resampled, np.full((n_points - resampled.shape[0], *sample_shapes[name]), np.nan)))
+
+                block[name], rest = resampled[:n_points], resampled[n_points:]
+                pending[name] = [rest] if rest.shape[0] > 0 else []
+
+            yield next(iter(self.resamplers.values())).timeline(yielded, end_point), block
+            yielded = end_point
+
+    """Summarize the gaps found in each stream"""
+    def gap_report(self) -> dict:
+        return {name: resampler.gap_report() for name, resampler in self.resamplers.items()}
+
+"""Read the readings file the sunglasses recorder writes (timestamp_ns,reading lines)
+   in blocks of block_size readings, yielding (timestamps_ns, readings) for each"""
+def iter_sunglasses_readings(path: str, block_size: int=4096):
+    with open(path, 'r') as f:
+        while(True):
+            lines: list = list(itertools.islice(f, block_size))
+            if(len(lines) == 0): break
+
+            block: np.ndarray = np.loadtxt(lines, delimiter=',', dtype=np.int64, ndmin=2)
+            yield block[:, 0], block[:, 1]
+
+"""Split a stream into chunks of chunk_size samples"""
+def split_stream(timestamps_ns: np.ndarray, values: np.ndarray, chunk_size: int):
+    for start in range(0, timestamps_ns.shape[0], chunk_size):
+        yield timestamps_ns[start:start + chunk_size], values[start:start + chunk_size]
+
+"""Generate a synthetic stream of a rate_hz sensor observing a flicker_hz source for duration
+   seconds, dropping drop_rate of its samples in runs. Returns the timestamps and samples"""
+def synthetic_stream(rate_hz: float, duration: float, flicker_hz: float, drop_rate: float,
+                     start_ns: int, rng: np.random.Generator) -> tuple:
+    period_ns: float = 1e9 / rate_hz
+    n_samples: int = int(duration * rate_hz)
+    timestamps_ns: np.ndarray = start_ns + np.round(np.arange(n_samples) * period_ns + rng.normal(0, 0.02 * period_ns, n_samples)).astype(np.int64)
+
+    # Drop runs of 1-4 samples
+    kept: np.ndarray = np.ones(n_samples, dtype=bool)
+    for run_start in rng.choice(n_samples, int(n_samples * drop_rate / 2.5), replace=False):
+        kept[run_start:run_start + rng.integers(1, 5)] = False
+    kept[0] = kept[-1] = True
+
+    values: np.ndarray = np.sin(2 * np.pi * flicker_hz * (timestamps_ns - start_ns) / 1e9)
+
+    return timestamps_ns[kept], values[kept]
+
+"""Parse arguments from the command line"""
+def parse_args() -> tuple:
+    parser = argparse.ArgumentParser(description='Align the sensor streams of a recording (or synthetic ones) onto a uniform timeline, chunk by chunk')
+
+    parser.add_argument('--experiment_path', type=str, default=None, help='A recording to align. If not given, synthetic streams are aligned and checked')
+    parser.add_argument('--sunglasses_path', type=str, default=None, help='The sunglasses readings file of the recording, if any')
+    parser.add_argument('--rate', type=float, default=200, help='The rate (Hz) of the aligned timeline')
+    parser.add_argument('--method', type=str, default='linear', choices=INTERPOLATION_METHODS, help='How to interpolate the streams onto the timeline')
+    parser.add_argument('--max_gap', type=float, default=None, help='Leave gaps longer than this many seconds as NaN rather than interpolating across them')
+    parser.add_argument('--output_path', type=str, default=None, help='A .npz file to save the aligned streams to')
+
+    args = parser.parse_args()
+
+    return args.experiment_path, args.sunglasses_path, args.rate, args.method, args.max_gap, args.output_path
+
+"""Main used for testing purposes. Aligns a recording's streams, or synthetic streams with
+   dropped samples, checking that aligning them chunk by chunk matches aligning them at once"""
+def main():
+    experiment_path, sunglasses_path, rate, method, max_gap, output_path = parse_args()
+
+    # Build the streams of the recording's sensors (only imported here,
+    # as it needs the MS library to parse its readings)
+    if(experiment_path is not None):
+        sys.path.append(os.path.dirname(__file__))
+        import Pi_util
+        streams: dict = {sensor: Pi_util.iter_sensor_stream(experiment_path, sensor) for sensor in ('W', 'P', 'M')}
+        if(sunglasses_path is not None): streams['S'] = iter_sunglasses_readings(sunglasses_path)
+
+    # Otherwise, generate an hour of synthetic streams
+    else:
+        rng: np.random.Generator = np.random.default_rng(0)
+        full_streams: dict = {'W': synthetic_stream(NOMINAL_RATES['W'], 3600, 1, 0.01, 10**9, rng),
+                              'P': synthetic_stream(NOMINAL_RATES['P'], 3600, 1, 0.01, 10**9 + 3 * 10**6, rng),
+                              'M': synthetic_stream(NOMINAL_RATES['M'], 3600, 0.01, 0.02, 10**9 + 10**8, rng)}
+        streams = {name: split_stream(*stream, 10 * int(NOMINAL_RATES[name])) for name, stream in full_streams.items()}
+
+    # Align the streams block by block
+    start_time: float = time.time()
+    aligner: StreamAligner = StreamAligner(streams, rate, method=method, max_gap_s=max_gap)
+    blocks: list = list(aligner.blocks())
+    aligned_t: np.ndarray = np.concatenate([block_t for block_t, _ in blocks])
+    aligned: dict = {name: np.concatenate([block[name] for _, block in blocks]) for name in aligner.streams}
+    print(f'Aligned {len(aligner.streams)} streams onto {aligned_t.shape[0]} points in {len(blocks)} blocks in {time.time() - start_time:.3f} seconds')
+
+    for name, report in aligner.gap_report().items():
+        print(f"{name} | Samples: {report['num_samples']} | Gaps: {report['num_gaps']} | Missing: {report['missing_samples']} ({100 * report['drop_rate']:.3f}%)")
+
+    # Check that aligning the synthetic streams in chunks matches aligning them at once
+    if(experiment_path is None):
+        for name, (timestamps_ns, values) in full_streams.items():
+            covered: np.ndarray = aligned_t <= timestamps_ns[-1]
+            expected: np.ndarray = interpolate_samples(aligned_t[covered], timestamps_ns, values, method, None if max_gap is None else max_gap * 1e9)
+            assert(np.allclose(aligned[name][covered], expected, equal_nan=True))
+            assert(np.all(np.isnan(aligned[name][~covered])))
+        print('Aligning in chunks matches aligning at once')
+
+    if(output_path is not None):
+        np.savez(output_path, t_ns=aligned_t, **aligned)
+
+if(__name__ == '__main__'):
+    main()
@@ -6,16 +6,92 @@ import signal
 import psutil
 import traceback
 import sys
+import numpy as np
 
 # Interval in seconds that readings will be apart
 READ_INTERVAL: float = 5
 
+# The number of readings to buffer before writing them to the readings file, 
+# and the longest time in seconds to hold readings before writing them anyway 
+# (so slow sample rates still reach the disk regularly)
+FLUSH_BLOCK_SIZE: int = 256
+FLUSH_INTERVAL: float = 10
+
+"""Read a single 12 bit reading from the device"""
+def read_sample(device: smbus.SMBus) -> int:
+    # Read data from the device
+    data = device.read_i2c_block_data(0x6b, 0x00, 2)
+
+    # Convert the data read to 12 bits
+    raw_adc = (data[0] & 0x0F) * 256 + data[1]
+    if(raw_adc > 2047): raw_adc -= 4095
+
+    return raw_adc
+
+"""Samples the device on a fixed schedule, sleeping until each deadline 
+   rather than spinning. Readings and their CLOCK_MONOTONIC timestamps are 
+   buffered into preallocated arrays and written to the readings file in blocks"""
+class ScheduledSampler:
+    def __init__(self, device: smbus.SMBus, readings_file: object, 
+                 sample_rate: float=1/READ_INTERVAL, block_size: int=FLUSH_BLOCK_SIZE):
+        self.device: smbus.SMBus = device
+        self.readings_file: object = readings_file
+        self.read_interval_ns: int = int(1e9 / sample_rate)
+
+        # Preallocate the block of readings and when they were taken
+        self.readings: np.ndarray = np.empty(block_size, dtype=np.int16)
+        self.timestamps: np.ndarray = np.empty(block_size, dtype=np.int64)
+        self.num_buffered: int = 0
+        self.last_flush: float = time.monotonic()
+
+        # Count the readings we were too late to take (e.g. the I2C read took longer than the interval)
+        self.missed_deadlines: int = 0
+
+    """Sample for duration seconds (or until interrupted if the duration is infinite)"""
+    def run(self, duration: float) -> None:
+        # Define the deadlines relative to the start, so the schedule does not 
+        # drift with how long each read takes 
+        start_time_ns: int = time.monotonic_ns()
+        end_time_ns: float = start_time_ns + duration * 1e9
+        next_deadline_ns: int = start_time_ns
+        while(next_deadline_ns < end_time_ns):
+            # Sleep until the next reading is due
+            remaining_ns: int = next_deadline_ns - time.monotonic_ns()
+            if(remaining_ns > 0): time.sleep(remaining_ns / 1e9)
+
+            # Take the reading and note when it was taken 
+            self.readings[self.num_buffered] = read_sample(self.device)
+            self.timestamps[self.num_buffered] = time.monotonic_ns()
+            self.num_buffered += 1
+
+            # Write the block if it is full or has been held for too long 
+            if(self.num_buffered == self.readings.shape[0] or (time.monotonic() - self.last_flush) >= FLUSH_INTERVAL):
+                self.flush()
+
+            # Schedule the next reading, skipping any deadlines that already passed
+            next_deadline_ns += self.read_interval_ns
+            missed: int = max(0, (time.monotonic_ns() - next_deadline_ns) // self.read_interval_ns)
+            self.missed_deadlines += missed
+            next_deadline_ns += missed * self.read_interval_ns
+
+    """Write the buffered readings to the readings file as timestamp,reading lines"""
+    def flush(self) -> None:
+        if(self.num_buffered > 0):
+            block: np.ndarray = np.column_stack((self.timestamps[:self.num_buffered], self.readings[:self.num_buffered]))
+            np.savetxt(self.readings_file, block, fmt='%d', delimiter=',')
+            self.readings_file.flush()
+            print(f'Sunglasses: Wrote {self.num_buffered} readings | Last: {self.readings[self.num_buffered-1]} | Missed deadlines: {self.missed_deadlines}')
+
+        self.num_buffered = 0
+        self.last_flush = time.monotonic()
+
 """Record from the device live with no duration"""
 def record_live(duration: float, filename: str,
                 is_subprocess: bool, parent_pid: int,
-                go_flag: threading.Event):
+                go_flag: threading.Event, sample_rate: float=1/READ_INTERVAL):
     # Initialize the readings file variable
     readings_file: object = None
+    sampler: ScheduledSampler = None
 
     # Record live
     try:
@@ -26,38 +102,18 @@ def record_live(duration: float, filename: str,
         readings_file: object = open(filename, 'a')
 
         # Begin recording
-        last_read: float = time.time()
-        while(True):
-            # Capture the current time
-            current_time: float = time.time()
-            
-            # If not at a read time, skip 
-            if((current_time - last_read)) < READ_INTERVAL:
-                continue
-
-            # Read data from the device
-            data = device.read_i2c_block_data(0x6b, 0x00, 2)
-
-            # Convert the data read to 12 bits
-            raw_adc = (data[0] & 0x0F) * 256 + data[1]
-            if(raw_adc > 2047) : raw_adc -= 4095
-            
-            print(f'Sunglasses Writing: {raw_adc}')
-
-            # Write the reading to the reading file
-            readings_file.write(f'{raw_adc}\n')
-
-            # Update the last read time 
-            last_read = current_time
+        sampler = ScheduledSampler(device, readings_file, sample_rate)
+        sampler.run(float('inf'))
     
-    # When exception is raised, close the file
+    # When exception is raised, write the remaining readings and close the file
     except KeyboardInterrupt:
+        if(sampler is not None): sampler.flush()
         readings_file.close()
 
 """Record from the device for a given duration"""
 def record(duration: float, filename: str,
            is_subprocess: bool, parent_pid: int, 
-           go_flag: threading.Event):
+           go_flag: threading.Event, sample_rate: float=1/READ_INTERVAL):
     
     # Initialize a connection to the device
     try:
@@ -107,34 +163,13 @@ def record(duration: float, filename: str,
     print('Sunglasses: Beginning capture')
 
     # Begin recording
-    start_time: float = time.time()
-    last_read: float = time.time()
-    while(True):
-        # Capture the current time
-        current_time: float = time.time()
-
-        # Check to see if we have reached the desired recording duration
-        if(abs(current_time - start_time) >= duration):
-            break 
-        
-        # If not at a read time, skip 
-        if((current_time - last_read)) < READ_INTERVAL:
-            continue
-
-        # Read data from the device
-        data = device.read_i2c_block_data(0x6b, 0x00, 2)
-
-        # Convert the data read to 12 bits
-        raw_adc = (data[0] & 0x0F) * 256 + data[1]
-        if(raw_adc > 2047): raw_adc -= 4095
-        
-        print(f'Sunglasses Writing: {raw_adc}')
-
-        # Write the reading to the reading file
-        readings_file.write(f'{raw_adc}\n')
-
-        # Update the last read time
-        last_read = current_time    
+    sampler: ScheduledSampler = ScheduledSampler(device, readings_file, sample_rate)
+    try:
+        sampler.run(duration)
+    
+    # Write the remaining readings whether we finished or were interrupted
+    finally:
+        sampler.flush()
     
     # Close the readings file
     readings_file.close()